@@ -0,0 +1,281 @@
+"""
+conversion_benchmark.py
+
+Times each stage of the bag -> training data path on synthetic data, so a change to the
+processor, the telemetry loader or data_gen can be measured before a field day instead of
+by watching the FPS printout on a real bag.
+
+A synthetic run (frames with white lane lines on a dark floor, plus a matching telemetry
+csv with frame numbers and host timestamps) is built in a temp folder, then these stages
+are timed one at a time:
+
+    telemetry_load   load_telem_file on the csv (dict by frame number)
+    telemetry_table  utilities.telemetry.load_telemetry on the csv (sorted numpy table)
+    lookup_frame     exact frame-number lookups, one per frame
+    lookup_time      nearest-timestamp join for the whole run
+    preprocess       transform_frame per frame ("bw" product)
+    preprocess_batch transform_batch over BATCH_SIZE frames
+    encode           png encoding of the BW frames
+    write            writing the encoded pngs to disk
+    write_shards     packing the BW frames into shards
+    write_packed     packing the BW frames into bit-packed shards (1 bit per pixel)
+    batch_load       one epoch of data_gen.batch_generator over the written pngs
+    batch_loader     the same epoch through data_gen.BatchLoader (LOADER_WORKERS decode threads);
+                     decode only, so on few cores the threads can be slower than batch_load
+    train_generator  batch_load with a fixed TRAIN_STEP_MS sleep per batch standing in for model.fit
+    train_loader     the same through BatchLoader, whose threads decode while the step runs
+    shard_batch_load one epoch of data_gen.shard_batch_generator over the shards
+    packed_batch_load the same epoch over the bit-packed shards (unpacked per batch)
+
+Each stage runs --repeat times and the fastest run is kept. Results are saved as JSON
+(benchmark_results/conversion_<time>.json); pass --compare with an earlier file to see
+the change per stage.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+import cv2
+import numpy as np
+import data_gen
+import rover_data_processor as rdp
+import utilities.telemetry as tl
+from utilities.shard_io import ShardWriter, list_shards, packed_name
+
+RESULTS_PATH = "benchmark_results"
+# frames in the synthetic run (about 1.5 minutes of driving at 30 fps)
+NUM_FRAMES = 3000
+# distinct synthetic frames cycled through the run
+NUM_PATTERNS = 32
+# fraction of frames with no telemetry row
+MISSING_TELEMETRY = 0.05
+BATCH_SIZE = 64
+REPEAT = 3
+# simulated training step per batch (ms) for the train_* stages
+TRAIN_STEP_MS = 20
+# a stage this much slower than the compared run is flagged
+REGRESSION_THRESHOLD = 0.10
+
+
+def make_frames(num_patterns=NUM_PATTERNS, seed=0):
+    # 640x480 bgr frames with two bright lane lines on a noisy dark floor,
+    # so png sizes and threshold results look like the real thing
+    rng = np.random.default_rng(seed)
+    frames = []
+    for i in range(num_patterns):
+        frame = rng.integers(40, 90, (480, 640, 3), dtype=np.uint8)
+        offset = int(rng.integers(-60, 60))
+        cv2.line(frame, (200 + offset, 479), (300 + offset // 2, 160), (240, 240, 240), 12)
+        cv2.line(frame, (460 + offset, 479), (360 + offset // 2, 160), (240, 240, 240), 12)
+        frames.append(frame)
+    return frames
+
+
+def make_telemetry(path, num_frames, missing=MISSING_TELEMETRY, seed=0):
+    # telemetry csv like rs_rover_collect writes: frame numbers start at 1, 30 fps host timestamps,
+    # a few rows lost; returns (frame numbers, frame timestamps) for the camera side
+    rng = np.random.default_rng(seed)
+    frames = np.arange(1, num_frames + 1)
+    frame_times = 1.7e9 + frames / 30.0
+    keep = rng.random(num_frames) >= missing
+    throttle = 1500 + rng.integers(0, 300, num_frames)
+    steering = 1192 + rng.integers(0, 600, num_frames)
+    heading = rng.integers(0, 360, num_frames)
+    jitter = rng.normal(0, 0.003, num_frames)
+    with open(path, 'w') as f:
+        f.write("index,throttle,steering,heading,timestamp\n")
+        for i in np.flatnonzero(keep):
+            f.write(f"{frames[i]},{throttle[i]},{steering[i]},{heading[i]},{frame_times[i] + jitter[i]:.6f}\n")
+    return frames, frame_times
+
+
+class StageTimer:
+    # best-of-N wall time per stage
+    def __init__(self, repeat=REPEAT):
+        self.repeat = repeat
+        self.results = {}
+
+    def run(self, name, func, items):
+        best = None
+        result = None
+        for _ in range(self.repeat):
+            start = time.perf_counter()
+            result = func()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        self.results[name] = {'items': items, 'seconds': best,
+                              'ms_per_item': best / items * 1000 if items else 0.0,
+                              'items_per_sec': items / best if best > 0 else 0.0}
+        print(f"  {name:<17} {items:>7} items  {best:8.3f} s  "
+              f"{self.results[name]['ms_per_item']:8.3f} ms/item  {self.results[name]['items_per_sec']:10.1f} items/sec")
+        return result
+
+
+def run_benchmark(num_frames=NUM_FRAMES, batch_size=BATCH_SIZE, repeat=REPEAT, work_folder=None,
+                  train_step_ms=TRAIN_STEP_MS):
+    work_folder = work_folder or tempfile.mkdtemp(prefix="rover_bench_")
+    run_folder = os.path.join(work_folder, "run")
+    shard_folder = os.path.join(work_folder, "shards")
+    csv_file = os.path.join(work_folder, "run.csv")
+    timer = StageTimer(repeat)
+    try:
+        patterns = make_frames()
+        frames, frame_times = make_telemetry(csv_file, num_frames)
+        stream = [patterns[i % len(patterns)] for i in range(num_frames)]
+        print(f"Benchmarking {num_frames} synthetic frames in {work_folder}")
+
+        # telemetry
+        frm_lookup = timer.run("telemetry_load", lambda: rdp.load_telem_file(csv_file), num_frames)
+        telem = timer.run("telemetry_table", lambda: tl.load_telemetry(csv_file), num_frames)
+        timer.run("lookup_frame", lambda: [frm_lookup.get(int(frm)) for frm in frames], num_frames)
+        timer.run("lookup_time", lambda: tl.frame_lookup(frames, frame_times, telem), num_frames)
+
+        # preprocessing
+        timer.run("preprocess", lambda: [rdp.transform_frame({'color': frame, 'depth': None}, ("bw",), copy=True)
+                                         for frame in stream], num_frames)
+        raws = [{'color': frame, 'depth': None} for frame in stream]
+        images = timer.run("preprocess_batch", lambda: [images for start in range(0, num_frames, batch_size)
+                                                        for images in rdp.transform_batch(raws[start:start + batch_size],
+                                                                                          ("bw",))],
+                           num_frames)
+        BW_frames = [image['bw'] for image in images]
+
+        # output
+        encoded = timer.run("encode", lambda: [cv2.imencode(".png", image)[1] for image in BW_frames], num_frames)
+        names = []
+        for frm in frames:
+            telem_row = frm_lookup.get(int(frm), ("1500", "1500", "0"))
+            names.append(os.path.join(run_folder, f"{frm:09d}_{telem_row[0]}_{telem_row[1]}_{telem_row[2]}_BW.png"))
+
+        def write_pngs():
+            shutil.rmtree(run_folder, ignore_errors=True)
+            os.makedirs(run_folder)
+            for name, data in zip(names, encoded):
+                with open(name, 'wb') as f:
+                    f.write(data.tobytes())
+        timer.run("write", write_pngs, num_frames)
+
+        def write_shards():
+            shutil.rmtree(shard_folder, ignore_errors=True)
+            writer = ShardWriter(os.path.join(shard_folder, "run"), name="bw")
+            for frm, image in zip(frames, BW_frames):
+                writer.add(image, frm, 1500, 1500, 0)
+            writer.close()
+        timer.run("write_shards", write_shards, num_frames)
+
+        def write_packed():
+            run_folder = os.path.join(shard_folder, "run")
+            for path in list_shards(run_folder, packed_name("bw")):
+                os.remove(path)
+            writer = ShardWriter(run_folder, name=packed_name("bw"))
+            for frm, image in zip(frames, BW_frames):
+                writer.add(image, frm, 1500, 1500, 0)
+            writer.close()
+        timer.run("write_packed", write_packed, num_frames)
+        shard_bytes = sum(os.path.getsize(p) for p in list_shards(os.path.join(shard_folder, "run"), "bw"))
+        packed_bytes = sum(os.path.getsize(p)
+                           for p in list_shards(os.path.join(shard_folder, "run"), packed_name("bw")))
+        print(f"BW shards: {shard_bytes / 1e6:.1f} MB, bit-packed: {packed_bytes / 1e6:.1f} MB")
+
+        # training input
+        samples = sorted(names)
+        num_batches = (len(samples) + batch_size - 1) // batch_size
+
+        def load_epoch(generator):
+            for _ in range(num_batches):
+                next(generator)
+        timer.run("batch_load", lambda: load_epoch(data_gen.batch_generator(samples, batch_size)), num_frames)
+
+        def load_threaded():
+            loader = data_gen.BatchLoader(samples, batch_size, workers=data_gen.LOADER_WORKERS)
+            try:
+                load_epoch(loader)
+            finally:
+                loader.close()
+        timer.run("batch_loader", load_threaded, num_frames)
+
+        # the same epochs as model.fit sees them: the caller is busy for train_step_ms per batch,
+        # so only decoding that overlaps the step makes the epoch faster
+        def train_epoch(batches):
+            for _ in range(num_batches):
+                next(batches)
+                time.sleep(train_step_ms / 1000)
+        timer.run("train_generator", lambda: train_epoch(data_gen.batch_generator(samples, batch_size)), num_frames)
+
+        def train_threaded():
+            loader = data_gen.BatchLoader(samples, batch_size, workers=data_gen.LOADER_WORKERS)
+            try:
+                train_epoch(loader)
+            finally:
+                loader.close()
+        timer.run("train_loader", train_threaded, num_frames)
+
+        shards, shard_samples = data_gen.get_shard_samples(shard_folder, shuffle_series=False)
+        num_batches = (len(shard_samples) + batch_size - 1) // batch_size
+        timer.run("shard_batch_load",
+                  lambda: load_epoch(data_gen.shard_batch_generator(shards, shard_samples, batch_size)),
+                  len(shard_samples))
+
+        packed, packed_samples = data_gen.get_shard_samples(shard_folder, shuffle_series=False,
+                                                            name=packed_name("bw"))
+        timer.run("packed_batch_load",
+                  lambda: load_epoch(data_gen.shard_batch_generator(packed, packed_samples, batch_size)),
+                  len(packed_samples))
+    finally:
+        shutil.rmtree(work_folder, ignore_errors=True)
+
+    return {'created': time.strftime("%Y%m%d-%H%M%S"),
+            'host': platform.node(), 'platform': platform.platform(), 'cpus': os.cpu_count(),
+            'python': platform.python_version(), 'numpy': np.__version__, 'opencv': cv2.__version__,
+            'params': {'frames': num_frames, 'batch_size': batch_size, 'repeat': repeat,
+                       'train_step_ms': train_step_ms},
+            'stages': timer.results}
+
+
+def compare(results, baseline, threshold=REGRESSION_THRESHOLD):
+    # per-stage change in ms/item against an earlier results file; returns the regressed stages
+    regressions = []
+    print(f"Compared with {baseline.get('created')} ({baseline.get('host')}):")
+    for name, stage in results['stages'].items():
+        before = baseline.get('stages', {}).get(name)
+        if before is None or before['ms_per_item'] == 0:
+            print(f"  {name:<17} (new)")
+            continue
+        change = stage['ms_per_item'] / before['ms_per_item'] - 1.0
+        flag = ""
+        if change > threshold:
+            flag = "  <-- slower"
+            regressions.append(name)
+        print(f"  {name:<17} {before['ms_per_item']:8.3f} -> {stage['ms_per_item']:8.3f} ms/item ({change:+.0%}){flag}")
+    return regressions
+
+
+def save_results(results, folder=RESULTS_PATH):
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, f"conversion_{results['created']}.json")
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {path}")
+    return path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the conversion and data loading stages.")
+    parser.add_argument("-n", "--frames", type=int, default=NUM_FRAMES, help="Frames in the synthetic run.")
+    parser.add_argument("-b", "--batch", type=int, default=BATCH_SIZE, help="Batch size for batched stages.")
+    parser.add_argument("-r", "--repeat", type=int, default=REPEAT, help="Runs per stage (fastest is kept).")
+    parser.add_argument("--step-ms", type=float, default=TRAIN_STEP_MS,
+                        help="Simulated training step per batch for the train_* stages.")
+    parser.add_argument("-o", "--output", type=str, default=RESULTS_PATH, help="Folder for the results JSON.")
+    parser.add_argument("--compare", type=str, default=None, help="Earlier results JSON to compare against.")
+    args = parser.parse_args()
+
+    results = run_benchmark(args.frames, args.batch, args.repeat, train_step_ms=args.step_ms)
+    save_results(results, args.output)
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            compare(results, json.load(f))
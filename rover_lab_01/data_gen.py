@@ -13,8 +13,13 @@ data_gen.py
 import cv2
 import os
 import glob
-from random import shuffle
+import queue
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
+import utilities.shard_io as shard_io
+import utilities.sample_manifest as sample_manifest
 
 # Constants defining the range of steering and throttle values
 # Note that these should match YOUR rover's range 
@@ -24,6 +29,20 @@ STEERING_MAX = 1792
 THROTTLE_MIN = 1492
 THROTTLE_MAX = 1800
 
+# Read png samples through the dataset manifest kept in the data folder (utilities/sample_manifest.py):
+# samples become one structured array with their labels, and only changed run folders are rescanned
+USE_MANIFEST = True
+
+# BatchLoader defaults: decode threads, and finished batches kept ready ahead of training
+LOADER_WORKERS = 4
+PREFETCH_BATCHES = 8
+
+# ImageCache defaults: memory for decoded samples kept across epochs, and what happens once it is full:
+# "keep" stops adding images (a fixed part of the dataset stays resident, the best a cache can do for
+# repeated full passes over data larger than the budget); "lru" evicts the least recently used image
+CACHE_BYTES = 2 * 1024 ** 3
+CACHE_POLICY = "keep"
+
 """
 HINT:  Get values to the above by querying your own rover...
 throttle_max = rover.parameters['RC3_MAX']
@@ -43,36 +62,40 @@ def invert_min_max_norm(val, v_min=1000.0, v_max=2000.0):
     return (val * (v_max - v_min)) + v_min
 
 
-# Gathers a list of image file paths in sequences from subdirectories of a root folder
+# Gathers a list of image file paths in sequences from subdirectories of a root folder.
+# Every interval-th file from offset_start is kept and cut into whole sequences within each
+# run folder (a sequence never spans two runs; a run's last partial sequence is dropped).
+# With use_manifest each sequence is a slice of the manifest sample array instead of a list of paths.
 def get_sample_series_list(root_folder, sequence_size=13,
                            offset_start=0, shuffle_series=True,
-                           random_state=None, interval=1, ends_with="*_BW.png"):
+                           random_state=None, interval=1, ends_with="*_BW.png",
+                           use_manifest=USE_MANIFEST):
                            
     samples = []  # simple array to append all the entries present in the .csv file
-    sub_folders = [f.path for f in os.scandir(root_folder) if f.is_dir()]
-    sequence = []
 
-    for folder in sub_folders:
-        path = os.path.join(folder, ends_with)
-        files = sorted(glob.glob(path))
-        file_count = 0
-        for file in files:
-            if file_count % interval == 0:
-                if len(sequence) >= sequence_size:
-                    # Add sequence to list of sequences/samples
-                    samples.append(sequence)
-
-                    # reset sequence list
-                    sequence = []
-                
-                # continue to build current sequence...
-                file_count += 1
-                if file_count >= offset_start:
-                    sequence.append(file)
+    if use_manifest:
+        # row numbers into the manifest samples, one range per run folder
+        records, sizes = sample_manifest.load_samples(root_folder, ends_with)
+        folder_files = np.split(np.arange(len(records)), np.cumsum(sizes)[:-1]) if sizes else []
+    else:
+        sub_folders = [f.path for f in os.scandir(root_folder) if f.is_dir()]
+        folder_files = (sorted(glob.glob(os.path.join(folder, ends_with))) for folder in sub_folders)
+
+    for files in folder_files:
+        files = files[offset_start::interval]
+        for start in range(0, len(files) - sequence_size + 1, sequence_size):
+            samples.append(files[start:start + sequence_size])
+
+    if use_manifest:
+        samples = [records[seq] for seq in samples]
+    else:
+        samples = [list(seq) for seq in samples]
 
     if shuffle_series:
-        # Shuffle the order of sequences so that they are not contiguous.
-        shuffle(samples, random =random_state)
+        # Shuffle the order of sequences so that they are not contiguous
+        # (random_state seeds the order, like get_shard_samples).
+        order = np.random.default_rng(random_state).permutation(len(samples))
+        samples = [samples[i] for i in order]
 
     return samples
 
@@ -80,7 +103,8 @@ def get_sample_series_list(root_folder, sequence_size=13,
 # Organizes all image files in subfolders under the root folder into sequences
 def get_sequence_samples(root_folder, sequence_size=13,
                             offset_start=0, shuffle_series=True,
-                            random_state=None, interval=1):
+                            random_state=None, interval=1, ends_with="*_BW.png",
+                            use_manifest=USE_MANIFEST):
     
     # Start with a list of sequential image series.
     samples = get_sample_series_list(root_folder=root_folder,
@@ -88,13 +112,27 @@ def get_sequence_samples(root_folder, sequence_size=13,
                                      offset_start=offset_start,
                                      shuffle_series=shuffle_series,
                                      random_state=random_state,
-                                     interval=interval)
+                                     interval=interval,
+                                     ends_with=ends_with,
+                                     use_manifest=use_manifest)
 
-    # Finally, convert this list of lists into a single flat list of images.
+    # Finally, convert this list of lists into a single flat list of images
+    # (one sample array when read through the manifest).
+    if use_manifest:
+        if not samples:
+            return np.empty(0, dtype=sample_manifest.sample_dtype(1))
+        return np.concatenate(samples)
     samples = [item for sublist in samples for item in sublist]
     return samples
 
 
+# Path of one sample, from a list of paths or a manifest sample array
+def sample_path(sample):
+    if isinstance(sample, np.void):
+        return os.fsdecode(sample['path'])
+    return sample
+
+
 # Splits the samples into two sets based on a specified fraction
 def split_samples(samples, fraction=0.8):
     length = len(samples)
@@ -102,65 +140,537 @@ def split_samples(samples, fraction=0.8):
     return samples[:num_training], samples[num_training:]
 
 
+# Loads one sample image: single-channel pngs as gray, fused multi-channel samples
+# (rover_data_processor "fused" product, *_fused.png or *_fused.npy) as (H, W, C) arrays
+def load_sample_image(path):
+    if path.endswith(".npy"):
+        return np.load(path)
+    if "_fused." in os.path.basename(path):
+        return cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    return cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+
+
+# Shape of one model input, (H, W, C), from the first png sample or shard;
+# feed this to define_model(input_shape=...)
+def get_input_shape(samples=None, shards=None):
+    if shards:
+        shape = shards[0][0].shape[1:]
+    else:
+        shape = load_sample_image(sample_path(samples[0])).shape
+    if len(shape) == 2:
+        shape = shape + (1,)
+    return tuple(int(d) for d in shape)
+
+
+class ImageCache:
+    """
+    Decoded sample images kept in memory across epochs, up to max_bytes, keyed by path.
+    Thread safe, so one cache can be shared by the BatchLoader workers (and by the training
+    and validation loaders). pin() decodes a set of paths up front (e.g. the validation set)
+    and keeps them for the whole run, never evicted; they count against the budget too,
+    and pinning stops once it is used up.
+
+    Hits and misses are counted per tag (e.g. "train", "val"); take_stats(tag) returns
+    and resets them, so each loader can report its own hit rate every epoch.
+    Cached images are read-only; batches are built by copying them.
+    """
+
+    def __init__(self, max_bytes=CACHE_BYTES, policy=CACHE_POLICY):
+        if policy not in ("keep", "lru"):
+            raise ValueError(f"unknown cache policy: {policy} (choose keep or lru)")
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.entries = OrderedDict()
+        self.pinned = {}
+        self.resident_bytes = 0
+        self.evictions = 0
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def pin(self, paths, workers=LOADER_WORKERS):
+        """Decode these images now and keep them for the whole run (as many as fit in the budget)."""
+        paths = [os.fsdecode(path) for path in paths]
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            # only a few decodes are in flight at a time, so nothing more is read once the budget is used up
+            pending = deque((path, pool.submit(load_sample_image, path)) for path in paths[:2 * workers])
+            next_path = len(pending)
+            while pending:
+                path, future = pending.popleft()
+                if next_path < len(paths):
+                    pending.append((paths[next_path], pool.submit(load_sample_image, paths[next_path])))
+                    next_path += 1
+                image = future.result()
+                if image is None:
+                    continue
+                image.setflags(write=False)
+                with self.lock:
+                    if path in self.entries:
+                        self.resident_bytes -= self.entries.pop(path).nbytes
+                    if path in self.pinned:
+                        continue
+                    if self.resident_bytes + image.nbytes > self.max_bytes:
+                        print(f"[cache] budget used up after pinning {len(self.pinned)} of {len(paths)} images")
+                        pool.shutdown(wait=True, cancel_futures=True)
+                        return
+                    self.pinned[path] = image
+                    self.resident_bytes += image.nbytes
+
+    def get(self, path, tag=None):
+        with self.lock:
+            counts = self.counts.setdefault(tag, [0, 0])
+            image = self.pinned.get(path)
+            if image is None:
+                image = self.entries.get(path)
+                if image is not None and self.policy == "lru":
+                    self.entries.move_to_end(path)
+            counts[0 if image is not None else 1] += 1
+            return image
+
+    def put(self, path, image):
+        image.setflags(write=False)
+        size = image.nbytes
+        with self.lock:
+            if path in self.pinned or path in self.entries:
+                return
+            if self.policy == "lru":
+                while self.entries and self.resident_bytes + size > self.max_bytes:
+                    _, evicted = self.entries.popitem(last=False)
+                    self.resident_bytes -= evicted.nbytes
+                    self.evictions += 1
+            if self.resident_bytes + size <= self.max_bytes:
+                self.entries[path] = image
+                self.resident_bytes += size
+
+    def load(self, path, tag=None):
+        # cached image, or decode it from disk and cache it (None if it cannot be read)
+        image = self.get(path, tag)
+        if image is None:
+            image = load_sample_image(path)
+            if image is not None:
+                self.put(path, image)
+        return image
+
+    def take_stats(self, tag=None):
+        with self.lock:
+            hits, misses = self.counts.pop(tag, [0, 0])
+            return {'hits': hits, 'misses': misses,
+                    'hit_rate': hits / (hits + misses) if hits + misses else 0.0,
+                    'resident_bytes': self.resident_bytes, 'pinned_images': len(self.pinned),
+                    'images': len(self.pinned) + len(self.entries), 'evictions': self.evictions}
+
+    def report(self, tag=None, label=None):
+        stats = self.take_stats(tag)
+        label = label or str(tag or "samples")
+        print(f"[cache] {label}: hit rate {stats['hit_rate']:.1%} ({stats['hits']}/{stats['hits'] + stats['misses']}), "
+              f"{stats['images']} images ({stats['pinned_images']} pinned), "
+              f"{stats['resident_bytes'] / 1e6:.0f} of {self.max_bytes / 1e6:.0f} MB, {stats['evictions']} evictions")
+        return stats
+
+
 def batch_generator(samples, batch_size=13,
                     normalize_labels=True,
-                    y_min=1000.0, y_max=2000.0):
+                    y_min=1000.0, y_max=2000.0,
+                    cache=None, tag=None):
     
     num_samples = len(samples)
+    epoch = 0
     while True:
         for offset in range(0, num_samples, batch_size):
             batch_samples = samples[offset:offset + batch_size]
-            images = []
-            labels = []
-            for batch_sample in batch_samples:
-                try:
-                    if not os.path.exists(batch_sample):
-                        print(f"Skipping missing image: {batch_sample}")
-                        continue
 
-                    file_name = os.path.basename(batch_sample).replace(".png", "")
+            # Here we do not hold the values of X_train and y_train,
+            # instead we yield the values.
+            yield load_batch(batch_samples, normalize_labels, y_min, y_max, cache, tag)
 
-                    # IMPORTANT NOTE: Be sure that these fields line up 
-                    # with your particular file naming convention!
-                    attributes = file_name.split('_')
-                    #print(len(attributes))
-                    if len(attributes) < 5:
-                        f_num, throttle, steering, f_type = file_name.split('_')
-                    else:
-                        f_num, throttle, steering, heading, f_type = file_name.split('_')
-                    #    print("Debugging 1")
+        epoch += 1
+        if cache is not None:
+            cache.report(tag, f"{tag or 'samples'} epoch {epoch}")
 
+
+# Loads the images and labels of one batch, from a list of paths or a manifest sample array.
+# With a cache (ImageCache) images decoded in earlier epochs are reused.
+def load_batch(batch_samples, normalize_labels=True, y_min=1000.0, y_max=2000.0, cache=None, tag=None):
+    if isinstance(batch_samples, np.ndarray) and batch_samples.dtype.names:
+        return load_manifest_batch(batch_samples, normalize_labels, y_min, y_max, cache, tag)
+
+    images = []
+    labels = []
+    for batch_sample in batch_samples:
+        try:
+            image = cache.get(batch_sample, tag) if cache is not None else None
+            if image is None and not os.path.exists(batch_sample):
+                print(f"Skipping missing image: {batch_sample}")
+                continue
+
+            file_name = os.path.splitext(os.path.basename(batch_sample))[0]
+
+            # IMPORTANT NOTE: Be sure that these fields line up 
+            # with your particular file naming convention!
+            attributes = file_name.split('_')
+            #print(len(attributes))
+            if len(attributes) < 5:
+                f_num, throttle, steering, f_type = file_name.split('_')
+            else:
+                f_num, throttle, steering, heading, f_type = file_name.split('_')
+            #    print("Debugging 1")
+
+            try:
+                throttle = int(throttle)
+                steering = int(steering)
+            except ValueError:
+                print(f"Error parsing labels from filename: {batch_sample}")
+                raise
+
+            # As we stream frames from the realsense camera, we opted to
+            # configure that stream to give us B&W images.
+            # If this is not the case, then change the line below!
+            # (fused samples load all their channels at once)
+            if image is None:
+                image = load_sample_image(batch_sample)
+                if image is None:
+                    print(f"Error loading image: {batch_sample}")
+                    raise ValueError("Failed to load image")
+                if cache is not None:
+                    cache.put(batch_sample, image)
+            images.append(image)
+
+            if normalize_labels:
+                steering = min_max_norm(steering, y_min, y_max)
+                throttle = min_max_norm(throttle, y_min, y_max)
+
+            labels.append([steering, throttle])
+
+        except Exception as e:
+            print(f" [EXCEPTION ENCOUNTERED: {e}; skipping sample {batch_sample}.] ")
+
+    # Convert images and labels into numpy arrays
+    return np.array(images), np.array(labels)
+
+
+# load_batch for manifest samples: labels come from the sample array, so there are
+# no per-sample exists() checks or filename parsing; only the images are read from disk.
+def load_manifest_batch(batch_samples, normalize_labels=True, y_min=1000.0, y_max=2000.0, cache=None, tag=None):
+    images = []
+    keep = []
+    for i, path in enumerate(batch_samples['path']):
+        if cache is not None:
+            image = cache.load(os.fsdecode(path), tag)
+        else:
+            image = load_sample_image(os.fsdecode(path))
+        if image is None:
+            print(f" [EXCEPTION ENCOUNTERED: Failed to load image; skipping sample {os.fsdecode(path)}.] ")
+            continue
+        images.append(image)
+        keep.append(i)
+
+    batch_samples = batch_samples[keep]
+    y_train = np.stack([batch_samples['steering'], batch_samples['throttle']], axis=1).astype(np.float64)
+    if normalize_labels:
+        y_train = min_max_norm(y_train, y_min, y_max)
+    return np.array(images), y_train
+
+
+class BatchLoader:
+    """
+    Replacement for batch_generator that decodes batches on a pool of worker threads and
+    keeps up to `prefetch` finished batches queued, so image decoding overlaps with training.
+    cv2.imread releases the GIL, so threads are enough to keep several cores decoding.
+
+    Batches come out in a fixed order whichever worker finishes first: the batch_generator
+    order, or with shuffle=True a new permutation of the batches every epoch drawn from `seed`
+    (the same seed gives the same sequence of epochs).
+
+    With a cache (ImageCache) decoded images are reused across epochs; its hit rate and
+    resident bytes for this loader (tagged `name`) are printed after every epoch.
+
+    Keras 3 model.fit only takes Python generators, so pass it wrapped in one (`yield from loader`,
+    see model_training.fit_data), and call close() when training ends or fails.
+    """
+
+    def __init__(self, samples, batch_size=13, workers=LOADER_WORKERS, prefetch=PREFETCH_BATCHES,
+                 shuffle=False, seed=None, normalize_labels=True, y_min=1000.0, y_max=2000.0,
+                 cache=None, name=None):
+        self.samples = samples
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.rng = np.random.default_rng(seed)
+        self.cache = cache
+        self.name = name
+        self.load_args = (normalize_labels, y_min, y_max, cache)
+        self.num_batches = (len(samples) + batch_size - 1) // batch_size
+        self.consumed = 0
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="batch_loader")
+        # futures of the batches submitted so far, oldest first; the bounded queue is the prefetch limit
+        self.pending = queue.Queue(maxsize=max(prefetch, 1))
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._submit, daemon=True)
+        self.thread.start()
+
+    def __len__(self):
+        return self.num_batches
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.num_batches == 0:
+            raise StopIteration
+        batch = self.pending.get().result()
+        self.consumed += 1
+        if self.cache is not None and self.consumed % self.num_batches == 0:
+            epoch = self.consumed // self.num_batches
+            self.cache.report((self.name, epoch), f"{self.name or 'samples'} epoch {epoch}")
+        return batch
+
+    def _epoch_order(self):
+        if self.shuffle:
+            return self.rng.permutation(self.num_batches)
+        return np.arange(self.num_batches)
+
+    def _submit(self):
+        epoch = 0
+        while not self.stopped.is_set() and self.num_batches:
+            epoch += 1
+            for batch in self._epoch_order():
+                offset = int(batch) * self.batch_size
+                batch_samples = self.samples[offset:offset + self.batch_size]
+                # cache lookups are counted per epoch: prefetching runs ahead into the next one
+                future = self.pool.submit(load_batch, batch_samples, *self.load_args, (self.name, epoch))
+                # blocks while `prefetch` batches are already waiting to be consumed
+                while not self.stopped.is_set():
                     try:
-                        throttle = int(throttle)
-                        steering = int(steering)
-                    except ValueError:
-                        print(f"Error parsing labels from filename: {batch_sample}")
-                        raise
+                        self.pending.put(future, timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+                if self.stopped.is_set():
+                    return
 
-                    # As we stream frames from the realsense camera, we opted to
-                    # configure that stream to give us B&W images.
-                    # If this is not the case, then change the line below!
-                    image = cv2.imread(batch_sample, cv2.IMREAD_GRAYSCALE)
-                    if image is None:
-                        print(f"Error loading image: {batch_sample}")
-                        raise ValueError("Failed to load image")
-                    images.append(image)
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        self.pool.shutdown(wait=True, cancel_futures=True)
 
-                    if normalize_labels:
-                        steering = min_max_norm(steering, y_min, y_max)
-                        throttle = min_max_norm(throttle, y_min, y_max)
 
-                    labels.append([steering, throttle])
+# Memory-maps the packed shards (see utilities/shard_io.py) of every run folder under a root folder.
+# Returns the list of (images, labels) shards and an (N, 2) array of [shard, row] sample references,
+# grouped into sequences of sequence_size frames that are shuffled like get_sample_series_list.
+def get_shard_samples(root_folder, sequence_size=13, shuffle_series=True,
+                      random_state=None, name="bw"):
 
-                except Exception as e:
-                    print(f" [EXCEPTION ENCOUNTERED: {e}; skipping sample {batch_sample}.] ")
+    shards = []
+    sequences = []
+    sub_folders = sorted([f.path for f in os.scandir(root_folder) if f.is_dir()])
 
-            # Convert images into numpy arrays
-            x_train = np.array(images)
+    for folder in sub_folders:
+        for image_path in shard_io.list_shards(folder, name):
+            images, labels = shard_io.open_shard(image_path)
+            shard_id = len(shards)
+            shards.append((images, labels))
 
-            # Convert labels to numpy arrays
-            y_train = np.array(labels)
+            rows = np.arange(len(labels))
+            for start in range(0, len(rows), sequence_size):
+                seq_rows = rows[start:start + sequence_size]
+                sequences.append(np.stack([np.full_like(seq_rows, shard_id), seq_rows], axis=1))
+
+    if len(sequences) == 0:
+        return shards, np.empty((0, 2), dtype=np.int64)
+
+    if shuffle_series:
+        # Shuffle the order of sequences so that they are not contiguous.
+        order = np.random.default_rng(random_state).permutation(len(sequences))
+        sequences = [sequences[i] for i in order]
+
+    return shards, np.concatenate(sequences)
+
+
+# Same batches as batch_generator, but sliced out of memory-mapped shards
+# (no per-file opens, filename parsing or png decodes).
+def shard_batch_generator(shards, samples, batch_size=13,
+                          normalize_labels=True,
+                          y_min=1000.0, y_max=2000.0):
+
+    num_samples = len(samples)
+    while True:
+        for offset in range(0, num_samples, batch_size):
+            batch_samples = samples[offset:offset + batch_size]
+            shard_ids = batch_samples[:, 0]
+            rows = batch_samples[:, 1]
+
+            first_images = shards[shard_ids[0]][0]
+            x_train = np.empty((len(batch_samples),) + first_images.shape[1:], dtype=first_images.dtype)
+            y_train = np.empty((len(batch_samples), 2), dtype=np.float64)
+
+            # one fancy-indexed read per shard touched by this batch
+            for shard_id in np.unique(shard_ids):
+                mask = shard_ids == shard_id
+                images, labels = shards[shard_id]
+                shard_rows = rows[mask]
+                x_train[mask] = images[shard_rows]
+                y_train[mask, 0] = labels['steering'][shard_rows]
+                y_train[mask, 1] = labels['throttle'][shard_rows]
+
+            if normalize_labels:
+                y_train = min_max_norm(y_train, y_min, y_max)
+
+            yield x_train, y_train
+
+
+class RunWindows:
+    """
+    Overlapping windows of `length` frames over one run, read straight from the run's shard
+    memory maps: consecutive windows start `stride` frames apart and take every `interval`-th
+    frame, so window i holds run frames i*stride + [0, interval, 2*interval, ...]. Windows
+    cross shard boundaries (never runs) and nothing is copied until a batch is read.
+
+    Behaves like an (N, length, H, W[, C]) image array: len(), shape, dtype and indexing with
+    ints or row arrays return the windows' pixels (bit-packed shards are unpacked).
+    """
+
+    def __init__(self, blocks, length=13, stride=1, interval=1, packed=False):
+        # blocks: the run's per-shard image arrays in order (the raw packed bytes for packed shards)
+        self.blocks = blocks
+        self.packed = packed
+        # run frame index of the first frame of every shard, plus the run length
+        self.bounds = np.cumsum([0] + [len(block) for block in blocks])
+        span = (length - 1) * interval + 1
+        self.starts = np.arange(0, max(int(self.bounds[-1]) - span + 1, 0), stride)
+        self.offsets = np.arange(length) * interval
+        frame_shape = blocks[0].shape[1:]
+        if packed:
+            frame_shape = frame_shape[:-1] + (frame_shape[-1] * 8,)
+        self.shape = (len(self.starts), length) + tuple(frame_shape)
+        self.dtype = np.dtype(np.uint8) if packed else blocks[0].dtype
+
+    def __len__(self):
+        return len(self.starts)
+
+    def last_frames(self):
+        # run frame index of the last frame of every window
+        return self.starts + self.offsets[-1]
+
+    def __getitem__(self, rows):
+        rows = np.asarray(rows)
+        frames = (self.starts[rows][..., None] + self.offsets).ravel()
+        block_ids = np.searchsorted(self.bounds, frames, side='right') - 1
+        out = np.empty((len(frames),) + self.blocks[0].shape[1:], dtype=self.blocks[0].dtype)
+        # one fancy-indexed read per shard the windows touch
+        for block_id in np.unique(block_ids):
+            mask = block_ids == block_id
+            out[mask] = self.blocks[block_id][frames[mask] - self.bounds[block_id]]
+        if self.packed:
+            out = shard_io.unpack_bits(out)
+        return out.reshape(rows.shape + self.shape[1:])
+
+
+# One run folder's windows (RunWindows over its shard memory maps) and the labels of their last
+# frames, or (None, None) for folders without shards; bit-packed shards stay packed until read.
+def load_run_windows(folder, name="bw", length=13, stride=1, interval=1):
+    shards = [shard_io.open_shard(path) for path in shard_io.list_shards(folder, name)]
+    if not shards:
+        return None, None
+    packed = shard_io.is_packed(name)
+    windows = RunWindows([images.packed if packed else images for images, _ in shards],
+                         length, stride, interval, packed)
+    # labels are small; one array per run
+    labels = np.concatenate([labels for _, labels in shards])
+    return windows, labels[windows.last_frames()]
+
+
+# Temporal windows for sequence-aware (e.g. frame-stacking) models, from the shards of every run
+# folder under a root folder. Windows never cross runs; each is labelled with its last frame.
+# Returns the per-run (windows, labels) list and an (N, 2) array of [run, window] sample
+# references, shuffled with random_state like get_shard_samples. Split them into training and
+# validation with split_window_samples, not split_samples: neighbouring windows share frames.
+def get_window_samples(root_folder, length=13, stride=1, interval=1, shuffle_series=True,
+                       random_state=None, name="bw"):
+
+    runs = []
+    samples = []
+    sub_folders = sorted([f.path for f in os.scandir(root_folder) if f.is_dir()])
+
+    for folder in sub_folders:
+        windows, window_labels = load_run_windows(folder, name, length, stride, interval)
+        if windows is None or len(windows) == 0:
+            continue
+        run_id = len(runs)
+        runs.append((windows, window_labels))
+        samples.append(np.stack([np.full(len(windows), run_id), np.arange(len(windows))], axis=1))
+
+    if len(samples) == 0:
+        return runs, np.empty((0, 2), dtype=np.int64)
+
+    samples = np.concatenate(samples)
+    if shuffle_series:
+        samples = samples[np.random.default_rng(random_state).permutation(len(samples))]
+    return runs, samples
+
+
+# Training / validation split of window samples without shared frames: within every run the
+# first `fraction` of its windows (in time order) train and the rest validate, and training
+# windows that overlap the first validation window are dropped. Both sets are then shuffled.
+def split_window_samples(runs, samples, fraction=0.8, shuffle_series=True, random_state=None):
+    train, val = [], []
+    for run_id in np.unique(samples[:, 0]):
+        rows = np.sort(samples[samples[:, 0] == run_id, 1])
+        cut = int(fraction * len(rows))
+        if cut < len(rows):
+            windows = runs[run_id][0]
+            first_val_frame = windows.starts[rows[cut]]
+            train_rows = rows[:cut][windows.last_frames()[rows[:cut]] < first_val_frame]
+        else:
+            train_rows = rows
+        train.append(np.stack([np.full(len(train_rows), run_id), train_rows], axis=1))
+        val.append(np.stack([np.full(len(rows) - cut, run_id), rows[cut:]], axis=1))
+
+    if not train:
+        return samples[:0], samples[:0]
+    train, val = np.concatenate(train), np.concatenate(val)
+    if shuffle_series:
+        rng = np.random.default_rng(random_state)
+        train, val = train[rng.permutation(len(train))], val[rng.permutation(len(val))]
+    return train, val
+
+
+# Shape of one window as the model sees it: (T, H, W[, C]), or (H, W, T) with channels_last
+# (frames stacked as channels, for 2D conv models)
+def get_window_shape(runs, channels_last=False):
+    shape = runs[0][0].shape[1:]
+    if channels_last:
+        shape = shape[1:] + (shape[0],)
+    return tuple(int(d) for d in shape)
+
+
+# Batches of (B, T, H, W) windows (or (B, H, W, T) with channels_last) and the labels of their
+# last frames. Window frames are read from the shard memory maps straight into the batch.
+def window_batch_generator(runs, samples, batch_size=13,
+                           normalize_labels=True,
+                           y_min=1000.0, y_max=2000.0, channels_last=False):
+
+    first_windows = runs[0][0]
+    shape = get_window_shape(runs)
+    num_samples = len(samples)
+    while True:
+        for offset in range(0, num_samples, batch_size):
+            batch_samples = samples[offset:offset + batch_size]
+            run_ids = batch_samples[:, 0]
+            rows = batch_samples[:, 1]
+
+            x_train = np.empty((len(batch_samples),) + shape, dtype=first_windows.dtype)
+            y_train = np.empty((len(batch_samples), 2), dtype=np.float64)
+
+            # one read per run touched by this batch
+            for run_id in np.unique(run_ids):
+                mask = run_ids == run_id
+                windows, labels = runs[run_id]
+                run_rows = rows[mask]
+                x_train[mask] = windows[run_rows]
+                y_train[mask, 0] = labels['steering'][run_rows]
+                y_train[mask, 1] = labels['throttle'][run_rows]
+
+            if normalize_labels:
+                y_train = min_max_norm(y_train, y_min, y_max)
+            if channels_last:
+                x_train = np.ascontiguousarray(np.moveaxis(x_train, 1, -1))
 
-            # Here we do not hold the values of X_train and y_train,
-            # instead we yield the values.
             yield x_train, y_train
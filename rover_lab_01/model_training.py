@@ -26,6 +26,19 @@ TRAINING_VER = 1  # Training version for naming
 NUM_EPOCHS = 50  # Number of epochs to train
 BATCH_SIZE = 13  # Batch size for training
 TRAIN_VAL_SPLIT = 0.8  # Train/validation split ratio
+USE_SHARDS = False  # Train from packed shards (rover_data_processor --format shards) instead of png files
+PACKED_BW = False  # With USE_SHARDS, read the 1 bit per pixel bw shards (rover_data_processor --format packed)
+WINDOW_LENGTH = 0  # With USE_SHARDS, frames stacked per sample for temporal models (0 = single frames)
+WINDOW_STRIDE = 1  # Frames between the starts of consecutive windows
+WINDOW_INTERVAL = 1  # Take every Nth frame within a window
+SAMPLE_PRODUCT = "bw"  # "bw", or "fused" for multi-channel samples (rover_data_processor --products fused)
+SAMPLE_FILES = {"bw": "*_BW.png", "fused": "*_fused.*"}  # png sample file pattern per product
+LOADER_WORKERS = 4  # Threads decoding png batches ahead of training (data_gen.BatchLoader)
+PREFETCH_BATCHES = 8  # Decoded batches kept ready for model.fit
+SHUFFLE_SEED = None  # Set to an int to shuffle the training batches every epoch, reproducibly
+CACHE_MB = 2048  # Memory for decoded png samples reused across epochs (0 = decode every epoch)
+CACHE_POLICY = "keep"  # "keep" or "lru", see data_gen.ImageCache
+PIN_VALIDATION = True  # Decode the validation set into the cache up front and never evict it
 
 
 # Define the CNN model structure
@@ -60,12 +73,29 @@ def define_model(input_shape=(80, 160, 1)):
 
     return model
 
+# Keras 3 model.fit accepts Python generators but not other iterators such as data_gen.BatchLoader
+def fit_data(batches):
+    yield from batches
+
 # Train the model with data from a generator, using checkpoints and a specified device
 def train_model(amt_data=1.0):
     
     # Load samples (i.e. preprocessed frames for training).
     # Note that we are using sequences consisting of 13 frames.
-    samples = data_gen.get_sequence_samples(DATA_PATH, sequence_size=13)
+    if USE_SHARDS and WINDOW_LENGTH > 0:
+        # (H, W, WINDOW_LENGTH) samples: consecutive frames stacked as channels, never across runs
+        shard_name = SAMPLE_PRODUCT + "_bits" if PACKED_BW else SAMPLE_PRODUCT
+        runs, samples = data_gen.get_window_samples(DATA_PATH, length=WINDOW_LENGTH, stride=WINDOW_STRIDE,
+                                                    interval=WINDOW_INTERVAL, name=shard_name)
+        input_shape = data_gen.get_window_shape(runs, channels_last=True)
+    elif USE_SHARDS:
+        shard_name = SAMPLE_PRODUCT + "_bits" if PACKED_BW else SAMPLE_PRODUCT
+        shards, samples = data_gen.get_shard_samples(DATA_PATH, sequence_size=13, name=shard_name)
+        input_shape = data_gen.get_input_shape(shards=shards)
+    else:
+        samples = data_gen.get_sequence_samples(DATA_PATH, sequence_size=13,
+                                                ends_with=SAMPLE_FILES[SAMPLE_PRODUCT])
+        input_shape = data_gen.get_input_shape(samples=samples)
     
     # You may wish to do simple testing using only 
     # a fraction of your training data...
@@ -77,43 +107,69 @@ def train_model(amt_data=1.0):
     # Now, split our samples into training and validation sets
     # Note that train_samples will contain a flat list of sequenced 
     # image file paths.
-    train_samples, val_samples = data_gen.split_samples(samples, fraction=TRAIN_VAL_SPLIT)
+    if USE_SHARDS and WINDOW_LENGTH > 0:
+        # per run in time order, so overlapping windows never end up on both sides
+        train_samples, val_samples = data_gen.split_window_samples(runs, samples, fraction=TRAIN_VAL_SPLIT)
+    else:
+        train_samples, val_samples = data_gen.split_samples(samples, fraction=TRAIN_VAL_SPLIT)
 
     train_steps = int(len(train_samples) / BATCH_SIZE)
     val_steps = int(len(val_samples) / BATCH_SIZE)
 
     # Create data generators that will supply both the training and validation data during training.
-    train_gen = data_gen.batch_generator(train_samples, batch_size=BATCH_SIZE)
-    val_gen = data_gen.batch_generator(val_samples, batch_size=BATCH_SIZE)
+    if USE_SHARDS and WINDOW_LENGTH > 0:
+        train_gen = data_gen.window_batch_generator(runs, train_samples, batch_size=BATCH_SIZE, channels_last=True)
+        val_gen = data_gen.window_batch_generator(runs, val_samples, batch_size=BATCH_SIZE, channels_last=True)
+    elif USE_SHARDS:
+        train_gen = data_gen.shard_batch_generator(shards, train_samples, batch_size=BATCH_SIZE)
+        val_gen = data_gen.shard_batch_generator(shards, val_samples, batch_size=BATCH_SIZE)
+    else:
+        cache = None
+        if CACHE_MB > 0:
+            cache = data_gen.ImageCache(max_bytes=CACHE_MB * 1024 * 1024, policy=CACHE_POLICY)
+            if PIN_VALIDATION:
+                cache.pin([data_gen.sample_path(sample) for sample in val_samples], workers=LOADER_WORKERS)
+        train_gen = data_gen.BatchLoader(train_samples, batch_size=BATCH_SIZE, workers=LOADER_WORKERS,
+                                         prefetch=PREFETCH_BATCHES, shuffle=SHUFFLE_SEED is not None,
+                                         seed=SHUFFLE_SEED, cache=cache, name="train")
+        val_gen = data_gen.BatchLoader(val_samples, batch_size=BATCH_SIZE, workers=LOADER_WORKERS,
+                                       prefetch=PREFETCH_BATCHES, cache=cache, name="val")
     
-    with tf.device(DEVICE):
+    try:
+        with tf.device(DEVICE):
 
-        # Note that your input shape must match your preprocessed image size
-        model = define_model(input_shape=(160, 320, 1))
-        model.summary()  # Print a summary of the model architecture
+            # Input shape (height, width, channels) comes from the preprocessed samples themselves
+            print(f"Input shape: {input_shape}")
+            model = define_model(input_shape=input_shape)
+            model.summary()  # Print a summary of the model architecture
         
-        # Path for saving the best model checkpoints
-        filePath = "models/rover_model_" + f"{MODEL_NUM:02d}_ver{TRAINING_VER:02d}" + "_epoch{epoch:04d}_val_loss{val_loss:.4f}.h5"
+            # Path for saving the best model checkpoints
+            filePath = "models/rover_model_" + f"{MODEL_NUM:02d}_ver{TRAINING_VER:02d}" + "_epoch{epoch:04d}_val_loss{val_loss:.4f}.h5"
         
-        # Save only the best (i.e. min validation loss) epochs
-        checkpoint_best = ModelCheckpoint(filePath, monitor="val_loss", 
-                                          verbose=1, save_best_only=True, 
-                                          mode="min")
+            # Save only the best (i.e. min validation loss) epochs
+            checkpoint_best = ModelCheckpoint(filePath, monitor="val_loss", 
+                                              verbose=1, save_best_only=True, 
+                                              mode="min")
         
-        # Train your model here.
-        #print("Made it here 1")
-        print(train_gen)
-        history = model.fit(
-            train_gen,
-            validation_data=val_gen,
-            epochs=NUM_EPOCHS,
-            verbose=1,
-            steps_per_epoch=train_steps,
-            validation_steps=val_steps,
-            callbacks=[checkpoint_best]
-        )
-
-        print(history.history.keys())
+            # Train your model here.
+            #print("Made it here 1")
+            print(train_gen)
+            history = model.fit(
+                fit_data(train_gen),
+                validation_data=fit_data(val_gen),
+                epochs=NUM_EPOCHS,
+                verbose=1,
+                steps_per_epoch=train_steps,
+                validation_steps=val_steps,
+                callbacks=[checkpoint_best]
+            )
+
+            print(history.history.keys())
+    finally:
+        if not USE_SHARDS:
+            # stop the decode threads, also when fit raises
+            train_gen.close()
+            val_gen.close()
     return history
 
 
@@ -32,10 +32,17 @@ crop_W, crop_B, crop_T = 160, 120, 40  # Crop from top third down
 def load_telem_file(path):
     """
     Loads telemetry data from a CSV file to associate video frames with sensor data like throttle and steering.
+    Returns a dictionary keyed by integer frame number: {frame: (throttle, steering, heading)}.
     """
+    frm_lookup = {}
     with open(path, "r") as f:
-        dict_reader = csv.DictReader(f)
-        return list(dict_reader)
+        for row in csv.DictReader(f):
+            try:
+                frm_num = int(row["index"])
+            except (TypeError, ValueError):
+                continue  # Skip partial rows
+            frm_lookup.setdefault(frm_num, (row["throttle"], row["steering"], row["heading"]))
+    return frm_lookup
 
 def process_bag_file(source_file, dest_folder=None, skip_if_exists=True):
     """
@@ -71,16 +78,16 @@ def process_bag_file(source_file, dest_folder=None, skip_if_exists=True):
         while playback.current_status() == rs.playback_status.playing:
             try:
                 frames = pipeline.wait_for_frames(timeout_ms=5000)
+
+                # Skip if no telemetry data for frame (before aligning or copying pixels)
+                frm_num = frames.get_color_frame().frame_number
+                telem = frm_lookup.get(int(frm_num))
+                if telem is None: continue
+
+                # Extract throttle, steering, and heading data
+                throttle, steering, heading = telem
                 aligned_frames = alignedFs.process(frames)
                 color_frame = aligned_frames.get_color_frame()
-                
-                # Skip if no telemetry data for frame
-                frm_num = color_frame.frame_number
-                result = [entry for entry in frm_lookup if entry["index"] == str(frm_num)]
-                if not result: continue
-                
-                # Extract throttle, steering, and heading data
-                throttle, steering, heading = result[0]["throttle"], result[0]["steering"], result[0]["heading"]
                 color_frame = np.asanyarray(color_frame.get_data())
 
                 # Image processing
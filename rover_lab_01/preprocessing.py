@@ -0,0 +1,186 @@
+"""
+preprocessing.py
+
+Shared frame preprocessing (resize -> gray -> white threshold -> crop) used by the bag
+processor and the driver, so the model is trained and driven on the same image. The recorder
+does no preprocessing; it only saves the raw bag and telemetry.
+
+FramePreprocessor allocates its intermediate buffers once and reuses them on every call,
+thresholds with a 256-entry lookup table instead of inRange, and, when the resize is an
+integer downscale, crops the source frame before resizing so the rows above crop_T are
+never resized, converted or thresholded. The results are identical to the original chain;
+run this file to benchmark it against that chain.
+
+bw_batch() takes a whole stack of frames, (N, 480, 640, 3) or a list of frames, and returns
+the (N, H, W) BW crops as one new array: each frame is resized straight into a stacked buffer
+and the gray conversion and threshold then run once over the whole stack.
+
+NOTE: images returned by bw()/full() are views into the preprocessor's buffers and are
+overwritten by the next call. Copy them if they need to outlive the next frame (or use one
+preprocessor per thread). bw_batch() always returns a fresh array.
+"""
+
+import argparse
+import time
+import numpy as np
+import cv2
+
+# Camera frame size
+SOURCE_W, SOURCE_H = 640, 480
+
+# Default image processing parameters
+# Define the range of white values to be considered for binary conversion
+WHITE_L, WHITE_H = 220, 255
+# Resize dimensions
+RESIZE_W, RESIZE_H = 320, 240
+# Crop: origin is top left, so crop_T is the top row we keep and crop_B the bottom (full height)
+CROP_W, CROP_B, CROP_T = RESIZE_W, RESIZE_H, RESIZE_H // 3
+
+
+def reference_bw(color_frame, resize_W=RESIZE_W, resize_H=RESIZE_H, white_L=WHITE_L, white_H=WHITE_H,
+                 crop_T=CROP_T, crop_B=CROP_B, crop_W=CROP_W):
+    # the original copy-pasted chain; kept as the reference the kernel is checked against
+    color_frame = cv2.resize(color_frame, (resize_W, resize_H))
+    gray_frame = cv2.cvtColor(color_frame, cv2.COLOR_BGR2GRAY)
+    BW_frame = cv2.inRange(gray_frame, white_L, white_H)
+    return BW_frame[crop_T:crop_B, 0:crop_W]
+
+
+class FramePreprocessor:
+
+    def __init__(self, resize_W=RESIZE_W, resize_H=RESIZE_H, white_L=WHITE_L, white_H=WHITE_H,
+                 crop_T=CROP_T, crop_B=CROP_B, crop_W=CROP_W, source_W=SOURCE_W, source_H=SOURCE_H):
+        self.resize_W, self.resize_H = resize_W, resize_H
+        self.white_L, self.white_H = white_L, white_H
+        self.crop_T, self.crop_B, self.crop_W = crop_T, crop_B, crop_W
+        self.source_W, self.source_H = source_W, source_H
+
+        # threshold lookup table: 255 inside [white_L, white_H], 0 elsewhere (same as cv2.inRange)
+        self.lut = np.zeros(256, dtype=np.uint8)
+        self.lut[white_L:white_H + 1] = 255
+
+        # full-frame buffers (color, gray and threshold at the resized size)
+        self.color_buf = np.empty((resize_H, resize_W, 3), dtype=np.uint8)
+        self.gray_buf = np.empty((resize_H, resize_W), dtype=np.uint8)
+        self.bw_buf = np.empty((resize_H, resize_W), dtype=np.uint8)
+
+        # cropped-first buffers: only the rows/columns that survive the crop
+        crop_H = crop_B - crop_T
+        self.crop_color_buf = np.empty((crop_H, crop_W, 3), dtype=np.uint8)
+        self.crop_gray_buf = np.empty((crop_H, crop_W), dtype=np.uint8)
+        self.crop_bw_buf = np.empty((crop_H, crop_W), dtype=np.uint8)
+
+        self.crop_first = self._crop_first_is_exact()
+
+    def _crop_first_is_exact(self):
+        # Cropping before the resize only gives the same pixels when every resized row/column is
+        # built from whole source blocks (integer downscale); confirm it on a test frame.
+        if self.source_W % self.resize_W != 0 or self.source_H % self.resize_H != 0:
+            return False
+        self.scale_x = self.source_W // self.resize_W
+        self.scale_y = self.source_H // self.resize_H
+
+        test_frame = np.random.default_rng(0).integers(0, 256, (self.source_H, self.source_W, 3), dtype=np.uint8)
+        expected = cv2.resize(test_frame, (self.resize_W, self.resize_H))[self.crop_T:self.crop_B, 0:self.crop_W]
+        cropped = cv2.resize(self._source_crop(test_frame), (self.crop_W, self.crop_B - self.crop_T))
+        return bool(np.array_equal(expected, cropped))
+
+    def _source_crop(self, color_frame):
+        return color_frame[self.crop_T * self.scale_y:self.crop_B * self.scale_y, 0:self.crop_W * self.scale_x]
+
+    def bw(self, color_frame):
+        """Cropped black and white image from a full-size bgr frame (the model input)."""
+        if self.crop_first:
+            cv2.resize(self._source_crop(color_frame), (self.crop_W, self.crop_B - self.crop_T),
+                       dst=self.crop_color_buf)
+            cv2.cvtColor(self.crop_color_buf, cv2.COLOR_BGR2GRAY, dst=self.crop_gray_buf)
+            cv2.LUT(self.crop_gray_buf, self.lut, dst=self.crop_bw_buf)
+            return self.crop_bw_buf
+
+        return self.full(color_frame)['bw']
+
+    def full(self, color_frame):
+        """Resized color, full gray and cropped black and white images from a full-size bgr frame."""
+        cv2.resize(color_frame, (self.resize_W, self.resize_H), dst=self.color_buf)
+        cv2.cvtColor(self.color_buf, cv2.COLOR_BGR2GRAY, dst=self.gray_buf)
+        cv2.LUT(self.gray_buf, self.lut, dst=self.bw_buf)
+        return {'color': self.color_buf, 'gray': self.gray_buf,
+                'bw': self.bw_buf[self.crop_T:self.crop_B, 0:self.crop_W]}
+
+    def bw_batch(self, color_frames):
+        """Cropped black and white images, shape (N, H, W), from a stack or list of full-size bgr frames."""
+        n = len(color_frames)
+        if n == 0:
+            return np.empty((0, self.crop_B - self.crop_T, self.crop_W), dtype=np.uint8)
+
+        if self.crop_first:
+            # resize only the rows/columns that survive the crop, straight into the stack
+            colors = np.empty((n, self.crop_B - self.crop_T, self.crop_W, 3), dtype=np.uint8)
+            for i in range(n):
+                cv2.resize(self._source_crop(color_frames[i]), (self.crop_W, self.crop_B - self.crop_T),
+                           dst=colors[i])
+        else:
+            colors = np.empty((n, self.resize_H, self.resize_W, 3), dtype=np.uint8)
+            for i in range(n):
+                cv2.resize(color_frames[i], (self.resize_W, self.resize_H), dst=colors[i])
+            colors = colors[:, self.crop_T:self.crop_B, 0:self.crop_W]
+
+        # one gray conversion and one threshold over the whole stack (as a single tall image)
+        crop_H, crop_W = colors.shape[1], colors.shape[2]
+        tall = np.ascontiguousarray(colors).reshape(n * crop_H, crop_W, 3)
+        gray = cv2.cvtColor(tall, cv2.COLOR_BGR2GRAY)
+        return cv2.LUT(gray, self.lut).reshape(n, crop_H, crop_W)
+
+
+def benchmark(num_frames=512, batch_size=32, **params):
+    # time the original chain against the shared kernel (per frame and batched) on the same
+    # frames and check all three agree
+    rng = np.random.default_rng(1)
+    frames = rng.integers(0, 256, (batch_size, SOURCE_H, SOURCE_W, 3), dtype=np.uint8)
+    preprocessor = FramePreprocessor(**params)
+
+    expected = np.stack([reference_bw(frame, **params) for frame in frames])
+    for i, frame in enumerate(frames):
+        if not np.array_equal(expected[i], preprocessor.bw(frame)):
+            raise AssertionError("kernel output differs from the reference chain")
+    if not np.array_equal(expected, preprocessor.bw_batch(frames)):
+        raise AssertionError("batched kernel output differs from the reference chain")
+    if not np.array_equal(expected[:3], preprocessor.bw_batch(list(frames[:3]))):
+        raise AssertionError("batched kernel output differs for a list of frames")
+
+    start = time.perf_counter()
+    for i in range(num_frames):
+        reference_bw(frames[i % len(frames)], **params)
+    reference_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(num_frames):
+        preprocessor.bw(frames[i % len(frames)])
+    kernel_time = time.perf_counter() - start
+
+    num_batches = max(num_frames // batch_size, 1)
+    start = time.perf_counter()
+    for i in range(num_batches):
+        preprocessor.bw_batch(frames)
+    batch_time = (time.perf_counter() - start) / (num_batches * batch_size) * num_frames
+
+    print(f"crop before resize: {preprocessor.crop_first}")
+    print(f"reference chain: {reference_time / num_frames * 1000:.3f} ms/frame")
+    print(f"shared kernel:   {kernel_time / num_frames * 1000:.3f} ms/frame "
+          f"({reference_time / kernel_time:.2f}x)")
+    print(f"batched kernel:  {batch_time / num_frames * 1000:.3f} ms/frame "
+          f"({reference_time / batch_time:.2f}x, batches of {batch_size})")
+    return reference_time, kernel_time, batch_time
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the shared preprocessing kernel.")
+    parser.add_argument("-n", "--frames", type=int, default=512, help="Number of frames to time.")
+    parser.add_argument("-b", "--batch", type=int, default=32, help="Frames per batch for the batched kernel.")
+    parser.add_argument("--small", action="store_true", help="Use the 160x120 / threshold 200 settings.")
+    args = parser.parse_args()
+
+    if args.small:
+        benchmark(args.frames, args.batch, resize_W=160, resize_H=120, white_L=200, crop_T=40, crop_B=120, crop_W=160)
+    else:
+        benchmark(args.frames, args.batch)
@@ -0,0 +1,179 @@
+"""
+rethreshold_dataset.py
+
+Regenerate the black and white training images of an already converted dataset from its
+color images (runs converted with the "color" product), e.g. to try a different white
+threshold without replaying the bag files.
+
+png runs:   every *_c.png gets a matching *_BW.png (or *_<suffix>.png)
+shard runs: every color_NNNNN.npy shard gets a matching bw_NNNNN.npy (or <suffix>_NNNNN.npy);
+            runs converted with --format packed get bit-packed bw_bits_NNNNN.npy shards instead
+
+Color pngs that cannot be read are skipped and listed. When the BW/bw images are replaced
+(no --suffix), the run's manifest.json is updated to the new threshold, so a later resume
+or re-conversion of the run compares against the threshold its images now have.
+
+Frames are read, thresholded and written in batches; the threshold itself is one batched
+call per batch (preprocessing.FramePreprocessor.bw_batch), so the same crop and threshold
+as the bag converter are applied.
+"""
+
+import argparse
+import glob
+import json
+import os
+import threading
+import time
+import cv2
+import numpy as np
+from preprocessing import FramePreprocessor, WHITE_L, WHITE_H, RESIZE_W, RESIZE_H, CROP_T, CROP_B, CROP_W
+from utilities.stage_pipeline import StagePipeline
+from utilities.shard_io import list_shards, open_shard, shard_paths, packed_name, pack_bits, save_atomic
+
+DATA_PATH = '/media/usafa/data/rover_data_processed'
+#color frames thresholded per call
+BATCH_SIZE = 64
+#threads decoding color pngs and encoding BW pngs
+READ_WORKERS = 2
+WRITE_WORKERS = 4
+
+
+def rethreshold_pngs(run_folder, preprocessor, suffix="BW", batch_size=BATCH_SIZE,
+                     read_workers=READ_WORKERS, write_workers=WRITE_WORKERS):
+    # *_c.png -> *_<suffix>.png for one run folder; returns the number of images written, the
+    # color files that could not be read and the number of batches that failed in a stage
+    color_files = sorted(glob.glob(os.path.join(run_folder, "*_c.png")))
+    batches = [color_files[i:i + batch_size] for i in range(0, len(color_files), batch_size)]
+    lock = threading.Lock()
+    written = [0]
+    unreadable = []
+
+    def read_stage(files):
+        read_files, frames = [], []
+        for f in files:
+            frame = cv2.imread(f)
+            if frame is None:
+                unreadable.append(f)
+            else:
+                read_files.append(f)
+                frames.append(frame)
+        return read_files, frames
+
+    def threshold_stage(item):
+        files, frames = item
+        return files, preprocessor.bw_batch(frames)
+
+    def write_stage(item):
+        files, BW_frames = item
+        for color_file, BW_frame in zip(files, BW_frames):
+            BW_file = color_file[:-len("c.png")] + suffix + ".png"
+            if not cv2.imwrite(BW_file, BW_frame):
+                raise OSError(f"could not write {BW_file}")
+            with lock:
+                written[0] += 1
+
+    stages = StagePipeline([("read", read_stage, read_workers),
+                            ("threshold", threshold_stage, 1),
+                            ("write", write_stage, write_workers)], queue_size=2)
+    stats = stages.run(batches)
+    # StagePipeline only counts the exceptions of its stages
+    return written[0], unreadable, sum(s['errors'] for s in stats.values())
+
+
+def rethreshold_shards(run_folder, preprocessor, suffix="bw", batch_size=BATCH_SIZE, packed=False):
+    # color_NNNNN.npy -> <suffix>_NNNNN.npy (labels copied) for one run folder,
+    # or <suffix>_bits_NNNNN.npy bit-packed shards when packed
+    name = packed_name(suffix) if packed else suffix
+    written = 0
+    for idx, color_path in enumerate(list_shards(run_folder, "color")):
+        colors, labels = open_shard(color_path)
+        BW_frames = np.concatenate([preprocessor.bw_batch(colors[i:i + batch_size])
+                                    for i in range(0, len(colors), batch_size)])
+        image_path, label_path = shard_paths(run_folder, name, idx)
+        save_atomic(image_path, pack_bits(BW_frames) if packed else BW_frames)
+        save_atomic(label_path, labels)
+        written += len(BW_frames)
+    return written
+
+
+def load_run_params(run_folder):
+    # conversion params from <run>/manifest.json, or None for runs without one
+    try:
+        with open(os.path.join(run_folder, "manifest.json"), 'r') as f:
+            return json.load(f).get('params')
+    except (OSError, ValueError):
+        return None
+
+
+def update_manifest_threshold(run_folder, white_L, white_H):
+    # record the new threshold in <run>/manifest.json so a resume or re-conversion of the run
+    # does not treat its BW images as made with the old one
+    path = os.path.join(run_folder, "manifest.json")
+    try:
+        with open(path, 'r') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return
+    params = manifest.get('params')
+    if not params or (params.get('white_L'), params.get('white_H')) == (white_L, white_H):
+        return
+    params['white_L'], params['white_H'] = white_L, white_H
+    manifest['updated'] = time.strftime("%Y%m%d-%H%M%S")
+    # write then rename so a crash never leaves a half-written manifest
+    with open(path + ".tmp", 'w') as f:
+        json.dump(manifest, f)
+    os.replace(path + ".tmp", path)
+
+
+def main(data_path=DATA_PATH, white_L=WHITE_L, white_H=WHITE_H, suffix=None, batch_size=BATCH_SIZE):
+    # color images were saved at the resized size, so the kernel only thresholds and crops them
+    preprocessor = FramePreprocessor(resize_W=RESIZE_W, resize_H=RESIZE_H, white_L=white_L, white_H=white_H,
+                                     crop_T=CROP_T, crop_B=CROP_B, crop_W=CROP_W,
+                                     source_W=RESIZE_W, source_H=RESIZE_H)
+    start = time.time()
+    total = 0
+    unreadable = []
+    failed_runs = 0
+    for run_folder in sorted(f.path for f in os.scandir(data_path) if f.is_dir()):
+        errors = 0
+        if list_shards(run_folder, "color"):
+            params = load_run_params(run_folder) or {}
+            packed = params.get('format') == "packed" or bool(list_shards(run_folder, packed_name("bw")))
+            count = rethreshold_shards(run_folder, preprocessor, suffix or "bw", batch_size, packed)
+        else:
+            count, skipped, errors = rethreshold_pngs(run_folder, preprocessor, suffix or "BW", batch_size)
+            unreadable.extend(skipped)
+            if errors:
+                # some BW pngs still have the old threshold, so the manifest must keep it too
+                print(f"{os.path.basename(run_folder)}: {errors} batches failed; manifest threshold left unchanged.")
+                failed_runs += 1
+        if count:
+            print(f"{os.path.basename(run_folder)}: {count} images")
+            if suffix is None and not errors:
+                update_manifest_threshold(run_folder, white_L, white_H)
+        total += count
+
+    if failed_runs:
+        print(f"{failed_runs} runs had failed writes; run again to finish them.")
+    if unreadable:
+        print(f"Skipped {len(unreadable)} color images that could not be read:")
+        for path in unreadable:
+            print(f"  {path}")
+
+    elapsed = time.time() - start
+    rate = total / elapsed if elapsed > 0 else 0.0
+    print(f"Re-thresholded {total} images at [{white_L}, {white_H}] in {elapsed:.1f}s ({rate:.1f} images/sec)")
+    return total
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Regenerate BW images from a converted dataset's color images.")
+    parser.add_argument("-s", "--source", type=str, default=DATA_PATH, help="Folder of converted runs.")
+    parser.add_argument("-l", "--white-l", type=int, default=WHITE_L, help="Lowest gray value counted as white.")
+    parser.add_argument("-u", "--white-h", type=int, default=WHITE_H, help="Highest gray value counted as white.")
+    parser.add_argument("--suffix", type=str, default=None,
+                        help="Write <suffix> images instead of replacing BW/bw (e.g. BW200 to compare thresholds).")
+    parser.add_argument("-b", "--batch", type=int, default=BATCH_SIZE, help="Frames thresholded per call.")
+    args = parser.parse_args()
+
+    main(data_path=args.source, white_L=args.white_l, white_H=args.white_h, suffix=args.suffix, batch_size=args.batch)
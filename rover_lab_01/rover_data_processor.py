@@ -1,16 +1,84 @@
 # Documentation is in rover_recorder.py
 
-import pyrealsense2.pyrealsense2 as rs
 import numpy as np
 import cv2
 import time
 import csv
 import os
-from imutils.video import FPS
+import json
+import argparse
+import multiprocessing
+import threading
+import glob
+import itertools
+from utilities.stage_pipeline import StagePipeline
+from utilities.shard_io import ShardWriter, SHARD_SIZE, list_shards, packed_name
+from utilities.stage_timer import StageTimers, report_on_signal
+from preprocessing import FramePreprocessor
+import utilities.telemetry as tl
+
+# the camera SDK is only needed to play bags back; the frame transforms and telemetry loaders
+# (and conversion_benchmark, which uses them on synthetic data) work without it
+try:
+    import pyrealsense2.pyrealsense2 as rs
+    import utilities.rs_playback as rsp
+    from imutils.video import FPS
+except ImportError as e:
+    rs = rsp = FPS = None
+    _sdk_error = e
 
 #set source and destination paths
 SOURCE_PATH = '/media/usafa/data/rover_data'
 DEST_PATH = '/media/usafa/data/rover_data_processed'
+#play bags back in real time (30 fps, drops frames when we fall behind) or as fast as possible
+REAL_TIME_PLAYBACK = False
+#number of bag files converted at once (each in its own process with its own pipeline)
+NUM_WORKERS = os.cpu_count() or 1
+#print progress every this many converted frames
+PROGRESS_INTERVAL = 300
+#decode, transform and png encode/write frames in parallel stages within each bag
+PIPELINED = True
+TRANSFORM_WORKERS = 2
+WRITER_WORKERS = 4
+#batches allowed to wait between stages before the stage in front has to wait
+QUEUE_SIZE = 2
+#frames handed to a transform worker at once in pipelined mode; bw-only conversions
+#threshold the whole batch in one call (preprocessing.FramePreprocessor.bw_batch)
+BATCH_SIZE = 16
+#show the preview windows every Nth converted frame (0 = headless, no GUI calls at all)
+PREVIEW_EVERY = 0
+#add every Nth converted frame to a contact sheet image in <run>/preview (0 = off)
+CONTACT_SHEET_EVERY = 0
+#save the run manifest (frames converted so far) every this many converted frames
+MANIFEST_SAVE_EVERY = 300
+#contact sheet layout (thumbnails per row and rows per sheet)
+SHEET_COLS = 4
+SHEET_ROWS = 4
+#products written for each frame; training (data_gen, ends_with="*_BW.png") only reads "bw".
+#choose from PRODUCT_SUFFIXES; intermediate images are only computed when a selected product needs them
+OUTPUT_PRODUCTS = ("bw",)
+PRODUCT_SUFFIXES = {'color': 'c', 'bw': 'BW', 'edge': 'edge', 'gray': 'gray', 'depth': 'd', 'fused': 'fused'}
+#channels stacked into the "fused" product: one (crop H, crop W, C) uint8 array per frame holding the
+#aligned, cropped BW, gray and depth images (written as a png for 1, 3 or 4 channels, otherwise as .npy)
+FUSED_CHANNELS = ("bw", "gray", "depth")
+#depth (mm) mapped to 255 in the fused depth channel; farther depths are clipped
+FUSED_DEPTH_MAX = 4000
+#run edge detection on the cropped region of interest (crop_T:crop_B) instead of the full frame
+EDGE_ON_ROI = False
+#write one png per frame and product ("png") or pack each product into fixed-size shards ("shards");
+#"packed" is "shards" with the bw product bit-packed, 1 bit per pixel (bw_bits_00000.npy, see shard_io)
+OUTPUT_FORMAT = "png"
+#match frames to telemetry by nearest host timestamp ("time") or by exact frame number ("frame");
+#logs recorded before the timestamp column existed always use the frame number
+TELEMETRY_JOIN = "time"
+#largest time gap (seconds) allowed between a frame and its telemetry row
+JOIN_TOLERANCE = tl.DEFAULT_TOLERANCE
+#interpolate throttle and steering between the telemetry rows around each frame (time join only)
+INTERPOLATE_TELEMETRY = False
+#record per-frame latency histograms for each conversion stage; the p50/p95/p99 report is printed
+#and saved to <run>/latency.json at the end of each file, and printed on demand with kill -USR1 <pid>
+LATENCY_STATS = False
+LATENCY_STAGES = ("wait", "align", "lookup", "transform", "encode", "write")
 #define the range of white you want
 white_L = 220
 white_H = 255
@@ -24,25 +92,506 @@ crop_W = int(resize_W)
 crop_B = resize_H
 crop_T = int(resize_H/3)
 
+# per-thread preprocessing kernels (see get_preprocessor)
+_thread_state = threading.local()
+
+# latency timers of the bag being converted (disabled unless LATENCY_STATS / --latency)
+_no_timers = StageTimers(LATENCY_STAGES, enabled=False)
+_current_timers = None
+
 
 def load_telem_file(path):
     # Create lookup for frame index (ID)
-    #this is a list of dictionaries
+    # this is a dictionary keyed by integer frame number so each frame
+    # can be matched in constant time: {frame: (throttle, steering, heading)}
+    frm_lookup = {}
     with open(path, 'r') as f:
         # Load data from the data file (comma delimited)
         dict_reader = csv.DictReader(f)
-        # hold it in a structure for quick lookup
-        list_of_dict = list(dict_reader)
+        for row in dict_reader:
+            try:
+                frm_num = int(row['index'])
+            except (TypeError, ValueError):
+                # skip partial rows (e.g. recording stopped mid-write)
+                continue
+            # keep the first row recorded for a frame, like the old filter did
+            if frm_num not in frm_lookup:
+                frm_lookup[frm_num] = (row['throttle'], row['steering'], row['heading'])
+
+    return frm_lookup
+
+
+def frames_to_ranges(frames):
+    # [1, 2, 3, 7, 8] -> [[1, 3], [7, 8]]; converted frames are mostly contiguous
+    ranges = []
+    for frm in sorted(frames):
+        if ranges and frm == ranges[-1][1] + 1:
+            ranges[-1][1] = frm
+        else:
+            ranges.append([frm, frm])
+    return ranges
+
+
+def ranges_to_frames(ranges):
+    frames = set()
+    for start, end in ranges:
+        frames.update(range(start, end + 1))
+    return frames
+
+
+class RunManifest:
+    # <run>/manifest.json records which frames were converted (per product) and with which
+    # preprocessing parameters, so an interrupted conversion can resume just the missing frames.
+    def __init__(self, dest_path, params):
+        self.path = os.path.join(dest_path, "manifest.json")
+        self.params = params
+        self.exists = os.path.exists(self.path)
+        self.complete = False
+        self.frames = {product: set() for product in params['products']}
+        self.params_match = False
+        self.lock = threading.Lock()
+        self.unsaved = 0
+
+        if self.exists:
+            with open(self.path, 'r') as f:
+                saved = json.load(f)
+            self.params_match = saved.get('params') == params
+            if self.params_match:
+                self.complete = saved.get('complete', False)
+                for product, ranges in saved.get('frames', {}).items():
+                    self.frames[product] = ranges_to_frames(ranges)
+
+    def done_frames(self):
+        # a frame is done once every selected product has been written for it
+        return set.intersection(*self.frames.values()) if self.frames else set()
+
+    def reset(self):
+        self.complete = False
+        self.frames = {product: set() for product in self.params['products']}
+        self.params_match = True
+
+    def mark(self, frames, products=None):
+        with self.lock:
+            for product in products or self.frames.keys():
+                self.frames[product].update(int(f) for f in frames)
+            self.unsaved += len(frames)
+            if self.unsaved >= MANIFEST_SAVE_EVERY:
+                self._save()
+
+    def save(self, complete=None):
+        with self.lock:
+            if complete is not None:
+                self.complete = complete
+            self._save()
+
+    def _save(self):
+        manifest = {'params': self.params,
+                    'complete': self.complete,
+                    'updated': time.strftime("%Y%m%d-%H%M%S"),
+                    'frames': {product: frames_to_ranges(frames) for product, frames in self.frames.items()}}
+        # write then rename so a crash never leaves a half-written manifest
+        with open(self.path + ".tmp", 'w') as f:
+            json.dump(manifest, f)
+        os.replace(self.path + ".tmp", self.path)
+        self.unsaved = 0
+
+
+def read_frame_times(bag_file):
+    # (frame numbers, timestamps) of the bag's color frames, or None if the bag cannot be indexed
+    # (e.g. it was never closed properly or is truncated); callers fall back to the frame-number join
+    try:
+        return tl.bag_frame_times(bag_file)
+    except Exception as e:
+        print(f"{os.path.basename(bag_file)}: WARNING cannot read frame timestamps from the bag ({e}); "
+              f"matching frames by frame number.")
+        return None
+
+
+def load_time_joined_telem(bag_file, frame_times, telem, tolerance=JOIN_TOLERANCE,
+                           interpolate=INTERPOLATE_TELEMETRY):
+    # frame -> telemetry lookup built by matching every color frame's timestamp in the bag
+    # (frame_times from read_frame_times) to the nearest telemetry row, in one vectorized pass
+    frames, frame_times = frame_times
+    frm_lookup, offsets = tl.frame_lookup(frames, frame_times, telem, tolerance, interpolate)
+
+    file_name = os.path.basename(bag_file)
+    if len(offsets) > 0:
+        print(f"{file_name}: {len(frm_lookup)} of {len(frames)} frames joined to telemetry by time "
+              f"(median offset {np.median(np.abs(offsets)) * 1000:.1f} ms)")
+    if len(frm_lookup) < len(frames) // 2:
+        # usually the camera was not stamping frames in host time
+        print(f"{file_name}: WARNING only {len(frm_lookup)} of {len(frames)} frames are within "
+              f"{tolerance * 1000:.0f} ms of a telemetry row; check the camera/host clocks.")
+    return frm_lookup
+
+
+def conversion_params(products, edge_roi, output_format, telemetry_join=None):
+    # everything that changes the pixels, labels or layout of the converted output
+    # (telemetry_join is only recorded for time joins, so frame-number runs keep their manifests)
+    params = {'white_L': white_L, 'white_H': white_H,
+              'resize_W': resize_W, 'resize_H': resize_H,
+              'crop_T': crop_T, 'crop_B': crop_B, 'crop_W': crop_W,
+              'products': sorted(products), 'edge_roi': edge_roi, 'format': output_format}
+    if 'fused' in products:
+        params['fused'] = {'channels': list(FUSED_CHANNELS), 'depth_max': FUSED_DEPTH_MAX}
+    if telemetry_join is not None:
+        params['telemetry_join'] = telemetry_join
+    return params
+
+
+def clear_run_outputs(dest_path):
+    # remove converted frames and shards before redoing a run with new parameters
+    for suffix in PRODUCT_SUFFIXES.values():
+        for path in glob.glob(os.path.join(dest_path, f"*_{suffix}.png")) + \
+                glob.glob(os.path.join(dest_path, f"*_{suffix}.npy")):
+            os.remove(path)
+    for product in PRODUCT_SUFFIXES:
+        for name in (product, packed_name(product)):
+            for path in glob.glob(os.path.join(dest_path, f"{name}_[0-9]*.npy")):
+                os.remove(path)
+
+
+def trim_unrecorded_shards(dest_path, name, done):
+    # drop the shards (from the first one onwards) holding frames the manifest does not list as done:
+    # they were flushed before a crash but never recorded, and would be written again on resume
+    paths = list_shards(dest_path, name)
+    for idx, image_path in enumerate(paths):
+        try:
+            frames = np.load(image_path.replace(".npy", "_labels.npy"))['frame'].tolist()
+        except OSError:
+            # crashed between writing the images and the labels
+            frames = None
+        if frames is None or not done.issuperset(frames):
+            for path in paths[idx:]:
+                for shard_file in (path, path.replace(".npy", "_labels.npy")):
+                    if os.path.exists(shard_file):
+                        os.remove(shard_file)
+            print(f"{os.path.basename(dest_path)}: removed {len(paths) - idx} unrecorded {name} shards.")
+            return
+
+
+class ShardFlushTracker:
+    # Every product gets its own ShardWriter, and each flushes on its own. A frame is only recorded
+    # in the manifest once every product has either flushed the shard holding it or skipped it, and
+    # the manifest is saved straight away, so a crash between two products' flushes never claims a
+    # frame one of them did not write. A frame some product wrote is recorded even if another skipped
+    # it (otherwise resuming would trim its shard); one every product skipped is left to be retried.
+    def __init__(self, manifest, products):
+        self.manifest = manifest
+        self.flushed = {product: set() for product in products}
+        self.skipped = {product: set() for product in products}
+        self.lock = threading.Lock()
+
+    def on_flush(self, product, frames):
+        self._settle(product, frames, self.flushed)
+
+    def on_skip(self, product, frames):
+        self._settle(product, frames, self.skipped)
+
+    def _settle(self, product, frames, into):
+        with self.lock:
+            into[product].update(frames)
+            settled = set.intersection(*(self.flushed[p] | self.skipped[p] for p in self.flushed))
+            ready = settled & set.union(*self.flushed.values())
+            for p in self.flushed:
+                self.flushed[p] -= settled
+                self.skipped[p] -= settled
+        if ready:
+            self.manifest.mark(sorted(ready))
+            self.manifest.save()
+
+
+class ContactSheet:
+    # Tiles sampled color/BW thumbnails into a grid and writes one png per full sheet,
+    # so thresholds can be spot-checked after a headless conversion.
+    def __init__(self, folder, cols=SHEET_COLS, rows=SHEET_ROWS):
+        self.folder = folder
+        self.cols = cols
+        self.rows = rows
+        self.tiles = []
+        self.sheet_num = 0
+
+    def add(self, frm_num, images):
+        # stack half-size thumbnails of whichever 8-bit products were computed for this frame
+        thumbs = []
+        thumb_w = resize_W // 2
+        for product in ('color', 'gray', 'bw', 'edge'):
+            image = images.get(product)
+            if image is None:
+                continue
+            thumb = cv2.resize(image, (thumb_w, max(image.shape[0] * thumb_w // image.shape[1], 1)))
+            if thumb.ndim == 2:
+                thumb = cv2.cvtColor(thumb, cv2.COLOR_GRAY2BGR)
+            thumbs.append(thumb)
+        if not thumbs:
+            return
+        tile = np.vstack(thumbs)
+        cv2.putText(img=tile, text=f"{frm_num}", org=(4, 14), fontFace=cv2.FONT_HERSHEY_SIMPLEX,
+                    fontScale=0.4, color=(0, 255, 0))
+        self.tiles.append(tile)
+        if len(self.tiles) == self.cols * self.rows:
+            self.flush()
+
+    def flush(self):
+        if len(self.tiles) == 0:
+            return
+        blank = np.zeros_like(self.tiles[0])
+        tiles = self.tiles + [blank] * (self.cols * self.rows - len(self.tiles))
+        rows = [np.hstack(tiles[r * self.cols:(r + 1) * self.cols]) for r in range(self.rows)]
+        os.makedirs(self.folder, exist_ok=True)
+        cv2.imwrite(os.path.join(self.folder, f"contact_{self.sheet_num:05d}.png"), np.vstack(rows))
+        self.sheet_num += 1
+        self.tiles = []
+
+
+def show_preview(images):
+    # show the output frames for sanity check; returns True if the `q` key was pressed
+    for window_name, image in images.items():
+        if image.ndim == 3 and image.shape[2] not in (3, 4):
+            # fused images with other channel counts can't be shown directly
+            continue
+        cv2.imshow(window_name, image)
+    key = cv2.waitKey(1) & 0xFF
+    return key == ord("q")
+
+
+def get_preprocessor():
+    # one shared preprocessing kernel per thread (its buffers are reused on every call),
+    # rebuilt if the module parameters above are changed
+    params = (resize_W, resize_H, white_L, white_H, crop_T, crop_B, crop_W)
+    if getattr(_thread_state, 'params', None) != params:
+        _thread_state.preprocessor = FramePreprocessor(resize_W=resize_W, resize_H=resize_H,
+                                                       white_L=white_L, white_H=white_H,
+                                                       crop_T=crop_T, crop_B=crop_B, crop_W=crop_W)
+        _thread_state.params = params
+    return _thread_state.preprocessor
+
+
+def needs_depth(products):
+    # whether the depth stream has to be read for these products
+    return 'depth' in products or ('fused' in products and 'depth' in FUSED_CHANNELS)
+
+
+def needs_full(products):
+    # whether the full resized color/gray images are needed (not just the cropped BW image)
+    return ('color' in products or 'gray' in products or 'edge' in products
+            or ('fused' in products and 'gray' in FUSED_CHANNELS))
+
+
+def resize_depth(depth):
+    # 16-bit depth aligned to color; nearest neighbour so no depths are invented
+    return cv2.resize(depth, (resize_W, resize_H), interpolation=cv2.INTER_NEAREST)
 
-        return list_of_dict
 
+def fuse_channels(BW_frame, gray_frame, depth_frame):
+    # stack the cropped channels listed in FUSED_CHANNELS into one contiguous (H, W, C) uint8 array
+    fused = np.empty((crop_B - crop_T, crop_W, len(FUSED_CHANNELS)), dtype=np.uint8)
+    for c, channel in enumerate(FUSED_CHANNELS):
+        if channel == 'bw':
+            fused[:, :, c] = BW_frame
+        elif channel == 'gray':
+            fused[:, :, c] = gray_frame[crop_T:crop_B, 0:crop_W]
+        elif depth_frame is None:
+            fused[:, :, c] = 0
+        else:
+            depth = np.minimum(depth_frame[crop_T:crop_B, 0:crop_W], FUSED_DEPTH_MAX).astype(np.uint32)
+            fused[:, :, c] = depth * 255 // FUSED_DEPTH_MAX
+    return fused
+
+
+def transform_frame(raw, products=OUTPUT_PRODUCTS, edge_roi=EDGE_ON_ROI, copy=False):
+    # resize, threshold, crop and edge-detect one 640x480 bgr frame,
+    # building only the intermediates the selected products need.
+    # color/gray/bw are views into this thread's preprocessing buffers unless copy=True
+    images = {}
+    preprocessor = get_preprocessor()
+    depth_frame = None
+    if needs_depth(products) and raw.get('depth') is not None:
+        depth_frame = resize_depth(raw['depth'])
+        if 'depth' in products:
+            images['depth'] = depth_frame
+
+    if needs_full(products):
+        # resize frame and convert to gray/BW for easier line detection
+        full = preprocessor.full(raw['color'])
+        for product in ('color', 'gray', 'bw'):
+            if product in products:
+                images[product] = full[product].copy() if copy else full[product]
+
+        if 'edge' in products:
+            # Edge detection attempt (optionally on the cropped region only)
+            gray_frame = full['gray']
+            if edge_roi:
+                gray_frame = gray_frame[crop_T:crop_B, 0:crop_W]
+            blurred = cv2.GaussianBlur(gray_frame,(5,5), 0)
+            images['edge'] = cv2.Canny(blurred,100,175)
+
+        if 'fused' in products:
+            images['fused'] = fuse_channels(full['bw'], full['gray'], depth_frame)
+    elif 'bw' in products or 'fused' in products:
+        # only the cropped BW image is needed; the kernel crops before resizing when it can
+        BW_frame = preprocessor.bw(raw['color'])
+        if 'bw' in products:
+            images['bw'] = BW_frame.copy() if copy else BW_frame
+        if 'fused' in products:
+            images['fused'] = fuse_channels(BW_frame, None, depth_frame)
+
+    return images
+
+
+def transform_batch(raws, products=OUTPUT_PRODUCTS, edge_roi=EDGE_ON_ROI):
+    # transform a list of raw frames; returns one images dict per frame, none of them sharing
+    # the per-thread buffers. bw (and depth) only conversions use the batched kernel.
+    if needs_full(products) or 'fused' in products:
+        return [transform_frame(raw, products, edge_roi, copy=True) for raw in raws]
+
+    batch = [{} for _ in raws]
+    if 'bw' in products:
+        BW_frames = get_preprocessor().bw_batch([raw['color'] for raw in raws])
+        for images, BW_frame in zip(batch, BW_frames):
+            images['bw'] = BW_frame
+    if 'depth' in products:
+        for images, raw in zip(batch, raws):
+            if raw.get('depth') is not None:
+                images['depth'] = resize_depth(raw['depth'])
+    return batch
+
+
+def batched(items, size):
+    # group an iterable into lists of up to size items
+    iterator = iter(items)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def write_frame(dest_path, frm_num, telem, images, timers=_no_timers):
+    throttle, steering, heading = telem
+
+    #save every product computed for this frame, e.g. 000000123_1500_1600_90_BW.png
+    #(encoded first, then written, so the two can be timed separately; same bytes as cv2.imwrite)
+    t0 = timers.stamp()
+    encoded = []
+    for product, image in images.items():
+        frm_name = f"{'{:09d}'.format(frm_num)}_{throttle}_{steering}_{heading}_{PRODUCT_SUFFIXES[product]}"
+        if image.ndim == 3 and image.shape[2] not in (3, 4):
+            # png only holds 1, 3 or 4 channels; other fused layouts are stored as .npy
+            encoded.append((frm_name + ".npy", image))
+            continue
+        ok, data = cv2.imencode(".png", image)
+        if ok:
+            encoded.append((frm_name + ".png", data))
+    t0 = timers.record('encode', t0)
+    for frm_name, data in encoded:
+        if frm_name.endswith(".npy"):
+            np.save(os.path.join(dest_path, frm_name), data)
+        else:
+            data.tofile(os.path.join(dest_path, frm_name))
+    timers.record('write', t0)
+
+
+def add_to_shards(shard_writers, frm_num, telem, images, seq=None):
+    # hand one frame's images to the product writers; if any add fails, the writers it did not
+    # reach skip seq, so none of them is left waiting for this frame
+    missing = [product for product in shard_writers if product not in images]
+    if missing:
+        # e.g. no depth frame for this color frame: drop it from every product, so row i of
+        # every product's shards is still the same frame
+        for shard_writer in shard_writers.values():
+            shard_writer.skip(seq, frm_num)
+        raise ValueError(f"frame {frm_num} has no {', '.join(missing)} image; not written to any product")
+    reached = set()
+    try:
+        for product, image in images.items():
+            shard_writers[product].add(image, frm_num, *telem, seq=seq)
+            reached.add(product)
+    except Exception:
+        for product, shard_writer in shard_writers.items():
+            if product not in reached:
+                shard_writer.skip(seq, frm_num)
+        raise
+
+
+def read_matched_frames(pipeline, playback, frm_lookup, stats, copy=False, depth=False, timers=_no_timers,
+                        matched=None):
+    # yields (frame number, telemetry, {'color': 640x480 bgr array, 'depth': aligned z16 array or None})
+    # for every frame with telemetry, and adds its number to the `matched` set if one is given;
+    # copy=True detaches the pixels from librealsense so the frame can be handed to another thread
+    align_to = rs.stream.color
+    alignedFs = rs.align(align_to)
+
+    #loop until all frames are done (iter_frames stops at the end of the file)
+    t0 = timers.stamp()
+    for frames in rsp.iter_frames(pipeline, playback, stats):
+        # time spent waiting for the next frame (this generator is paused while its frames are consumed)
+        t0 = timers.record('wait', t0)
+        try:
+            # Get related throttle and steering for frame
+            frm_num = frames.get_color_frame().frame_number
+            #check if there is data recorded for the given frame
+            telem = frm_lookup.get(int(frm_num))
+            t0 = timers.record('lookup', t0)
+            #if no data is available restart loop before aligning or copying pixels
+            if telem is None:
+                continue
+            stats['matched'] += 1
+            if matched is not None:
+                matched.add(int(frm_num))
+
+            # align rgb to depth pixels
+            aligned_frames = alignedFs.process(frames)
+
+            raw = {'color': aligned_frames.get_color_frame(), 'depth': None}
+            if depth:
+                raw['depth'] = aligned_frames.get_depth_frame()
+            for name, frame in raw.items():
+                if frame is None:
+                    continue
+                if copy:
+                    raw[name] = np.array(frame.get_data())
+                else:
+                    raw[name] = np.asanyarray(frame.get_data())
+            t0 = timers.record('align', t0)
+        except Exception as e:
+            print(e)
+            t0 = timers.stamp()
+            continue
+
+        yield frm_num, telem, raw
+        t0 = timers.stamp()
+
+
+def require_sdk():
+    if rs is None:
+        raise ImportError(f"converting bag files needs pyrealsense2 and imutils ({_sdk_error})")
 
-def process_bag_file(source_file, dest_folder=None, skip_if_exists=True):
+
+def process_bag_file(source_file, dest_folder=None, skip_if_exists=True, real_time=REAL_TIME_PLAYBACK,
+                     preview_every=PREVIEW_EVERY, contact_sheet_every=CONTACT_SHEET_EVERY,
+                     pipelined=PIPELINED, transform_workers=TRANSFORM_WORKERS, writer_workers=WRITER_WORKERS,
+                     output_format=OUTPUT_FORMAT, shard_size=SHARD_SIZE,
+                     products=OUTPUT_PRODUCTS, edge_roi=EDGE_ON_ROI, telemetry_join=TELEMETRY_JOIN,
+                     join_tolerance=JOIN_TOLERANCE, interpolate=INTERPOLATE_TELEMETRY, latency=LATENCY_STATS):
+    global _current_timers
+    require_sdk()
     fps = None
     pipeline = None
+    playback = None
+    sheet = None
+    shard_writers = None
+    manifest = None
+    finished = False
+    matched_frames = set()
+    stats = rsp.new_stats()
+    stats.update({'file': source_file, 'elapsed': 0.0, 'fps': 0.0, 'skipped': False, 'error': None,
+                  'resumed': 0})
+    timers = StageTimers(LATENCY_STAGES, enabled=latency)
+    _current_timers = timers
+    dest_path = None
 
     try:
-        i = 0
         print(f"Processing {source_file}...")
         # path to file should look something like this: /media/usafa/drone_data/20210122-120614.bag
         path = source_file
@@ -54,117 +603,103 @@ def process_bag_file(source_file, dest_folder=None, skip_if_exists=True):
         else:
             dest_path = os.path.join(dest_folder, file_name)
 
+        # Load data associated with the video.
+        telem_file = path.replace(".bag", ".csv")
+        telem = None
+        join = None
+        frame_times = None
+        if telemetry_join == "time":
+            telem = tl.load_telemetry(telem_file)
+            if tl.has_timestamps(telem):
+                # read before the manifest is opened: a bag we cannot index is converted (and recorded)
+                # as a frame-number join
+                frame_times = read_frame_times(path)
+                if frame_times is not None:
+                    join = {'tolerance': join_tolerance, 'interpolate': interpolate}
+            else:
+                print(f"{file_name}: telemetry has no timestamps; matching frames by frame number.")
+
+        manifest = RunManifest(dest_path, conversion_params(products, edge_roi, output_format, join))
+
         #skip over previously processed files
         if skip_if_exists:
-            if os.path.isdir(dest_path):
+            if manifest.complete:
                 print(f"{file_name} was previously processed; skipping file...")
-                return
+                stats['skipped'] = True
+                return stats
+            if os.path.isdir(dest_path) and not manifest.exists:
+                # converted before manifests existed; we can't tell what is missing
+                print(f"{file_name} was previously processed (no manifest); skipping file...")
+                stats['skipped'] = True
+                return stats
+
+        if not skip_if_exists or (manifest.exists and not manifest.params_match):
+            # parameters changed (or --redo): start the run over
+            if manifest.exists:
+                print(f"{file_name}: redoing all frames.")
+            clear_run_outputs(dest_path)
+            manifest.reset()
 
         # Make subfolder to hold all training data
         os.makedirs(dest_path, exist_ok=True)
+        # write the manifest straight away so a crash before the first save can still be resumed
+        manifest.save()
+        if contact_sheet_every > 0:
+            sheet = ContactSheet(os.path.join(dest_path, "preview"))
+        if output_format in ("shards", "packed"):
+            # one set of shards per product (bw_00000.npy, color_00000.npy, ...),
+            # continuing after any shards kept from an interrupted conversion
+            shard_names = {product: packed_name(product) if output_format == "packed" and product == "bw"
+                           else product for product in products}
+            done = manifest.done_frames()
+            for name in shard_names.values():
+                trim_unrecorded_shards(dest_path, name, done)
+            flush_tracker = ShardFlushTracker(manifest, products)
+            shard_writers = {product: ShardWriter(dest_path, name=shard_names[product], shard_size=shard_size,
+                                                  start_shard=len(list_shards(dest_path, shard_names[product])),
+                                                  on_flush=lambda frames, p=product: flush_tracker.on_flush(p, frames),
+                                                  on_skip=lambda frames, p=product: flush_tracker.on_skip(p, frames))
+                             for product in products}
+
+        if join is not None:
+            frm_lookup = load_time_joined_telem(path, frame_times, telem, join_tolerance, interpolate)
+        else:
+            frm_lookup = load_telem_file(telem_file)
 
-        # Load data associated with the video.
-        frm_lookup = load_telem_file(path.replace(".bag", ".csv"))
+        # resume: frames already converted with these parameters are skipped like frames without telemetry
+        done = manifest.done_frames()
+        if done:
+            stats['resumed'] = len(done)
+            print(f"{file_name}: resuming; {len(done)} frames already converted.")
+            frm_lookup = {frm: telem for frm, telem in frm_lookup.items() if frm not in done}
 
     #set up stream from bag
-        config = rs.config()
+        # with real_time off every frame is delivered in order, as fast as we can process it
+        streams = [(rs.stream.color, 640, 480, rs.format.bgr8, 30)]
+        if needs_depth(products):
+            streams.append((rs.stream.depth, 640, 480, rs.format.z16, 30))
+        pipeline, playback = rsp.open_bag(path, streams, real_time=real_time)
 
-        rs.config.enable_device_from_file(config, path, False)
-        pipeline = rs.pipeline()
+        if pipelined and preview_every > 0:
+            # preview windows must be driven from this thread, one frame at a time
+            print("Preview windows need sequential conversion; pipelining disabled.")
+            pipelined = False
 
-        config.enable_stream(rs.stream.color, 640, 480, rs.format.bgr8, 30)
-        pipeline.start(config)
-        time.sleep(1)
-
-        # Pause here to allow pipeline to start
-        # before turning off real-time streaming.
-        profile = pipeline.get_active_profile()
-
-        playback = profile.get_device().as_playback()
-        playback.set_real_time(True)
-
-        align_to = rs.stream.color
-        alignedFs = rs.align(align_to)
         fps = FPS().start()
-        #loop until all frames are done
-        while playback.current_status() == rs.playback_status.playing:
-            try:
-                frames = pipeline.wait_for_frames(timeout_ms=5000)
-                if not frames:
-                    print("no frames")
-                    continue
-
-                # align rgb to depth pixels
-                aligned_frames = alignedFs.process(frames)
-
-                color_frame = aligned_frames.get_color_frame()
-
-                # Get related throttle and steering for frame
-                frm_num = color_frame.frame_number
-                #check if there is data recorded for the given frame
-                result = list(filter(lambda entry: entry['index'] == str(frm_num), frm_lookup))
-                #if no data is available restart loop
-                if len(result) == 0:
-                    continue
-                #extract the data corresponding to the current frame
-                throttle = result[0]['throttle']
-                steering = result[0]['steering']
-                heading = result[0]['heading']
-
-                color_frame = np.asanyarray(color_frame.get_data())
-
-                # resize frame
-                color_frame = cv2.resize(color_frame, (resize_W, resize_H))
-
-                #convert to BW image for easier line detection
-                gray_frame = cv2.cvtColor(color_frame, cv2.COLOR_BGR2GRAY)
-                BW_frame = cv2.inRange(gray_frame, white_L, white_H)
-
-                # Crop Bw image
-                BW_frame = BW_frame[crop_T:crop_B, 0:crop_W]
-
-                # Edge detection attempt
-                blurred = cv2.GaussianBlur(gray_frame,(5,5), 0)
-                edges = cv2.Canny(blurred,100,175)
-                #print("Below is the image size \n")
-                #print(BW_frame.shape)
-                i += 1
-
-                # show the output frame for sanity check
-                cv2.imshow("gray", gray_frame)
-                cv2.imshow("Black and white", BW_frame)
-                cv2.imshow("Color Processed", color_frame)
-                cv2.imshow("Edge Detection", edges)
-
-
-                # rgb
-                c_frm_name = f"{'{:09d}'.format(frm_num)}_{throttle}_{steering}_{heading}_c.png"
-
-                # BW
-                bw_frm_name = f"{'{:09d}'.format(frm_num)}_{throttle}_{steering}_{heading}_BW.png"
-
-                # Edge Detection
-                edge_frm_name = f"{'{:09d}'.format(frm_num)}_{throttle}_{steering}_{heading}_edge.png"
-
-                #save both images
-                cv2.imwrite(os.path.join(dest_path, c_frm_name), color_frame)
-                cv2.imwrite(os.path.join(dest_path, bw_frm_name), BW_frame)
-                cv2.imwrite(os.path.join(dest_path, edge_frm_name), edges)
-
-                #keep track of fps
-                fps.update()
-
-                key = cv2.waitKey(1) & 0xFF
-
-                # if the `q` key was pressed, break from the loop
-                if key == ord("q"):
-                    break
-            except Exception as e:
-                print("I am here one")
-                print(e)
-                continue
+        if pipelined:
+            finished = convert_pipelined(pipeline, playback, frm_lookup, stats, dest_path, fps, sheet,
+                                         contact_sheet_every, transform_workers, writer_workers, shard_writers,
+                                         products, edge_roi, manifest, timers, matched_frames)
+        else:
+            finished = convert_sequential(pipeline, playback, frm_lookup, stats, dest_path, fps, sheet,
+                                          contact_sheet_every, preview_every, shard_writers, products, edge_roi,
+                                          manifest, timers, matched_frames)
+    except KeyboardInterrupt:
+        # CTRL-C stops a headless conversion cleanly
+        print(f"{source_file}: interrupted.")
     except Exception as e:
         print(e)
+        stats['error'] = str(e)
     finally:
         pass
 #checks to end loop
@@ -173,35 +708,268 @@ def process_bag_file(source_file, dest_folder=None, skip_if_exists=True):
         # stop recording
         if fps is not None:
             fps.stop()
-        time.sleep(0.5)
-        if playback is not None:
-            if playback.current_status() == rs.playback_status.playing:
-                playback.pause()
-                if pipeline is not None:
-                    pipeline.stop()
-                    time.sleep(0.5)
+        if sheet is not None:
+            sheet.flush()
+        if shard_writers is not None:
+            for shard_writer in shard_writers.values():
+                shard_writer.close()
+        rsp.close_bag(pipeline, playback)
+        if manifest is not None and not stats['skipped']:
+            # only a run that reached the end of the bag without errors, with every matched frame
+            # recorded, is complete; anything else resumes next time
+            missing = len(matched_frames - manifest.done_frames())
+            if finished and missing:
+                print(f"{file_name}: {missing} matched frames were not converted; the run will resume next time.")
+            manifest.save(complete=finished and stats['error'] is None and missing == 0)
     except Exception as e:
-        print("Unexpected error during cleanup.", exc_info=True)
+        print(f"Unexpected error during cleanup: {e}")
 
 #finishing messages
     print(f"Finished processing frames for {source_file}.")
+    rsp.print_stats(os.path.basename(source_file), stats)
     if fps is not None:
         print("Elapsed time: {:.2f}".format(fps.elapsed()))
         print("[INFO] approx. FPS: {:.2f}".format(fps.fps()))
+        stats['elapsed'] = fps.elapsed()
+        stats['fps'] = fps.fps()
+    if timers.enabled and not stats['skipped']:
+        timers.print_report(os.path.basename(source_file))
+        stats['latency'] = timers.summary()
+        if dest_path is not None and os.path.isdir(dest_path):
+            timers.save(os.path.join(dest_path, "latency.json"))
+    _current_timers = None
+    return stats
+
+
+def convert_sequential(pipeline, playback, frm_lookup, stats, dest_path, fps, sheet,
+                       contact_sheet_every, preview_every, shard_writers=None,
+                       products=OUTPUT_PRODUCTS, edge_roi=EDGE_ON_ROI, manifest=None, timers=_no_timers,
+                       matched=None):
+    # decode, transform and write each frame in turn on this thread;
+    # returns False if stopped early with the `q` key or if any frame failed
+    file_name = os.path.basename(dest_path)
+    i = 0
+    errors = 0
+    for frm_num, telem, raw in read_matched_frames(pipeline, playback, frm_lookup, stats,
+                                                   depth=needs_depth(products), timers=timers, matched=matched):
+        try:
+            t0 = timers.stamp()
+            images = transform_frame(raw, products, edge_roi)
+            t0 = timers.record('transform', t0)
+            if shard_writers is not None:
+                add_to_shards(shard_writers, frm_num, telem, images)
+                timers.record('write', t0)
+            else:
+                write_frame(dest_path, frm_num, telem, images, timers)
+                if manifest is not None:
+                    manifest.mark([frm_num])
+            i += 1
+
+            #keep track of fps
+            fps.update()
+            if i % PROGRESS_INTERVAL == 0:
+                print(f"{file_name}: {i} frames converted ({stats['read']} read)")
+
+            # sampled preview only; headless runs make no GUI calls
+            if sheet is not None and i % contact_sheet_every == 0:
+                sheet.add(frm_num, images)
+            if preview_every > 0 and i % preview_every == 0:
+                # if the `q` key was pressed, break from the loop
+                if show_preview(images):
+                    return False
+        except Exception as e:
+            print("I am here one")
+            print(e)
+            errors += 1
+            continue
+    if errors:
+        print(f"{file_name}: {errors} frames failed to convert.")
+    return errors == 0
+
+
+def convert_pipelined(pipeline, playback, frm_lookup, stats, dest_path, fps, sheet,
+                      contact_sheet_every, transform_workers, writer_workers, shard_writers=None,
+                      products=OUTPUT_PRODUCTS, edge_roi=EDGE_ON_ROI, manifest=None, timers=_no_timers,
+                      matched=None):
+    # reader (this thread) -> transform workers -> png encoder/writer workers,
+    # joined by bounded queues; frames travel in batches of BATCH_SIZE.
+    # output files are identical to convert_sequential; returns False if any frame or stage failed
+    file_name = os.path.basename(dest_path)
+    lock = threading.Lock()
+    written = [0]
+    frame_errors = [0]
+
+    def transform_stage(batch):
+        try:
+            t0 = timers.stamp()
+            batch_images = transform_batch([raw for seq, (frm_num, telem, raw) in batch], products, edge_roi)
+            timers.record('transform', t0, len(batch))
+        except Exception:
+            if shard_writers is not None:
+                # don't leave later frames waiting on these
+                for seq, (frm_num, telem, raw) in batch:
+                    for shard_writer in shard_writers.values():
+                        shard_writer.skip(seq, frm_num)
+            raise
+        return [(seq, frm_num, telem, images)
+                for (seq, (frm_num, telem, raw)), images in zip(batch, batch_images)]
+
+    def write_stage(batch):
+        for seq, frm_num, telem, images in batch:
+            # one failed frame must not cost the rest of the batch (or leave a gap in the shard sequence)
+            try:
+                if shard_writers is not None:
+                    # seq keeps shard rows in recorded order even though transforms finish out of order
+                    t0 = timers.stamp()
+                    add_to_shards(shard_writers, frm_num, telem, images, seq)
+                    timers.record('write', t0)
+                else:
+                    write_frame(dest_path, frm_num, telem, images, timers)
+                    if manifest is not None:
+                        manifest.mark([frm_num])
+            except Exception as e:
+                print(f"{file_name}: frame {frm_num}: {e}")
+                with lock:
+                    frame_errors[0] += 1
+                continue
+            with lock:
+                written[0] += 1
+                i = written[0]
+                fps.update()
+                if i % PROGRESS_INTERVAL == 0:
+                    print(f"{file_name}: {i} frames converted ({stats['read']} read)")
+                if sheet is not None and i % contact_sheet_every == 0:
+                    sheet.add(frm_num, images)
 
+    stages = StagePipeline([("transform", transform_stage, transform_workers),
+                            ("write", write_stage, writer_workers)], queue_size=QUEUE_SIZE)
+    try:
+        frames = read_matched_frames(pipeline, playback, frm_lookup, stats, copy=True, depth=needs_depth(products),
+                                     timers=timers, matched=matched)
+        stages.run(batched(enumerate(frames), BATCH_SIZE))
+    finally:
+        stages.print_report(file_name)
+    # StagePipeline only counts the exceptions of its stages
+    errors = frame_errors[0] + sum(s['errors'] for s in stages.stats.values())
+    if errors:
+        print(f"{file_name}: {errors} frames or batches failed to convert.")
+    return errors == 0
+
+
+def convert_worker(job):
+    # runs in its own process, so each bag gets its own librealsense pipeline
+    # job is (bag file, keyword arguments for process_bag_file)
+    source_file, options = job
+    if options.get('latency', LATENCY_STATS):
+        report_on_signal(lambda: _current_timers, os.path.basename(source_file))
+        print(f"{os.path.basename(source_file)}: latency report on demand with kill -USR1 {os.getpid()}")
+    try:
+        return process_bag_file(source_file, **options)
+    except Exception as e:
+        stats = rsp.new_stats()
+        stats.update({'file': source_file, 'elapsed': 0.0, 'fps': 0.0, 'skipped': False, 'error': str(e)})
+        return stats
+
+
+def write_summary(results, dest_folder, elapsed):
+    #print and save per-file throughput and failures for the whole batch
+    failures = [r for r in results if r['error'] is not None]
+    summary = {'finished': time.strftime("%Y%m%d-%H%M%S"),
+               'elapsed': elapsed,
+               'files': len(results),
+               'failures': len(failures),
+               'frames_converted': sum(r['matched'] for r in results),
+               'results': sorted(results, key=lambda r: r['file'])}
+
+    print(f"Converted {len(results)} bag files in {elapsed:.1f}s ({len(failures)} failed).")
+    for r in summary['results']:
+        if r['error'] is not None:
+            status = f"FAILED: {r['error']}"
+        elif r['skipped']:
+            status = "skipped"
+        else:
+            status = f"{r['matched']} frames, {r['fps']:.1f} frames/sec"
+        print(f"  {os.path.basename(r['file'])}: {status}")
+
+    summary_file = os.path.join(dest_folder, time.strftime("conversion_summary_%Y%m%d-%H%M%S.json"))
+    with open(summary_file, 'w') as f:
+        json.dump(summary, f, indent=2)
+    print(f"Summary written to {summary_file}")
+    return summary
+
+
+def main(source_path=SOURCE_PATH, dest_path=DEST_PATH, workers=NUM_WORKERS, **options):
+    # options are passed through to process_bag_file (skip_if_exists, preview_every, products, ...)
+    require_sdk()
+    if workers > 1 and options.get('preview_every', PREVIEW_EVERY) > 0:
+        # preview windows from several processes at once are not useful; use contact sheets instead
+        print("Preview windows are disabled when converting with more than one worker.")
+        options['preview_every'] = 0
+    options['dest_folder'] = dest_path
 
-def main():
     #loop through bag files in the given directory
-    for filename in os.listdir(SOURCE_PATH):
+    jobs = []
+    for filename in sorted(os.listdir(source_path)):
         if filename.endswith(".bag"):
-            source_file = os.path.join(SOURCE_PATH, filename)
-            process_bag_file(source_file)
+            source_file = os.path.join(source_path, filename)
+            jobs.append((source_file, options))
         else:
             continue
 
+    os.makedirs(dest_path, exist_ok=True)
+    start = time.time()
+    results = []
+    if workers <= 1:
+        for job in jobs:
+            results.append(convert_worker(job))
+    else:
+        # spawn fresh processes (one bag each) rather than forking librealsense state
+        ctx = multiprocessing.get_context("spawn")
+        with ctx.Pool(processes=min(workers, max(len(jobs), 1)), maxtasksperchild=1) as pool:
+            for stats in pool.imap_unordered(convert_worker, jobs):
+                results.append(stats)
+                print(f"[{len(results)}/{len(jobs)}] done: {os.path.basename(stats['file'])}")
+
+    return write_summary(results, dest_path, time.time() - start)
+
 
 if __name__ == "__main__":
     # for earlier datasets... not needed for new data
     # tweak_data_samples("training_data/McCurdy")
 
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--source", type=str, default=SOURCE_PATH, help="Folder of .bag files to convert.")
+    parser.add_argument("-d", "--dest", type=str, default=DEST_PATH, help="Folder to write converted runs to.")
+    parser.add_argument("-w", "--workers", type=int, default=NUM_WORKERS, help="Number of bag files to convert at once.")
+    parser.add_argument("--redo", action="store_true", help="Reconvert runs from scratch even if they were (partly) processed.")
+    parser.add_argument("-p", "--preview", type=int, default=PREVIEW_EVERY,
+                        help="Show preview windows every Nth frame (0 = headless).")
+    parser.add_argument("-c", "--contact-sheet", type=int, default=CONTACT_SHEET_EVERY,
+                        help="Add every Nth frame to contact sheets in <run>/preview (0 = off).")
+    parser.add_argument("--sequential", action="store_true",
+                        help="Decode, transform and write each frame in turn instead of in parallel stages.")
+    parser.add_argument("--format", type=str, default=OUTPUT_FORMAT, choices=["png", "shards", "packed"],
+                        help="Write png files per frame and product, or pack each product into shards "
+                             "(packed: with bw at 1 bit per pixel).")
+    parser.add_argument("--products", type=str, default=",".join(OUTPUT_PRODUCTS),
+                        help=f"Comma separated products to write ({', '.join(PRODUCT_SUFFIXES)}).")
+    parser.add_argument("--edge-roi", action="store_true", help="Run edge detection on the cropped region only.")
+    parser.add_argument("--join", type=str, default=TELEMETRY_JOIN, choices=["time", "frame"],
+                        help="Match frames to telemetry by nearest timestamp or by exact frame number.")
+    parser.add_argument("--tolerance", type=float, default=JOIN_TOLERANCE,
+                        help="Largest frame to telemetry time gap in seconds (time join).")
+    parser.add_argument("--interpolate", action="store_true",
+                        help="Interpolate throttle and steering between telemetry rows (time join).")
+    parser.add_argument("--latency", action="store_true",
+                        help="Record per-stage latency histograms (report per file, or on demand with kill -USR1).")
+    args = parser.parse_args()
+
+    products = tuple(p.strip() for p in args.products.split(",") if p.strip())
+    unknown = [p for p in products if p not in PRODUCT_SUFFIXES]
+    if unknown:
+        parser.error(f"unknown products: {', '.join(unknown)}")
+
+    main(source_path=args.source, dest_path=args.dest, workers=args.workers, skip_if_exists=not args.redo,
+         preview_every=args.preview, contact_sheet_every=args.contact_sheet, pipelined=not args.sequential,
+         output_format=args.format, products=products, edge_roi=args.edge_roi, telemetry_join=args.join,
+         join_tolerance=args.tolerance, interpolate=args.interpolate, latency=args.latency)
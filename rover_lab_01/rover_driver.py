@@ -13,9 +13,9 @@ rover_driver.py
 import pyrealsense2.pyrealsense2 as rs
 import time
 import numpy as np
-import cv2
 import keras
 import utilities.drone_lib as dl
+from preprocessing import FramePreprocessor
 
 # Path to the trained model weights
 MODEL_NAME = "models/rover_model_07_ver01_epoch0049_val_loss0.0006.h5"
@@ -40,6 +40,10 @@ crop_W = int(resize_W)
 crop_B = resize_H
 crop_T = int(resize_H/3)
 
+# shared preprocessing kernel (same chain as rover_data_processor, buffers reused every frame)
+preprocessor = FramePreprocessor(resize_W=resize_W, resize_H=resize_H, white_L=white_L, white_H=white_H,
+                                 crop_T=crop_T, crop_B=crop_B, crop_W=crop_W)
+
 def get_model(filename):
     """Load and compile the TensorFlow Keras model."""
     model = keras.models.load_model(filename, compile=False)
@@ -83,17 +87,9 @@ def get_video_data(pipeline):
     color_frame = np.asanyarray(color_frame.get_data())
     #print("Color Frame ", color_frame.shape)
 
-    # resize frame
-    color_frame = cv2.resize(color_frame, (resize_W, resize_H))
-    #print("Color Frame part 2", color_frame.shape)
-    #convert to BW image for easier line detection
-    gray_frame = cv2.cvtColor(color_frame, cv2.COLOR_BGR2GRAY)
-    BW_frame = cv2.inRange(gray_frame, white_L, white_H)
-
-                # Crop Bw image
-    BW_frame = BW_frame[crop_T:crop_B, 0:crop_W]
-    # Perform cropping (if any)
-    # etc...
+    # resize, convert to BW for easier line detection and crop
+    # (the returned image is reused on the next call; it is consumed before then)
+    BW_frame = preprocessor.bw(color_frame)
     image = BW_frame
     #print("BW Frame ",BW_frame.shape )
 
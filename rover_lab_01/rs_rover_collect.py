@@ -21,9 +21,10 @@ def append_ardu_data(throttle, steering, heading, idx, file):
     f.write(f"{throttle},{steering},{heading},{idx}\n")
     f.close()
 
-def append_data(data, index, data_file):
-    field_names = ['index', 'throttle', 'steering', 'heading']
-    data_dict = {'index': index, 'throttle': data[0], 'steering': data[1], 'heading': data[2]}
+def append_data(data, index, data_file, timestamp=None):
+    field_names = ['index', 'throttle', 'steering', 'heading', 'timestamp']
+    data_dict = {'index': index, 'throttle': data[0], 'steering': data[1], 'heading': data[2],
+                 'timestamp': timestamp}
     csv.DictWriter(data_file,  fieldnames=field_names).writerow(data_dict)
 
 def prepare_log_file(log_file):
@@ -51,7 +52,7 @@ def collect_data(bag_file):
 
         file_name = bag_file.replace(".bag", ".csv")
         data_file = open(file_name, 'w')
-        header = ['index', 'throttle', 'steering', 'heading']
+        header = ['index', 'throttle', 'steering', 'heading', 'timestamp']
 
         writer = csv.writer(data_file)
         writer.writerow(header)
@@ -99,6 +100,8 @@ def collect_data(bag_file):
                 steering_mix = int(connection.channels['1'])
 
             heading = connection.heading
+            # host time the telemetry was read; the processor joins frames to rows by time
+            timestamp = time.time()
 
             frm_num = int(bgr_frame.frame_number)
 
@@ -106,7 +109,7 @@ def collect_data(bag_file):
             #append_ardu_data(throttle=throttle, steering=steering_mix,heading=heading, idx=frm_num,file=ardu_file)
 
             data = [throttle, steering_mix, heading]
-            append_data(data, frm_num, data_file)
+            append_data(data, frm_num, data_file, f"{timestamp:.6f}")
 
             if (frm_num % state_update_interval) == 0:
                 dl.display_rover_state(connection)
@@ -0,0 +1,72 @@
+"""
+FramePreprocessor (per frame and batched) must give exactly the same BW images as the
+original resize -> gray -> inRange -> crop chain (preprocessing.reference_bw).
+
+Run from rover_lab_01 with: python -m pytest -q tests
+"""
+
+import numpy as np
+import pytest
+from preprocessing import FramePreprocessor, reference_bw, SOURCE_W, SOURCE_H
+
+# integer downscale (crop before resize) and a non-integer one (full resize, then crop)
+PARAMS = {
+    "integer": dict(resize_W=320, resize_H=240, white_L=220, white_H=255, crop_T=80, crop_B=240, crop_W=320),
+    "small": dict(resize_W=160, resize_H=120, white_L=200, white_H=255, crop_T=40, crop_B=120, crop_W=160),
+    "non_integer": dict(resize_W=300, resize_H=200, white_L=220, white_H=250, crop_T=60, crop_B=200, crop_W=280),
+}
+
+
+def random_frames(count, seed=0):
+    return np.random.default_rng(seed).integers(0, 256, (count, SOURCE_H, SOURCE_W, 3), dtype=np.uint8)
+
+
+def gray_frames(values):
+    # frames of one flat gray level each (equal b, g, r give exactly that gray value)
+    return np.stack([np.full((SOURCE_H, SOURCE_W, 3), v, dtype=np.uint8) for v in values])
+
+
+@pytest.mark.parametrize("name", sorted(PARAMS))
+def test_bw_matches_reference(name):
+    params = PARAMS[name]
+    preprocessor = FramePreprocessor(**params)
+    for frame in random_frames(4):
+        assert np.array_equal(preprocessor.bw(frame), reference_bw(frame, **params))
+
+
+@pytest.mark.parametrize("name", sorted(PARAMS))
+def test_bw_batch_matches_per_frame(name):
+    params = PARAMS[name]
+    preprocessor = FramePreprocessor(**params)
+    frames = random_frames(6, seed=1)
+    expected = np.stack([reference_bw(frame, **params) for frame in frames])
+    per_frame = np.stack([preprocessor.bw(frame).copy() for frame in frames])
+
+    assert np.array_equal(preprocessor.bw_batch(frames), expected)
+    assert np.array_equal(preprocessor.bw_batch(list(frames)), expected)
+    assert np.array_equal(per_frame, expected)
+
+
+def test_crop_first_paths():
+    assert FramePreprocessor(**PARAMS["integer"]).crop_first
+    assert not FramePreprocessor(**PARAMS["non_integer"]).crop_first
+
+
+@pytest.mark.parametrize("name", sorted(PARAMS))
+def test_threshold_boundaries(name):
+    params = PARAMS[name]
+    low, high = params["white_L"], params["white_H"]
+    values = [0, low - 1, low, high, 255] + ([high + 1] if high < 255 else [])
+    frames = gray_frames(values)
+    preprocessor = FramePreprocessor(**params)
+
+    batch = preprocessor.bw_batch(frames)
+    for i, v in enumerate(values):
+        expected = 255 if low <= v <= high else 0
+        assert np.all(batch[i] == expected), f"gray {v}"
+        assert np.array_equal(preprocessor.bw(frames[i]), reference_bw(frames[i], **params))
+
+
+def test_bw_batch_empty():
+    preprocessor = FramePreprocessor()
+    assert preprocessor.bw_batch([]).shape == (0, preprocessor.crop_B - preprocessor.crop_T, preprocessor.crop_W)
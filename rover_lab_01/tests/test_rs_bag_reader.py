@@ -0,0 +1,189 @@
+"""
+rs_bag_reader against tiny rosbag v2 files written here: one uncompressed and one bz2 chunk,
+color (rgb8) and depth (mono16) image topics. Checks the frame index order, decoded pixels
+and encodings, and that cached_index() notices when the bag changes.
+
+Run from rover_lab_01 with: python -m pytest -q tests
+"""
+
+import os
+import struct
+import bz2
+import numpy as np
+import pytest
+from utilities.rs_bag_reader import BagReader, COLOR_TOPIC, DEPTH_TOPIC, index_cache_path
+
+START_NS = 1_600_000_000 * 1_000_000_000
+FRAME_NS = 33_000_000
+
+
+def _fields(fields):
+    return b"".join(struct.pack("<I", len(name) + 1 + len(value)) + name.encode() + b"=" + value
+                    for name, value in fields)
+
+
+def _record(fields, data):
+    header = _fields(fields)
+    return struct.pack("<I", len(header)) + header + struct.pack("<I", len(data)) + data
+
+
+def _time(ns):
+    return struct.pack("<II", ns // 1_000_000_000, ns % 1_000_000_000)
+
+
+def _image_message(frame, ns, encoding, image):
+    height, width = image.shape[:2]
+    return (struct.pack("<I", frame) + _time(ns) + struct.pack("<I", 0)
+            + struct.pack("<III", height, width, len(encoding)) + encoding.encode()
+            + struct.pack("<BII", 0, image.strides[0], image.nbytes) + image.tobytes())
+
+
+def color_image(frame):
+    image = np.full((6, 8, 3), frame % 256, dtype=np.uint8)
+    image[0, 0] = (1, 2, 3)
+    return image
+
+
+def depth_image(frame):
+    return (np.arange(6 * 8, dtype=np.uint16).reshape(6, 8) + frame * 100).astype(np.uint16)
+
+
+def write_bag(path, frames, compressions=("none", "bz2")):
+    """
+    Write `frames` (frame numbers, in file order) split evenly over one chunk per entry of
+    compressions. Every frame has a color and a depth message with the same stamp.
+    """
+    topics = {0: COLOR_TOPIC, 1: DEPTH_TOPIC}
+    connections = {conn: _record([("op", b"\x07"), ("conn", struct.pack("<I", conn)), ("topic", topic.encode())],
+                                 _fields([("topic", topic.encode()), ("type", b"sensor_msgs/Image")]))
+                   for conn, topic in topics.items()}
+
+    def bag_header(index_pos, chunk_count):
+        return _record([("op", b"\x03"), ("index_pos", struct.pack("<Q", index_pos)),
+                        ("conn_count", struct.pack("<I", len(topics))),
+                        ("chunk_count", struct.pack("<I", chunk_count))], b"")
+
+    start = len(b"#ROSBAG V2.0\n") + len(bag_header(0, 0))
+    body = bytearray()
+    chunk_infos = []
+    parts = np.array_split(np.asarray(frames), len(compressions))
+    for part, compression in zip(parts, compressions):
+        chunk = bytearray()
+        offsets = {0: [], 1: []}
+        for conn in topics:
+            chunk += connections[conn]
+        for frame in part.tolist():
+            ns = START_NS + frame * FRAME_NS
+            for conn, encoding, image in ((0, "rgb8", color_image(frame)), (1, "mono16", depth_image(frame))):
+                offsets[conn].append((ns, len(chunk)))
+                chunk += _record([("op", b"\x02"), ("conn", struct.pack("<I", conn)), ("time", _time(ns))],
+                                 _image_message(frame, ns, encoding, image))
+        data = bytes(chunk) if compression == "none" else bz2.compress(bytes(chunk))
+        chunk_pos = start + len(body)
+        body += _record([("op", b"\x05"), ("compression", compression.encode()),
+                         ("size", struct.pack("<I", len(chunk)))], data)
+        for conn, entries in offsets.items():
+            body += _record([("op", b"\x04"), ("ver", struct.pack("<I", 1)), ("conn", struct.pack("<I", conn)),
+                             ("count", struct.pack("<I", len(entries)))],
+                            b"".join(_time(ns) + struct.pack("<I", offset) for ns, offset in entries))
+        times = [START_NS + frame * FRAME_NS for frame in part.tolist()]
+        chunk_infos.append((chunk_pos, min(times), max(times), {conn: len(e) for conn, e in offsets.items()}))
+
+    index_pos = start + len(body)
+    for conn in topics:
+        body += connections[conn]
+    for chunk_pos, first, last, counts in chunk_infos:
+        body += _record([("op", b"\x06"), ("ver", struct.pack("<I", 1)), ("chunk_pos", struct.pack("<Q", chunk_pos)),
+                         ("start_time", _time(first)), ("end_time", _time(last)),
+                         ("count", struct.pack("<I", len(counts)))],
+                        b"".join(struct.pack("<II", conn, count) for conn, count in counts.items()))
+
+    with open(path, "wb") as f:
+        f.write(b"#ROSBAG V2.0\n" + bag_header(index_pos, len(chunk_infos)) + bytes(body))
+
+
+# written out of frame order, so the index has to sort them
+FRAMES = [107, 103, 105, 101, 100, 106, 104, 102]
+
+
+@pytest.fixture
+def bag_path(tmp_path):
+    path = str(tmp_path / "run.bag")
+    write_bag(path, FRAMES)
+    return path
+
+
+def test_build_index_sorted_by_frame(bag_path):
+    with BagReader(bag_path) as reader:
+        for topic in (COLOR_TOPIC, DEPTH_TOPIC):
+            index = reader.build_index(topic)
+            assert index['frame'].tolist() == sorted(FRAMES)
+            assert index['time'].tolist() == [START_NS + f * FRAME_NS for f in sorted(FRAMES)]
+            # half the frames in the uncompressed chunk, half in the bz2 one
+            assert sorted(set(index['chunk'].tolist())) == [0, 1]
+
+
+def test_decode_images_from_both_chunks(bag_path):
+    with BagReader(bag_path) as reader:
+        for frame in FRAMES:
+            encoding, image = reader.image(COLOR_TOPIC, frame)
+            assert encoding == "rgb8"
+            assert image.shape == (6, 8, 3) and image.dtype == np.uint8
+            assert np.array_equal(image, color_image(frame))
+
+            encoding, image = reader.image(DEPTH_TOPIC, frame)
+            assert encoding == "mono16"
+            assert image.shape == (6, 8) and image.dtype == np.uint16
+            assert np.array_equal(image, depth_image(frame))
+
+        with pytest.raises(KeyError):
+            reader.image(COLOR_TOPIC, 999)
+
+
+def test_iter_images_in_file_order(bag_path):
+    with BagReader(bag_path) as reader:
+        frames = [frame for frame, _, _, _ in reader.iter_images(COLOR_TOPIC)]
+    assert frames == FRAMES
+
+
+def test_cached_index_saved_and_reused(bag_path, monkeypatch):
+    with BagReader(bag_path) as reader:
+        first = reader.cached_index(COLOR_TOPIC)
+    assert os.path.exists(index_cache_path(bag_path))
+
+    def no_rebuild(self, topic, chunks=None):
+        raise AssertionError("index rebuilt although the bag did not change")
+
+    monkeypatch.setattr(BagReader, "build_index", no_rebuild)
+    with BagReader(bag_path) as reader:
+        assert np.array_equal(reader.cached_index(COLOR_TOPIC), first)
+
+
+def test_cached_index_rebuilt_when_mtime_changes(tmp_path):
+    # uncompressed chunks only, so a bag with other frame numbers has exactly the same size
+    bag_path = str(tmp_path / "run.bag")
+    write_bag(bag_path, FRAMES, compressions=("none", "none"))
+    with BagReader(bag_path) as reader:
+        reader.cached_index(COLOR_TOPIC)
+
+    # same size, different frame numbers: only the modification time tells the bags apart
+    size = os.path.getsize(bag_path)
+    stat = os.stat(bag_path)
+    write_bag(bag_path, [f + 10 for f in FRAMES], compressions=("none", "none"))
+    assert os.path.getsize(bag_path) == size
+    os.utime(bag_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+    with BagReader(bag_path) as reader:
+        assert reader.cached_index(COLOR_TOPIC)['frame'].tolist() == sorted(f + 10 for f in FRAMES)
+
+
+def test_cached_index_rebuilt_when_size_changes(bag_path):
+    with BagReader(bag_path) as reader:
+        reader.cached_index(COLOR_TOPIC)
+    mtime_ns = os.stat(bag_path).st_mtime_ns
+
+    write_bag(bag_path, FRAMES + [108, 109])
+    os.utime(bag_path, ns=(mtime_ns, mtime_ns))
+
+    with BagReader(bag_path) as reader:
+        assert reader.cached_index(COLOR_TOPIC)['frame'].tolist() == sorted(FRAMES + [108, 109])
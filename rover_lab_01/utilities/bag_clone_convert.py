@@ -6,26 +6,79 @@ import time
 import datetime
 import os
 import glob
+import csv
 from imutils.video import FPS
+import utilities.rs_playback as rsp
+import utilities.depth_io as dio
+import utilities.depth_filters as df
+
+# Run from rover_lab_01 as: python -m utilities.bag_clone_convert -f <bag file>
 
 #SOURCE_PATH = "/media/8b3828b7-446b-4bae-9493-13389976bb46/rover_data/raw"
 SOURCE_PATH = '/media/usafa/data/rover_data'
 #DEST_PATH = "/media/8b3828b7-446b-4bae-9493-13389976bb46/rover_data/processed"
 DEST_PATH = '/media/usafa/data/rover_data_processed'
+# play bags back in real time (30 fps, drops frames when we fall behind) or as fast as possible
+REAL_TIME_PLAYBACK = False
+
+# how depth is exported:
+#   "png"        raw 16-bit depth only (*_d.png) at DEPTH_PNG_COMPRESSION
+#   "shards"     raw depth delta coded and compressed into depth_NNNNN.npz shards (utilities/depth_io.py)
+#   "png+color"  raw depth plus a colorized *_cd.png per frame (the old output)
+# colorized views can always be made later with: python -m utilities.depth_view -f <run folder>
+DEPTH_EXPORT = "png"
+DEPTH_PNG_COMPRESSION = dio.DEPTH_PNG_COMPRESSION
+# librealsense post-processing applied to depth before alignment (see utilities/depth_filters.py);
+# none by default, so the raw depth is exported unchanged. Depth is aligned to color so the color
+# outputs keep their size; only --filters decimation with DEPTH_GRID (--depth-grid) reduces both
+# to the decimated depth grid. Measure combinations first with
+# python -m utilities.depth_filter_benchmark -f <bag file>
+DEPTH_FILTERS = df.DEFAULT_FILTERS
+DECIMATION = df.DECIMATION_MAGNITUDE
+DEPTH_GRID = False
+
+# range of white used for line detection
+white_L = 220
+white_H = 255
 
 parser = argparse.ArgumentParser()
 parser.add_argument("-f", "--input", type=str, help="Bag file to read")
+parser.add_argument("--depth", type=str, default=DEPTH_EXPORT, choices=["png", "shards", "png+color"],
+                    help="Depth export: raw 16-bit png, compressed depth shards, or png plus colorized png.")
+parser.add_argument("--filters", type=str, default=",".join(DEPTH_FILTERS),
+                    help=f"Comma separated depth filters ({', '.join(df.FILTER_NAMES)}); none by default.")
+parser.add_argument("--decimation", type=int, default=DECIMATION, help="Depth decimation magnitude.")
+parser.add_argument("--depth-grid", action="store_true", default=DEPTH_GRID,
+                    help="With decimation, write color and depth at the decimated depth resolution.")
 args = parser.parse_args()
 
 
 def load_telem_file(path):
     # Create lookup for frame index (ID)
     # In other words, come up with a way to hold frame data
-    # indexed by frame ID.
+    # indexed by frame ID: {frame: (throttle, steering, heading)}
+
+    # .ard files are written by append_ardu_data without a header
+    # (throttle,steering,heading,idx); .csv files carry their own header.
+    if path.endswith(".ard"):
+        field_names = ['throttle', 'steering', 'heading', 'index']
+    else:
+        field_names = None
+
+    frm_lookup = {}
+    with open(path, 'r') as f:
+        # Load data from the data file (comma delimited), and
+        # hold it in a dictionary for constant time lookup.
+        for row in csv.DictReader(f, fieldnames=field_names):
+            try:
+                frm_num = int(row['index'])
+            except (TypeError, ValueError):
+                # header row or partial row
+                continue
+            if frm_num not in frm_lookup:
+                frm_lookup[frm_num] = (row['throttle'], row['steering'], row['heading'])
 
-    # Load data from the data file (comma delimited), and
-    # hold it in a structure for quick lookup (maybe a dictionary).
-    return None
+    return frm_lookup
 
 
 def get_num_frames(filename):
@@ -53,9 +106,21 @@ def get_num_frames(filename):
     return t, frame_counts
 
 
-def process_bag_file(source_file, dest_folder=None, skip_if_exists=True):
+def process_bag_file(source_file, dest_folder=None, skip_if_exists=True, real_time=REAL_TIME_PLAYBACK,
+                     depth_export=None, depth_filters=None, decimation=None, depth_grid=None):
     fps = None
     pipeline = None
+    playback = None
+    depth_writer = None
+    stats = rsp.new_stats()
+    if depth_export is None:
+        depth_export = args.depth
+    if depth_filters is None:
+        depth_filters = df.parse_filters(args.filters)
+    if decimation is None:
+        decimation = args.decimation
+    if depth_grid is None:
+        depth_grid = args.depth_grid
 
     try:
         i = 0
@@ -76,70 +141,72 @@ def process_bag_file(source_file, dest_folder=None, skip_if_exists=True):
         if skip_if_exists:
             if os.path.isdir(dest_path):
                 print(f"{file_name} was previously processed; skipping file...")
-                return
+                return stats
 
         # Make subfolder to hold all training data
         os.makedirs(dest_path, exist_ok=True)
 
         # Load data associated with the video.
-        frm_lookup = load_telem_file(path.replace(".bag", ".ard"))
+        # Newer recordings store telemetry in a .csv next to the bag.
+        telem_path = path.replace(".bag", ".csv")
+        if not os.path.exists(telem_path):
+            telem_path = path.replace(".bag", ".ard")
+        frm_lookup = load_telem_file(telem_path)
 
         # duration, frame_count = get_num_frames(path)
 
-        config = rs.config()
-
-        rs.config.enable_device_from_file(config, path, False)
-        pipeline = rs.pipeline()
-
         # Enable both color and depth streams
-        config.enable_stream(rs.stream.color, 640, 480, rs.format.bgr8, 30)
-        config.enable_stream(rs.stream.depth, 640, 480, rs.format.z16, 30)
-        pipeline.start(config)
-        time.sleep(1)
-
-        # Pause here to allow pipeline to start
-        # before turning off real-time streaming.
-        profile = pipeline.get_active_profile()
+        # (with real_time off every frame is delivered in order, as fast as we can process it)
+        pipeline, playback = rsp.open_bag(path, [(rs.stream.color, 640, 480, rs.format.bgr8, 30),
+                                                 (rs.stream.depth, 640, 480, rs.format.z16, 30)],
+                                          real_time=real_time)
 
         # Going to export depth (color and b&w),
         # rgb, and any other processed results we need/want...
 
-        # setup colorizer for depth map
-        colorizer = rs.colorizer()
-        playback = profile.get_device().as_playback()
-        playback.set_real_time(True)
+        # setup colorizer for depth map (only when colorized depth is exported)
+        colorizer = rs.colorizer() if depth_export == "png+color" else None
+        if depth_export == "shards":
+            depth_writer = dio.DepthShardWriter(dest_path)
 
-        align_to = rs.stream.color
+        # depth post-processing chain (one per bag: the temporal filter keeps state between frames)
+        depth_chain = df.build_chain(depth_filters, decimation)
+        align_to = df.align_target(depth_filters, decimation, depth_grid)
         alignedFs = rs.align(align_to)
         fps = FPS().start()
-        while playback.current_status() == rs.playback_status.playing:
+        # iter_frames stops at the end of the file
+        for frames in rsp.iter_frames(pipeline, playback, stats):
             try:
-                frames = pipeline.wait_for_frames(timeout_ms=5000)  # pipeline.poll_for_frames()
-                if not frames:
-                    print("no frames")
+                # Get related throttle and steering for frame
+                frm_num = frames.get_color_frame().frame_number
+                # print(f"Processing frame {frm_num}...")
+                telem = frm_lookup.get(int(frm_num))
+                if telem is None:
+                    # no telemetry; skip before aligning, colorizing or copying pixels
                     continue
+                (throttle, steering, heading) = telem
+                stats['matched'] += 1
 
-                # align rgb to depth pixels
+                # reduce and clean up depth, then align rgb and depth pixels
+                if depth_chain:
+                    frames = df.apply_chain(frames, depth_chain)
                 aligned_frames = alignedFs.process(frames)
 
                 color_frame = aligned_frames.get_color_frame()
                 depth_frame = aligned_frames.get_depth_frame()
 
-                # Get related throttle and steering for frame
-                frm_num = color_frame.frame_number
-                # print(f"Processing frame {frm_num}...")
-                (throttle, steering, heading) = frm_lookup.get(frm_num, (-1, -1, -1))
-
                 color_frame = np.asanyarray(color_frame.get_data())
-                c_depth_frame = np.asanyarray(colorizer.colorize(depth_frame).get_data())
+                c_depth_frame = None
+                if colorizer is not None:
+                    c_depth_frame = np.asanyarray(colorizer.colorize(depth_frame).get_data())
                 depth_frame = np.asanyarray(depth_frame.get_data())
 
                 color_frame = cv2.resize(color_frame, (320, 240))
 
                 # Maybe we want to do some white line detection here....
-                white_range = None
                 # white_range= based on results from processed rgb color frame
-                # white_range =
+                gray_frame = cv2.cvtColor(color_frame, cv2.COLOR_BGR2GRAY)
+                white_range = cv2.inRange(gray_frame, white_L, white_H)
                 # NOTE: any cropping could be done here...
                 # white_range = CROP here
 
@@ -172,8 +239,12 @@ def process_bag_file(source_file, dest_folder=None, skip_if_exists=True):
 
                 cv2.imwrite(os.path.join(dest_path, c_frm_name), color_frame)
                 cv2.imwrite(os.path.join(dest_path, w_frm_name), white_range)
-                cv2.imwrite(os.path.join(dest_path, d_frm_name), depth_frame)
-                cv2.imwrite(os.path.join(dest_path, cd_frm_name), c_depth_frame)
+                if depth_writer is not None:
+                    depth_writer.add(depth_frame, frm_num, throttle, steering, heading)
+                else:
+                    dio.write_depth_png(os.path.join(dest_path, d_frm_name), depth_frame, DEPTH_PNG_COMPRESSION)
+                if c_depth_frame is not None:
+                    cv2.imwrite(os.path.join(dest_path, cd_frm_name), c_depth_frame)
                 fps.update()
 
                 key = cv2.waitKey(1) & 0xFF
@@ -194,23 +265,21 @@ def process_bag_file(source_file, dest_folder=None, skip_if_exists=True):
         # stop recording
         if fps is not None:
             fps.stop()
-        time.sleep(0.5)
-        if playback is not None:
-            if playback.current_status() == rs.playback_status.playing:
-                playback.pause()
-                if pipeline is not None:
-                    pipeline.stop()
-                    time.sleep(0.5)
+        if depth_writer is not None:
+            depth_writer.close()
+        rsp.close_bag(pipeline, playback)
     except Exception as e:
-        print("Unexpected error during cleanup.", exc_info=True)
+        print(f"Unexpected error during cleanup: {e}")
 
     playback = None
     pipeline = None
 
     print(f"Finished processing frames for {source_file}.")
+    rsp.print_stats(os.path.basename(source_file), stats)
     if fps is not None:
         print("Elapsed time: {:.2f}".format(fps.elapsed()))
         print("[INFO] approx. FPS: {:.2f}".format(fps.fps()))
+    return stats
 
 
 def main():
@@ -1,96 +1,328 @@
+"""
+bag_playback.py
+
+Seekable playback of RealSense color recordings.
+
+The bag is read directly (utilities/rs_bag_reader.py) rather than through a librealsense
+playback device, so any frame can be shown at any time. On first open the color frame
+number -> chunk/offset/time index is built and saved next to the bag (run.bag.index.npz);
+later opens load it instead of walking the bag again. Playback is paced by the recorded
+frame timestamps.
+
+With -ard 1 each frame shows the throttle, steering and heading from the run's telemetry
+log (the .csv next to the bag). The log is joined to every indexed frame once, when the bag
+is opened (by timestamp, or by frame number for logs without one), so the overlay is an
+array lookup per frame. With --model the frames ahead of the cursor are run through the
+model in batches on a background thread (PredictionPrefetcher) and the prediction is drawn
+next to the recorded values; frames shown before their prediction is ready say so.
+
+Keys:
+    p / space   pause / resume
+    d / a       step one frame forward / back (pauses)
+    ] / [       jump JUMP_FRAMES forward / back
+    } / {       jump JUMP_FRAMES_LARGE forward / back
+    g           go to a frame number typed in the terminal
+    c / s       close (skip) this video
+    q           quit
+The trackbar under the image scrubs through the recording.
+
+Run from rover_lab_01 as:
+    python -m utilities.bag_playback -f <bag file> [--start-frame N] [-ard 1] [-m <model .h5>]
+    python -m utilities.bag_playback -f <folder>/ALL
+"""
+
 import argparse
-import pyrealsense2.pyrealsense2 as rs
+import threading
+import time
 import numpy as np
 import cv2
 import os
+import data_gen
+import utilities.telemetry as tl
+from utilities.rs_bag_reader import BagReader, COLOR_TOPIC
+from preprocessing import FramePreprocessor
+
+# frames skipped by the [ ] and { } keys (30 frames = 1 second at 30 fps)
+JUMP_FRAMES = 30
+JUMP_FRAMES_LARGE = 300
+# poll interval while paused, in ms
+PAUSED_WAIT_MS = 30
+# frames per model.predict call, and how far ahead of the cursor predictions are computed
+PREDICT_BATCH = 16
+PREDICT_LOOKAHEAD = 90
+
+# per indexed frame: recorded telemetry (NaN when no row matched) and the frame-telemetry time offset
+OVERLAY_DTYPE = np.dtype([('matched', '?'), ('throttle', '<f8'), ('steering', '<f8'),
+                          ('heading', '<f8'), ('offset', '<f8')])
 
 quit_program = False
 
 
-def play_bag(file_path, no_loop=False, bgr=False):
-    global quit_program
+def frame_position(index, frame):
+    # row of the first indexed frame at or after this frame number (clamped to the last one)
+    row = int(np.searchsorted(index['frame'], frame))
+    return min(row, len(index) - 1)
 
+
+def ask_frame(index):
+    text = input(f"Go to frame ({index['frame'][0]}..{index['frame'][-1]}): ").strip()
     try:
+        return frame_position(index, int(text))
+    except ValueError:
+        print(f"Not a frame number: {text}")
+        return None
+
+
+def load_overlay(bag_file, index, tolerance=tl.DEFAULT_TOLERANCE):
+    # telemetry joined to every indexed frame up front, so drawing it is an array lookup
+    telem_file = bag_file.replace(".bag", ".csv")
+    if not os.path.exists(telem_file):
+        print(f"No telemetry log {telem_file}; playing without the overlay.")
+        return None
+
+    telem = tl.load_telemetry(telem_file)
+    overlay = np.zeros(len(index), dtype=OVERLAY_DTYPE)
+    overlay['offset'] = np.nan
+    if tl.has_timestamps(telem):
+        (overlay['matched'], overlay['throttle'], overlay['steering'],
+         overlay['heading'], overlay['offset']) = tl.join_nearest(index['time'] / 1e9, telem, tolerance)
+    else:
+        overlay['matched'], overlay['throttle'], overlay['steering'], overlay['heading'] = \
+            tl.join_frames(index['frame'], telem)
+    print(f"{os.path.basename(telem_file)}: {np.count_nonzero(overlay['matched'])} of {len(index)} frames "
+          f"have telemetry")
+    return overlay
+
+
+def load_model(model_file):
+    # keras (tensorflow) is only needed when predictions are requested
+    import keras
+    model = keras.models.load_model(model_file, compile=False)
+    print(f"Loaded model {model_file}, input {model.input_shape}")
+    return model
+
+
+class PredictionPrefetcher:
+    """
+    Runs a model over the frames just ahead of the playback cursor on a background thread,
+    PREDICT_BATCH frames per predict call, using the same BW preprocessing as the driver.
+    Predictions are kept per indexed frame as [steering, throttle] in PWM units.
+    """
+
+    def __init__(self, bag_file, index, model, batch_size=PREDICT_BATCH, lookahead=PREDICT_LOOKAHEAD):
+        self.bag_file = bag_file
+        self.index = index
+        self.model = model
+        self.batch_size = batch_size
+        self.lookahead = lookahead
+        self.predictions = np.full((len(index), 2), np.nan)
+        self.done = np.zeros(len(index), dtype=bool)
+        self.cursor = 0
+        self.error = None
+        self.stopped = False
+        self.wake = threading.Condition()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def seek(self, pos):
+        with self.wake:
+            if pos != self.cursor:
+                self.cursor = pos
+                self.wake.notify()
+
+    def get(self, pos):
+        # (steering, throttle), or None when this frame has not been predicted yet
+        if not self.done[pos]:
+            return None
+        return self.predictions[pos]
 
-        file_name = os.path.basename(file_path)
-        config = rs.config()
-        rs.config.enable_device_from_file(config, file_path)
-        pipeline = rs.pipeline()
+    def stop(self):
+        with self.wake:
+            self.stopped = True
+            self.wake.notify()
+        self.thread.join()
 
-        # config.enable_stream(rs.stream.color, 640, 480, rs.format.bgr8, 30)
-        if not bgr:
-            config.enable_stream(rs.stream.color, 640, 480, rs.format.rgb8, 30)
+    def _next_batch(self):
+        # the first frames at or after the cursor, within the lookahead, that still need a prediction
+        with self.wake:
+            while not self.stopped:
+                start = self.cursor
+                todo = np.flatnonzero(~self.done[start:start + self.lookahead])
+                if len(todo):
+                    return todo[:self.batch_size] + start
+                self.wake.wait()
+            return None
+
+    def _run(self):
+        preprocessor = FramePreprocessor()
+        # a reader of its own: the display thread's reader caches its current chunk
+        with BagReader(self.bag_file) as reader:
+            try:
+                while True:
+                    positions = self._next_batch()
+                    if positions is None:
+                        break
+                    frames = []
+                    for pos in positions:
+                        _, _, encoding, image = reader.decode_image(int(self.index['chunk'][pos]),
+                                                                    int(self.index['offset'][pos]))
+                        frames.append(cv2.cvtColor(image, cv2.COLOR_RGB2BGR) if encoding == 'rgb8' else image)
+                    batch = preprocessor.bw_batch(frames)[..., np.newaxis]
+                    output = np.asarray(self.model.predict(batch, verbose=0))
+                    self.predictions[positions] = data_gen.invert_min_max_norm(output[:, :2])
+                    self.done[positions] = True
+            except Exception as e:
+                self.error = e
+                print(f"Prediction stopped: {e}")
+
+
+def overlay_lines(overlay, predictor, pos):
+    lines = []
+    if overlay is not None:
+        row = overlay[pos]
+        if row['matched']:
+            lines.append(f"thr {row['throttle']:.0f} str {row['steering']:.0f} hdg {row['heading']:.0f}")
         else:
-            config.enable_stream(rs.stream.color, 640, 480, rs.format.bgr8, 30)
+            lines.append("no telemetry")
+    if predictor is not None:
+        prediction = predictor.get(pos)
+        if prediction is None:
+            lines.append("pred: pending")
+        else:
+            lines.append(f"pred thr {prediction[1]:.0f} str {prediction[0]:.0f}")
+    return lines
 
-        pipeline.start(config)
-        i = 0
-        last_frm_idx = -1
-        pause = False
 
-        while True:
+def render(reader, index, pos, bgr=False, lines=()):
+    # decode one indexed frame into a bgr image for display, with its frame number drawn on it
+    row = index[pos]
+    cur_frm_idx, _, encoding, image = reader.decode_image(int(row['chunk']), int(row['offset']))
+    # rgb8 (what the recorder writes) is reversed for cv2; bgr=True reverses the layers once more
+    if (encoding == 'rgb8') != bgr:
+        color_frame = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+    else:
+        # the decoded image is a read-only view into the bag; copy before drawing on it
+        color_frame = image.copy()
 
-            if not pause:
-                frames = pipeline.wait_for_frames()
-                color_frame = frames.get_color_frame()
-                cur_frm_idx = int(color_frame.frame_number)
-                if not color_frame:
-                    continue
+    cv2.putText(img=color_frame, text=f"frame: {cur_frm_idx} ({pos + 1}/{len(index)})",
+                org=(10, 400), fontFace=cv2.FONT_HERSHEY_DUPLEX,
+                fontScale=1.0, color=(0, 255, 0))
+    for i, line in enumerate(lines):
+        cv2.putText(img=color_frame, text=line, org=(10, 430 + 28 * i), fontFace=cv2.FONT_HERSHEY_DUPLEX,
+                    fontScale=0.8, color=(0, 255, 255))
+    return color_frame
 
-                if no_loop:
-                    if cur_frm_idx < last_frm_idx:
-                        cv2.destroyWindow(file_name)
-                        break  # video is over, exit the playback loop
 
-                last_frm_idx = cur_frm_idx
+def play_bag(file_path, no_loop=False, bgr=False, start_frame=None, ard=False, model=None,
+             tolerance=tl.DEFAULT_TOLERANCE):
+    global quit_program
 
-                color_frame = np.asanyarray(color_frame.get_data())
+    file_name = os.path.basename(file_path)
+    with BagReader(file_path) as reader:
+        start = time.perf_counter()
+        index = reader.cached_index(COLOR_TOPIC)
+        print(f"{file_name}: {len(index)} color frames indexed in {time.perf_counter() - start:.2f}s")
+        if len(index) == 0:
+            return
 
-                # grab the frame dimensions and convert it to a blob
-                (h, w) = color_frame.shape[:2]
-                i += 1
+        pos = 0 if start_frame is None else frame_position(index, start_frame)
+        overlay = load_overlay(file_path, index, tolerance) if ard else None
+        predictor = PredictionPrefetcher(file_path, index, model) if model is not None else None
+        shown_count = pending_count = 0
+        last = len(index) - 1
+        # the trackbar callback only records the request; the loop below acts on it
+        scrub = [pos]
+        cv2.namedWindow(file_name)
+        cv2.createTrackbar("frame", file_name, pos, max(last, 1), lambda value: scrub.__setitem__(0, value))
 
-                cv2.putText(img=color_frame, text=f"frame: {cur_frm_idx}",
-                            org=(10, 400), fontFace=cv2.FONT_HERSHEY_DUPLEX,
-                            fontScale=1.0, color=(0, 255, 0))
+        pause = False
+        shown = None
+        next_time = time.perf_counter()
 
-                # show the output frame
-                if not bgr:
-                    cv2.imshow(file_name, cv2.cvtColor(color_frame, cv2.COLOR_RGB2BGR))
-                else:
-                    cv2.imshow(file_name, color_frame)
+        try:
+            while True:
+                if scrub[0] != pos:
+                    pos = min(scrub[0], last)
 
-            key = cv2.waitKey(1) & 0xFF
+                if pos != shown:
+                    if predictor is not None:
+                        predictor.seek(pos)
+                        shown_count += 1
+                        pending_count += predictor.get(pos) is None
+                    cv2.imshow(file_name, render(reader, index, pos, bgr, overlay_lines(overlay, predictor, pos)))
+                    cv2.setTrackbarPos("frame", file_name, pos)
+                    shown = pos
 
-            if key == ord("q"):  # Quit program
-                quit_program = True
-                break
-            if key == ord("c") \
-                    or key == ord("s"):  # close (or skip) current video
-                cv2.destroyWindow(file_name)
-                break
-            if key == ord("p"):  # Pause current video
                 if pause:
-                    pause = False
+                    wait_ms = PAUSED_WAIT_MS
                 else:
+                    # hold each frame for as long as it lasted in the recording
+                    if pos < last:
+                        next_time += (index['time'][pos + 1] - index['time'][pos]) / 1e9
+                    wait_ms = max(1, int((next_time - time.perf_counter()) * 1000))
+
+                key = cv2.waitKey(wait_ms) & 0xFF
+
+                if key == ord("q"):  # Quit program
+                    quit_program = True
+                    break
+                if key == ord("c") \
+                        or key == ord("s"):  # close (or skip) current video
+                    break
+                if key == ord("p") or key == ord(" "):  # Pause current video
+                    pause = not pause
+                    next_time = time.perf_counter()
+                    continue
+
+                if key in (ord("d"), ord("a")):  # step one frame, paused
                     pause = True
-    finally:
-        pass
+                    pos = min(max(pos + (1 if key == ord("d") else -1), 0), last)
+                elif key in (ord("]"), ord("[")):
+                    pos = min(max(pos + (JUMP_FRAMES if key == ord("]") else -JUMP_FRAMES), 0), last)
+                elif key in (ord("}"), ord("{")):
+                    pos = min(max(pos + (JUMP_FRAMES_LARGE if key == ord("}") else -JUMP_FRAMES_LARGE), 0), last)
+                elif key == ord("g"):
+                    requested = ask_frame(index)
+                    if requested is not None:
+                        pos = requested
+                elif not pause:
+                    if pos < last:
+                        pos += 1
+                    elif no_loop:
+                        break  # video is over, exit the playback loop
+                    else:
+                        pos = 0
+                    scrub[0] = pos
+                    continue
 
-    pipeline.stop()
+                # a key moved the position: restart pacing from the new frame
+                scrub[0] = pos
+                next_time = time.perf_counter()
+        finally:
+            cv2.destroyWindow(file_name)
+            if predictor is not None:
+                predictor.stop()
+                print(f"{file_name}: {shown_count - pending_count} of {shown_count} frames shown "
+                      f"with their prediction ready")
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("-f", "--input", type=str, help="Bag file to read")
+    parser.add_argument("-f", "--input", type=str, required=True,
+                        help="Bag file to read, or <folder>/ALL to play every bag in a folder")
     parser.add_argument("-l", "--loop", type=str, help="Set l=0 to prevent playback loop.")
     parser.add_argument("-bgr", "--bgr", type=str, help="Set bgr=1 to reverse rgb color layers during playback.")
     parser.add_argument("-ard", "--ard", type=str, help="Set ard=1 to display ArduPilot data with frames.")
+    parser.add_argument("-s", "--start-frame", type=int, default=None, help="Frame number to start playback at.")
+    parser.add_argument("-m", "--model", type=str, default=None,
+                        help="Trained model (.h5) whose predictions are drawn on each frame.")
+    parser.add_argument("--tolerance", type=float, default=tl.DEFAULT_TOLERANCE,
+                        help="Largest frame/telemetry time gap (seconds) for the -ard overlay.")
 
     args = parser.parse_args()
 
     if args.loop \
-            and args.loop == 0:
+            and args.loop == '0':
         no_loop = True
     else:
         no_loop = False
@@ -101,11 +333,11 @@ if __name__ == "__main__":
     else:
         bgr = False
 
-    # TODO: enable ard feature option...
+    ard = bool(args.ard) and args.ard == '1'
+    model = load_model(args.model) if args.model else None
 
     playback_location = str(args.input) + ""
 
-    playback_location="/media/usafa/data/rover_data/run.bag"
     if playback_location.upper().endswith("/ALL"):
         # Play all videos in the folder...
 
@@ -113,16 +345,18 @@ if __name__ == "__main__":
         playback_location = playback_location[:-4]
 
         # get list of files to play from root folder
-        videos = os.listdir(playback_location)
+        videos = sorted(os.listdir(playback_location))
 
         for vid_file in videos:
             if quit_program:
                 break
 
             if vid_file.lower().endswith(".bag"):
-                play_bag(os.path.join(playback_location, vid_file), no_loop=True, bgr=bgr)
+                play_bag(os.path.join(playback_location, vid_file), no_loop=True, bgr=bgr,
+                         ard=ard, model=model, tolerance=args.tolerance)
 
         pass
     else:
         # Play specific video file
-        play_bag(playback_location, no_loop=no_loop, bgr=bgr)
+        play_bag(playback_location, no_loop=no_loop, bgr=bgr, start_frame=args.start_frame,
+                 ard=ard, model=model, tolerance=args.tolerance)
@@ -0,0 +1,105 @@
+"""
+depth_filter_benchmark.py
+
+Per-frame cost and output size of every combination of the depth post-processing filters
+(utilities/depth_filters.py) on a real recording.
+
+For each combination the bag is played back once; for the first --frames framesets we time
+the filter chain and the alignment, then measure the depth that would be exported: its
+resolution, the fraction of pixels with depth, and its encoded size as a 16-bit png
+(DEPTH_PNG_COMPRESSION) and as a compressed depth-shard frame (utilities/depth_io.py).
+Depth is aligned to color as bag_clone_convert does by default; --depth-grid measures the
+decimated depth-grid output instead.
+
+Run from rover_lab_01 as:
+    python -m utilities.depth_filter_benchmark -f <bag file> [-n 300] [--depth-grid] [-o results.json]
+"""
+
+import argparse
+import itertools
+import json
+import time
+import cv2
+import numpy as np
+import pyrealsense2.pyrealsense2 as rs
+import utilities.rs_playback as rsp
+import utilities.depth_filters as df
+import utilities.depth_io as dio
+
+NUM_FRAMES = 300
+
+
+def filter_combinations():
+    # every subset of the filters, in chain order, starting with no filtering
+    for count in range(len(df.FILTER_NAMES) + 1):
+        for names in itertools.combinations(df.FILTER_NAMES, count):
+            yield names
+
+
+def measure(bag_file, names, num_frames=NUM_FRAMES, decimation=df.DECIMATION_MAGNITUDE, depth_grid=False):
+    chain = df.build_chain(names, decimation)
+    aligner = rs.align(df.align_target(names, decimation, depth_grid))
+    filter_time = align_time = 0.0
+    png_bytes = shard_bytes = valid = 0
+    shape = None
+    count = 0
+
+    pipeline, playback = rsp.open_bag(bag_file, [(rs.stream.color, 640, 480, rs.format.bgr8, 30),
+                                                 (rs.stream.depth, 640, 480, rs.format.z16, 30)])
+    try:
+        for frames in rsp.iter_frames(pipeline, playback):
+            t0 = time.perf_counter()
+            frames = df.apply_chain(frames, chain)
+            t1 = time.perf_counter()
+            aligned = aligner.process(frames)
+            t2 = time.perf_counter()
+            filter_time += t1 - t0
+            align_time += t2 - t1
+
+            depth = np.asanyarray(aligned.get_depth_frame().get_data())
+            shape = depth.shape
+            png_bytes += len(cv2.imencode(".png", depth, [cv2.IMWRITE_PNG_COMPRESSION, dio.DEPTH_PNG_COMPRESSION])[1])
+            shard_bytes += len(dio.encode_depth(depth))
+            valid += np.count_nonzero(depth) / depth.size
+            count += 1
+            if count >= num_frames:
+                break
+    finally:
+        rsp.close_bag(pipeline, playback)
+
+    count = max(count, 1)
+    return {'filters': list(names), 'frames': count,
+            'width': shape[1] if shape else 0, 'height': shape[0] if shape else 0,
+            'filter_ms': filter_time / count * 1000, 'align_ms': align_time / count * 1000,
+            'valid_fraction': valid / count,
+            'png_kb': png_bytes / count / 1024, 'shard_kb': shard_bytes / count / 1024}
+
+
+def run(bag_file, num_frames=NUM_FRAMES, decimation=df.DECIMATION_MAGNITUDE, depth_grid=False):
+    results = []
+    print(f"{'filters':<42} {'size':>9} {'filter ms':>10} {'align ms':>9} {'valid':>6} {'png KB':>8} {'shard KB':>9}")
+    for names in filter_combinations():
+        r = measure(bag_file, names, num_frames, decimation, depth_grid)
+        results.append(r)
+        label = "+".join(names) or "(none)"
+        print(f"{label:<42} {r['width']:>4}x{r['height']:<4} {r['filter_ms']:10.2f} {r['align_ms']:9.2f} "
+              f"{r['valid_fraction']:6.1%} {r['png_kb']:8.1f} {r['shard_kb']:9.1f}")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark depth post-processing filter combinations on a bag.")
+    parser.add_argument("-f", "--input", type=str, required=True, help="Bag file with color and depth streams.")
+    parser.add_argument("-n", "--frames", type=int, default=NUM_FRAMES, help="Framesets measured per combination.")
+    parser.add_argument("--decimation", type=int, default=df.DECIMATION_MAGNITUDE, help="Decimation magnitude.")
+    parser.add_argument("--depth-grid", action="store_true",
+                        help="Align color onto decimated depth instead of depth onto color.")
+    parser.add_argument("-o", "--output", type=str, default=None, help="Save the results to this JSON file.")
+    args = parser.parse_args()
+
+    results = run(args.input, args.frames, args.decimation, args.depth_grid)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'bag': args.input, 'depth_grid': args.depth_grid, 'created': time.strftime("%Y%m%d-%H%M%S"),
+                       'results': results}, f, indent=2)
+        print(f"Results written to {args.output}")
@@ -0,0 +1,97 @@
+"""
+depth_filters.py
+
+librealsense post-processing chain for depth, applied to each frameset before alignment:
+
+    decimation    shrinks depth by DECIMATION_MAGNITUDE in each direction (2: 640x480 -> 320x240)
+    spatial       edge-preserving smoothing
+    temporal      smoothing across frames (keeps state; one chain per recording)
+    hole_filling  fills pixels with no depth from their neighbours
+
+spatial and temporal run in disparity space, as librealsense recommends, so the chain
+inserts the depth <-> disparity transforms around them automatically.
+
+Every filter is opt-in: DEFAULT_FILTERS is empty, so unless filters are asked for the exported
+depth is the raw aligned depth, unchanged. Outputs stay on the 640x480 color grid as well:
+depth is aligned to color, so the *_c.png / *_w.png images keep the geometry the
+line-following model was trained on. Only when depth-grid output is asked for explicitly
+(with decimation) does align_target() pick the depth stream, mapping color onto the smaller
+depth grid so both are encoded at the reduced size. Measure a combination with
+utilities/depth_filter_benchmark.py on a real recording before making it a default.
+"""
+
+import pyrealsense2.pyrealsense2 as rs
+
+FILTER_NAMES = ("decimation", "spatial", "temporal", "hole_filling")
+# filters applied unless others are asked for: none, so exported depth values are unchanged
+DEFAULT_FILTERS = ()
+
+# filter settings (librealsense defaults, except decimation which defaults to 2 there too)
+DECIMATION_MAGNITUDE = 2
+SPATIAL_MAGNITUDE = 2
+SPATIAL_SMOOTH_ALPHA = 0.5
+SPATIAL_SMOOTH_DELTA = 20
+TEMPORAL_SMOOTH_ALPHA = 0.4
+TEMPORAL_SMOOTH_DELTA = 20
+# 0 = fill from left, 1 = farthest from around, 2 = nearest from around
+HOLE_FILLING_MODE = 1
+
+
+def parse_filters(text):
+    """'decimation,spatial' -> ('decimation', 'spatial'); raises ValueError for unknown names."""
+    names = tuple(name.strip() for name in text.split(",") if name.strip())
+    unknown = [name for name in names if name not in FILTER_NAMES]
+    if unknown:
+        raise ValueError(f"unknown depth filters: {', '.join(unknown)} (choose from {', '.join(FILTER_NAMES)})")
+    return names
+
+
+def build_chain(names, decimation=DECIMATION_MAGNITUDE):
+    """The rs filters for the named steps, in FILTER_NAMES order, with disparity transforms as needed."""
+    chain = []
+    in_disparity = False
+    for name in FILTER_NAMES:
+        if name not in names:
+            continue
+        if name in ("spatial", "temporal") and not in_disparity:
+            chain.append(rs.disparity_transform(True))
+            in_disparity = True
+        elif name not in ("spatial", "temporal") and in_disparity:
+            chain.append(rs.disparity_transform(False))
+            in_disparity = False
+
+        if name == "decimation":
+            block = rs.decimation_filter()
+            block.set_option(rs.option.filter_magnitude, decimation)
+        elif name == "spatial":
+            block = rs.spatial_filter()
+            block.set_option(rs.option.filter_magnitude, SPATIAL_MAGNITUDE)
+            block.set_option(rs.option.filter_smooth_alpha, SPATIAL_SMOOTH_ALPHA)
+            block.set_option(rs.option.filter_smooth_delta, SPATIAL_SMOOTH_DELTA)
+        elif name == "temporal":
+            block = rs.temporal_filter()
+            block.set_option(rs.option.filter_smooth_alpha, TEMPORAL_SMOOTH_ALPHA)
+            block.set_option(rs.option.filter_smooth_delta, TEMPORAL_SMOOTH_DELTA)
+        else:
+            block = rs.hole_filling_filter()
+            block.set_option(rs.option.holes_fill, HOLE_FILLING_MODE)
+        chain.append(block)
+
+    if in_disparity:
+        chain.append(rs.disparity_transform(False))
+    return chain
+
+
+def apply_chain(frames, chain):
+    """Run a frameset through the chain; the filters only touch its depth frame."""
+    for block in chain:
+        frames = block.process(frames).as_frameset()
+    return frames
+
+
+def align_target(names, decimation=DECIMATION_MAGNITUDE, depth_grid=False):
+    # color unless depth-grid output was asked for: then decimated depth stays small and
+    # color is mapped onto it (this changes the size and geometry of the color outputs)
+    if depth_grid and "decimation" in names and decimation > 1:
+        return rs.stream.depth
+    return rs.stream.color
@@ -0,0 +1,73 @@
+"""
+depth_view.py
+
+Colorized depth on demand: browse the raw depth of a converted run (16-bit *_d.png files or
+depth_NNNNN.npz shards from bag_clone_convert), or export colorized *_cd.png images for a
+range of frames when they are actually needed.
+
+Run from rover_lab_01 as:
+    python -m utilities.depth_view -f <run folder>                 (browse: any key = next, q = quit)
+    python -m utilities.depth_view -f <run folder> --export        (write *_cd.png next to the depth)
+"""
+
+import argparse
+import glob
+import os
+import cv2
+import utilities.depth_io as dio
+
+
+def iter_depth(run_folder, start=0, end=None):
+    # yields (frame number, name for a colorized copy, raw depth) in frame order
+    shards = dio.list_depth_shards(run_folder)
+    if shards:
+        for shard_path in shards:
+            shard = dio.DepthShard(shard_path)
+            for i, label in enumerate(shard.labels):
+                frm_num = int(label['frame'])
+                if frm_num < start or (end is not None and frm_num > end):
+                    continue
+                name = f"{frm_num:09d}_{label['throttle']}_{label['steering']}_cd.png"
+                yield frm_num, name, shard[i]
+        return
+
+    for depth_file in sorted(glob.glob(os.path.join(run_folder, "*_d.png"))):
+        frm_num = int(os.path.basename(depth_file).split('_')[0])
+        if frm_num < start or (end is not None and frm_num > end):
+            continue
+        yield frm_num, os.path.basename(depth_file)[:-len("d.png")] + "cd.png", dio.read_depth_png(depth_file)
+
+
+def browse(run_folder, start=0, end=None, min_m=dio.COLOR_MIN_M, max_m=dio.COLOR_MAX_M):
+    for frm_num, name, depth in iter_depth(run_folder, start, end):
+        view = dio.colorize(depth, min_m=min_m, max_m=max_m)
+        cv2.putText(view, str(frm_num), (10, 25), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 255, 255), 2)
+        cv2.imshow("Depth", view)
+        if cv2.waitKey(0) & 0xFF == ord("q"):
+            break
+    cv2.destroyAllWindows()
+
+
+def export(run_folder, start=0, end=None, min_m=dio.COLOR_MIN_M, max_m=dio.COLOR_MAX_M):
+    count = 0
+    for frm_num, name, depth in iter_depth(run_folder, start, end):
+        cv2.imwrite(os.path.join(run_folder, name), dio.colorize(depth, min_m=min_m, max_m=max_m))
+        count += 1
+    print(f"Wrote {count} colorized depth images to {run_folder}")
+    return count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="View or export colorized depth for a converted run.")
+    parser.add_argument("-f", "--folder", type=str, required=True, help="Converted run folder.")
+    parser.add_argument("--start", type=int, default=0, help="First frame number.")
+    parser.add_argument("--end", type=int, default=None, help="Last frame number.")
+    parser.add_argument("--min", type=float, default=dio.COLOR_MIN_M, help="Nearest depth (m) on the color scale.")
+    parser.add_argument("--max", type=float, default=dio.COLOR_MAX_M, help="Farthest depth (m) on the color scale.")
+    parser.add_argument("--export", action="store_true", help="Write *_cd.png files instead of showing a window.")
+    args = parser.parse_args()
+
+    if args.export:
+        export(args.folder, args.start, args.end, args.min, args.max)
+    else:
+        browse(args.folder, args.start, args.end, args.min, args.max)
@@ -1,11 +1,158 @@
+"""
+ros_bag_api.py
+
+Extract images from a ROS bag (e.g. a RealSense recording) for one or more image topics,
+optionally limited to a range of frame numbers (header.seq) or of seconds from the start
+of the bag.
+
+Messages are streamed from the bag on the calling thread into a pool of decode and
+encode/write workers (utilities/stage_pipeline.py), and written either as png files,
+<output_dir>/<stream>/<seq>.png, or straight into packed shards (utilities/shard_io.py),
+<output_dir>/<stream>/images_00000.npy. A throughput report is printed at the end.
+
+Run from rover_lab_01 as:
+    python -m utilities.ros_bag_api <bag file> <output dir> [-t topic ...] [--format shards]
+"""
+
 import os
 import argparse
-import  numpy as np
+import threading
+import time
+import numpy as np
 import cv2
 
 import rosbag
-from sensor_msgs.msg import Image
-from cv_bridge import CvBridge
+import rospy
+from utilities.stage_pipeline import StagePipeline
+from utilities.shard_io import ShardWriter, SHARD_SIZE
+
+COLOR_TOPIC = '/device_0/sensor_1/Color_0/image/data'
+DEPTH_TOPIC = '/device_0/sensor_0/Depth_0/image/data'
+
+DECODE_WORKERS = 2
+WRITER_WORKERS = 4
+QUEUE_SIZE = 32
+
+# sensor_msgs/Image encodings -> (numpy dtype, channels)
+ENCODINGS = {'rgb8': (np.uint8, 3), 'bgr8': (np.uint8, 3),
+             'rgba8': (np.uint8, 4), 'bgra8': (np.uint8, 4),
+             'mono8': (np.uint8, 1), '8UC1': (np.uint8, 1),
+             'mono16': (np.uint16, 1), '16UC1': (np.uint16, 1)}
+
+
+def topic_folder(topic):
+    # /device_0/sensor_1/Color_0/image/data -> Color_0; anything else -> its path with underscores
+    parts = topic.strip('/').split('/')
+    if len(parts) == 5 and parts[3:] == ['image', 'data']:
+        return parts[2]
+    return '_'.join(parts)
+
+
+def decode_image(msg):
+    # sensor_msgs/Image -> numpy array (bgr for color, so cv2 writes the right colors)
+    dtype, channels = ENCODINGS.get(msg.encoding, (np.uint8, msg.step // max(msg.width, 1)))
+    dtype = np.dtype(dtype).newbyteorder('>' if msg.is_bigendian else '<')
+    image = np.frombuffer(msg.data, dtype=dtype).reshape(msg.height, msg.step // dtype.itemsize)
+    image = image[:, :msg.width * channels]
+    if channels > 1:
+        image = image.reshape(msg.height, msg.width, channels)
+    if msg.encoding == 'rgb8':
+        image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+    elif msg.encoding == 'rgba8':
+        image = cv2.cvtColor(image, cv2.COLOR_RGBA2BGRA)
+    return image.astype(dtype.newbyteorder('='), copy=False)
+
+
+def read_messages(bag, topics, start_seq=None, end_seq=None, start_sec=None, end_sec=None):
+    # yields (topic, seq, msg) for the selected range; time limits are seconds from the start of the bag
+    start_time = end_time = None
+    if start_sec is not None:
+        start_time = rospy.Time.from_sec(bag.get_start_time() + start_sec)
+    if end_sec is not None:
+        end_time = rospy.Time.from_sec(bag.get_start_time() + end_sec)
+
+    for topic, msg, t in bag.read_messages(topics=topics, start_time=start_time, end_time=end_time):
+        seq = msg.header.seq
+        if start_seq is not None and seq < start_seq:
+            continue
+        if end_seq is not None and seq > end_seq:
+            continue
+        yield topic, seq, msg
+
+
+def extract(bag_file, output_dir, topics, output_format="png", start_seq=None, end_seq=None,
+            start_sec=None, end_sec=None, decode_workers=DECODE_WORKERS, writer_workers=WRITER_WORKERS,
+            shard_size=SHARD_SIZE):
+    """Extract the images of each topic; returns {topic: images written}."""
+    folders = {topic: os.path.join(output_dir, topic_folder(topic)) for topic in topics}
+    for folder in folders.values():
+        os.makedirs(folder, exist_ok=True)
+
+    shard_writers = None
+    if output_format == "shards":
+        shard_writers = {topic: ShardWriter(folders[topic], name="images", shard_size=shard_size)
+                         for topic in topics}
+
+    counts = {topic: 0 for topic in topics}
+    written_bytes = [0]
+    lock = threading.Lock()
+    sequence = {topic: 0 for topic in topics}
+
+    def source(bag):
+        # per-topic order numbers keep shard rows in bag order even though workers finish out of order
+        for topic, seq, msg in read_messages(bag, topics, start_seq, end_seq, start_sec, end_sec):
+            order = sequence[topic]
+            sequence[topic] += 1
+            yield topic, order, seq, msg
+
+    def decode_stage(item):
+        topic, order, seq, msg = item
+        try:
+            return topic, order, seq, decode_image(msg)
+        except Exception:
+            if shard_writers is not None:
+                shard_writers[topic].skip(order)
+            raise
+
+    def write_stage(item):
+        topic, order, seq, image = item
+        if shard_writers is not None:
+            shard_writers[topic].add(image, seq, 0, 0, 0.0, seq=order)
+        else:
+            ok, data = cv2.imencode(".png", image)
+            if not ok:
+                raise ValueError(f"could not encode {topic} frame {seq}")
+            data.tofile(os.path.join(folders[topic], f"{seq:09d}.png"))
+            with lock:
+                written_bytes[0] += len(data)
+        with lock:
+            counts[topic] += 1
+
+    stages = StagePipeline([("decode", decode_stage, decode_workers),
+                            ("write", write_stage, writer_workers)], queue_size=QUEUE_SIZE)
+
+    start = time.time()
+    bag = rosbag.Bag(bag_file, "r")
+    try:
+        stages.run(source(bag))
+    finally:
+        bag.close()
+        if shard_writers is not None:
+            for shard_writer in shard_writers.values():
+                shard_writer.close()
+
+    elapsed = time.time() - start
+    total = sum(counts.values())
+    stages.print_report(os.path.basename(bag_file))
+    for topic, count in counts.items():
+        print(f"  {topic}: {count} images -> {folders[topic]}")
+    rate = total / elapsed if elapsed > 0 else 0.0
+    print(f"Extracted {total} images in {elapsed:.1f}s ({rate:.1f} images/sec", end="")
+    if written_bytes[0]:
+        print(f", {written_bytes[0] / elapsed / 1e6 if elapsed > 0 else 0.0:.1f} MB/sec written)")
+    else:
+        print(")")
+    return counts
 
 
 def main():
@@ -13,62 +160,22 @@ def main():
     """
     parser = argparse.ArgumentParser(description="Extract images from a ROS bag.")
     parser.add_argument("bag_file", help="Input ROS bag.")
-    parser.add_argument("output_dir", help="Output directory.")
-    parser.add_argument("image_topic", help="Image topic.")
-
-    bag_file = None
-    img_topic = None
-    output_path = None
-    args = None
-
-    try:
-        args = parser.parse_args()
-        bag_file = args.bag_file
-        img_topic = args.image_topic
-        output_path = args.output_dir
-    except SystemExit as e:
-        print(f"callback exception: {e}")
-        pass
-
-    if bag_file is None:
-        bag_file = '/media/internal/data/cloning_20230127-152424.bag'
-
-    if img_topic is None:
-        #img_topic =('/device_0/sensor_0/Depth_0/image/data')
-        img_topic = ('/device_0/sensor_1/Color_0/image/data')
-
-    if output_path is None:
-        output_path = "/media/internal/data/cloning_20230127-152424"
-
-    print("Extract images from %s on topic %s into %s" % (bag_file,
-                                                          img_topic, output_path))
-
-    bag = rosbag.Bag(bag_file, "r")
-    bridge = CvBridge()
-    count = 0
-
-    topics = bag.get_type_and_topic_info()
-
-    for topic, msg, t in bag.read_messages(topics=[img_topic]):
-        #cv_img = bridge.imgmsg_to_cv2(msg, desired_encoding="passthrough")
-
-        encoding = msg.encoding
-
-        if encoding=="mono16":
-            cv_img = np.frombuffer(msg.data, dtype=np.uint16).reshape(msg.height, msg.width, -1)
-        else:
-            cv_img = np.frombuffer(msg.data, dtype=np.uint8).reshape(msg.height, msg.width, -1)
-
-        file_name = output_path+f"_{msg.header.seq}"+".png"
-
-        cv2.imwrite(file_name, cv_img)
-        print("Wrote image %i" % count)
-
-        count += 1
-
-    bag.close()
-
-    return
+    parser.add_argument("output_dir", help="Output directory (one sub folder per topic).")
+    parser.add_argument("-t", "--topic", action="append", default=None,
+                        help=f"Image topic; repeat for several (default {COLOR_TOPIC}).")
+    parser.add_argument("--start-seq", type=int, default=None, help="First frame number (header.seq) to extract.")
+    parser.add_argument("--end-seq", type=int, default=None, help="Last frame number (header.seq) to extract.")
+    parser.add_argument("--start", type=float, default=None, help="Start, in seconds from the start of the bag.")
+    parser.add_argument("--end", type=float, default=None, help="End, in seconds from the start of the bag.")
+    parser.add_argument("--format", type=str, default="png", choices=["png", "shards"],
+                        help="Write png files or packed shards.")
+    parser.add_argument("-w", "--workers", type=int, default=WRITER_WORKERS, help="Encoder/writer threads.")
+    args = parser.parse_args()
+
+    topics = args.topic or [COLOR_TOPIC]
+    print("Extract images from %s on topics %s into %s" % (args.bag_file, ", ".join(topics), args.output_dir))
+    extract(args.bag_file, args.output_dir, topics, args.format, args.start_seq, args.end_seq,
+            args.start, args.end, writer_workers=args.workers)
 
 
 if __name__ == '__main__':
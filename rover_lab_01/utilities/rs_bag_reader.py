@@ -0,0 +1,392 @@
+"""
+rs_bag_reader.py
+
+Reads RealSense .bag recordings (rosbag v2 container) directly, without a librealsense
+playback device: no pipeline start-up sleeps, no timeouts, random access by frame number,
+and any number of readers on the same file.
+
+The file is memory-mapped. On open we read the bag header, the connection records and the
+chunk info records at the end of the file (the "chunk index"). build_index(topic) walks the
+index data records that follow each chunk and returns a frame number -> (chunk, offset, time)
+table, so image(topic, frame) can return a frame as a numpy view straight into the mapped
+file (uncompressed chunks, which is what librealsense writes) without copying.
+
+Chunks are independent, so workers can decode disjoint chunk ranges of one bag at the same
+time; see chunk_ranges() and map_chunk_ranges().
+
+rosbag v2 format: http://wiki.ros.org/Bags/Format/2.0
+"""
+
+import argparse
+import bz2
+import mmap
+import multiprocessing
+import os
+import struct
+import numpy as np
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+BAG_MAGIC = b"#ROSBAG V2.0\n"
+
+# record op codes
+OP_MSG_DATA = 0x02
+OP_BAG_HEADER = 0x03
+OP_INDEX_DATA = 0x04
+OP_CHUNK = 0x05
+OP_CHUNK_INFO = 0x06
+OP_CONNECTION = 0x07
+
+# topics librealsense writes for the D4xx color and depth streams
+COLOR_TOPIC = "/device_0/sensor_1/Color_0/image/data"
+DEPTH_TOPIC = "/device_0/sensor_0/Depth_0/image/data"
+
+# sensor_msgs/Image encodings -> (numpy dtype, channels)
+ENCODINGS = {'rgb8': (np.uint8, 3), 'bgr8': (np.uint8, 3),
+             'rgba8': (np.uint8, 4), 'bgra8': (np.uint8, 4),
+             'mono8': (np.uint8, 1), '8UC1': (np.uint8, 1),
+             'mono16': (np.uint16, 1), '16UC1': (np.uint16, 1),
+             'yuv422': (np.uint8, 2)}
+
+# one row per message of a topic, sorted by frame number
+INDEX_DTYPE = np.dtype([('frame', '<i8'), ('time', '<i8'), ('chunk', '<i4'), ('offset', '<i8')])
+
+# frame indexes saved next to the bag by cached_index(): run.bag -> run.bag.index.npz
+INDEX_CACHE_SUFFIX = ".index.npz"
+
+
+def index_cache_path(bag_path):
+    return bag_path + INDEX_CACHE_SUFFIX
+
+
+def _read_header(buf, pos):
+    # a record header is a uint32 length followed by name=value fields, each with its own uint32 length
+    (header_len,) = struct.unpack_from("<I", buf, pos)
+    pos += 4
+    end = pos + header_len
+    fields = {}
+    while pos < end:
+        (field_len,) = struct.unpack_from("<I", buf, pos)
+        pos += 4
+        field = bytes(buf[pos:pos + field_len])
+        name, value = field.split(b"=", 1)
+        fields[name.decode()] = value
+        pos += field_len
+    return fields, end
+
+
+def _read_record(buf, pos):
+    # returns (header fields, data offset, data length, offset of the next record)
+    fields, pos = _read_header(buf, pos)
+    (data_len,) = struct.unpack_from("<I", buf, pos)
+    pos += 4
+    return fields, pos, data_len, pos + data_len
+
+
+def _u32(value):
+    return struct.unpack("<I", value)[0]
+
+
+def _u64(value):
+    return struct.unpack("<Q", value)[0]
+
+
+def _time(value):
+    # ros time is two uint32s (sec, nsec); keep it as integer nanoseconds
+    sec, nsec = struct.unpack("<II", value)
+    return sec * 1000000000 + nsec
+
+
+class BagReader:
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mm[:len(BAG_MAGIC)] != BAG_MAGIC:
+            raise ValueError(f"{path} is not a rosbag v2.0 file")
+
+        self.connections = {}
+        self.chunks = []
+        self._chunk_cache = (None, None)
+        self._indexes = {}
+        self._read_index()
+
+    def close(self):
+        self._chunk_cache = (None, None)
+        self._indexes = {}
+        try:
+            self.mm.close()
+        except BufferError:
+            # numpy views into the file are still alive; the map closes when they are released
+            pass
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _read_index(self):
+        fields, data_pos, data_len, pos = _read_record(self.mm, len(BAG_MAGIC))
+        if fields['op'][0] != OP_BAG_HEADER:
+            raise ValueError(f"{self.path}: missing bag header record")
+        index_pos = _u64(fields['index_pos'])
+        if index_pos == 0:
+            raise ValueError(f"{self.path}: bag was not closed properly (no index); reindex it first")
+        conn_count = _u32(fields['conn_count'])
+        chunk_count = _u32(fields['chunk_count'])
+
+        pos = index_pos
+        for _ in range(conn_count):
+            fields, data_pos, data_len, pos = _read_record(self.mm, pos)
+            conn = _u32(fields['conn'])
+            # the record data is another header block holding type, md5sum, message_definition...
+            details = self._read_fields(data_pos, data_len)
+            self.connections[conn] = {'topic': fields['topic'].decode(),
+                                      'type': details.get('type', b'').decode()}
+
+        for _ in range(chunk_count):
+            fields, data_pos, data_len, pos = _read_record(self.mm, pos)
+            counts = {}
+            for i in range(_u32(fields['count'])):
+                conn, count = struct.unpack_from("<II", self.mm, data_pos + i * 8)
+                counts[conn] = count
+            self.chunks.append({'pos': _u64(fields['chunk_pos']),
+                                'start_time': _time(fields['start_time']),
+                                'end_time': _time(fields['end_time']),
+                                'counts': counts})
+
+    def _read_fields(self, pos, length):
+        fields = {}
+        end = pos + length
+        while pos < end:
+            (field_len,) = struct.unpack_from("<I", self.mm, pos)
+            pos += 4
+            name, value = bytes(self.mm[pos:pos + field_len]).split(b"=", 1)
+            fields[name.decode()] = value
+            pos += field_len
+        return fields
+
+    def topics(self):
+        """{topic: message count} for every topic in the bag."""
+        topics = {}
+        for chunk in self.chunks:
+            for conn, count in chunk['counts'].items():
+                topic = self.connections[conn]['topic']
+                topics[topic] = topics.get(topic, 0) + count
+        return topics
+
+    def _topic_conns(self, topic):
+        conns = {conn for conn, c in self.connections.items() if c['topic'] == topic}
+        if not conns:
+            raise KeyError(f"{self.path} has no topic {topic}")
+        return conns
+
+    def chunk_data(self, chunk_idx):
+        """The uncompressed records of one chunk; a zero-copy memoryview for uncompressed chunks."""
+        if self._chunk_cache[0] == chunk_idx:
+            return self._chunk_cache[1]
+
+        fields, data_pos, data_len, _ = _read_record(self.mm, self.chunks[chunk_idx]['pos'])
+        compression = fields['compression'].decode()
+        if compression == 'none':
+            data = memoryview(self.mm)[data_pos:data_pos + data_len]
+        elif compression == 'bz2':
+            data = memoryview(bz2.decompress(self.mm[data_pos:data_pos + data_len]))
+        elif compression == 'lz4':
+            if lz4_frame is None:
+                raise ImportError("lz4 compressed bag; install the lz4 package to read it")
+            data = memoryview(lz4_frame.decompress(self.mm[data_pos:data_pos + data_len]))
+        else:
+            raise ValueError(f"unsupported chunk compression: {compression}")
+
+        self._chunk_cache = (chunk_idx, data)
+        return data
+
+    def _chunk_index_entries(self, chunk_idx, conns):
+        # index data records follow the chunk record: one per connection, (time, offset) per message
+        chunk = self.chunks[chunk_idx]
+        _, _, _, pos = _read_record(self.mm, chunk['pos'])
+        entries = []
+        for _ in range(len(chunk['counts'])):
+            fields, data_pos, data_len, pos = _read_record(self.mm, pos)
+            if fields['op'][0] != OP_INDEX_DATA:
+                break
+            if _u32(fields['conn']) not in conns:
+                continue
+            count = _u32(fields['count'])
+            entry = np.frombuffer(self.mm, dtype=np.dtype([('sec', '<u4'), ('nsec', '<u4'), ('offset', '<u4')]),
+                                  count=count, offset=data_pos)
+            entries.append(entry.copy())
+        return entries
+
+    def build_index(self, topic, chunks=None):
+        """
+        frame number -> (time, chunk, offset) table for one image topic, sorted by frame.
+        time is the image header stamp in ns (the frame timestamp librealsense recorded);
+        offset is where the serialized message starts inside the uncompressed chunk.
+        """
+        whole_bag = chunks is None
+        if whole_bag and topic in self._indexes:
+            return self._indexes[topic]
+
+        conns = self._topic_conns(topic)
+        if whole_bag:
+            chunks = range(len(self.chunks))
+
+        rows = []
+        for chunk_idx in chunks:
+            if not conns.intersection(self.chunks[chunk_idx]['counts']):
+                continue
+            data = None
+            for entries in self._chunk_index_entries(chunk_idx, conns):
+                if data is None:
+                    data = self.chunk_data(chunk_idx)
+                for sec, nsec, offset in entries.tolist():
+                    # skip the message record header; the message starts with header.seq and
+                    # header.stamp (the frame's own timestamp, same as decode_image returns)
+                    _, msg_pos, _, _ = _read_record(data, offset)
+                    seq, stamp_sec, stamp_nsec = struct.unpack_from("<III", data, msg_pos)
+                    rows.append((seq, stamp_sec * 1000000000 + stamp_nsec, chunk_idx, msg_pos))
+
+        index = np.array(rows, dtype=INDEX_DTYPE)
+        index.sort(order='frame')
+        if whole_bag:
+            self._indexes[topic] = index
+        return index
+
+    def cached_index(self, topic):
+        """
+        build_index(topic), saved next to the bag the first time and loaded from there after that.
+        The cache holds every topic indexed so far and is rebuilt when the bag's size or
+        modification time changes. If it cannot be written (read-only media) we just rebuild
+        the index next time.
+        """
+        if topic in self._indexes:
+            return self._indexes[topic]
+
+        cache_path = index_cache_path(self.path)
+        stat = os.stat(self.path)
+        indexes = {}
+        try:
+            with np.load(cache_path) as cache:
+                if int(cache['size']) == stat.st_size and int(cache['mtime_ns']) == stat.st_mtime_ns:
+                    indexes = {str(name): cache[f"index_{i}"] for i, name in enumerate(cache['topics'])}
+        except (OSError, KeyError, ValueError):
+            indexes = {}
+        indexes = {name: index for name, index in indexes.items() if index.dtype == INDEX_DTYPE}
+
+        if topic in indexes:
+            self._indexes[topic] = indexes[topic]
+            return indexes[topic]
+
+        indexes[topic] = self.build_index(topic)
+        names = sorted(indexes)
+        tmp_path = cache_path + ".tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, topics=np.array(names), size=stat.st_size, mtime_ns=stat.st_mtime_ns,
+                         **{f"index_{i}": indexes[name] for i, name in enumerate(names)})
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            print(f"Could not save the frame index to {cache_path}: {e}")
+        return indexes[topic]
+
+    def decode_image(self, chunk_idx, offset):
+        """
+        Decode the sensor_msgs/Image at offset in a chunk.
+        Returns (frame number, header time in ns, encoding, image view with shape (h, w[, c])).
+        """
+        data = self.chunk_data(chunk_idx)
+        seq, sec, nsec = struct.unpack_from("<III", data, offset)
+        pos = offset + 12
+        (frame_id_len,) = struct.unpack_from("<I", data, pos)
+        pos += 4 + frame_id_len
+        height, width, encoding_len = struct.unpack_from("<III", data, pos)
+        pos += 12
+        encoding = bytes(data[pos:pos + encoding_len]).decode()
+        pos += encoding_len
+        is_bigendian, step, data_len = struct.unpack_from("<BII", data, pos)
+        pos += 9
+
+        dtype, channels = ENCODINGS.get(encoding, (np.uint8, step // max(width, 1)))
+        dtype = np.dtype(dtype).newbyteorder('>' if is_bigendian else '<')
+        # a view into the mapped file (or the decompressed chunk); nothing is copied
+        image = np.frombuffer(data, dtype=dtype, count=data_len // dtype.itemsize, offset=pos)
+        if channels == 1:
+            image = image.reshape(height, step // dtype.itemsize)[:, :width]
+        else:
+            image = image.reshape(height, step // dtype.itemsize)[:, :width * channels].reshape(height, width, channels)
+        return seq, sec * 1000000000 + nsec, encoding, image
+
+    def image(self, topic, frame):
+        """(encoding, image view) for one frame number of a topic."""
+        index = self.build_index(topic)
+        row = np.searchsorted(index['frame'], frame)
+        if row >= len(index) or index['frame'][row] != frame:
+            raise KeyError(f"frame {frame} not found in {topic}")
+        _, _, encoding, image = self.decode_image(int(index['chunk'][row]), int(index['offset'][row]))
+        return encoding, image
+
+    def iter_images(self, topic, chunk_range=None):
+        """Yield (frame, time ns, encoding, image view) in file order, optionally for chunks [start, end)."""
+        chunks = range(len(self.chunks)) if chunk_range is None else range(*chunk_range)
+        index = self.build_index(topic, chunks=chunks)
+        order = np.lexsort((index['offset'], index['chunk']))
+        for row in index[order]:
+            yield self.decode_image(int(row['chunk']), int(row['offset']))
+
+    def chunk_ranges(self, topic, parts):
+        """Split the chunks into up to `parts` contiguous [start, end) ranges with similar message counts."""
+        conns = self._topic_conns(topic)
+        counts = np.array([sum(c['counts'].get(conn, 0) for conn in conns) for c in self.chunks])
+        if len(counts) == 0:
+            return []
+        bounds = np.searchsorted(np.cumsum(counts), np.linspace(0, counts.sum(), parts + 1)[1:-1], side='right')
+        edges = [0] + sorted(set(int(b) for b in bounds if 0 < b < len(counts))) + [len(counts)]
+        return [(edges[i], edges[i + 1]) for i in range(len(edges) - 1)]
+
+
+def _map_worker(job):
+    # each worker opens its own reader; the operating system shares the mapped pages
+    path, topic, chunk_range, func = job
+    with BagReader(path) as reader:
+        return [func(frame, time_ns, encoding, image)
+                for frame, time_ns, encoding, image in reader.iter_images(topic, chunk_range)]
+
+
+def map_chunk_ranges(path, topic, func, workers=None):
+    """
+    Decode one topic of a bag with a process pool, each worker handling its own chunk range.
+    func(frame, time_ns, encoding, image) must be a module-level function; results come back
+    in file order.
+    """
+    workers = workers or os.cpu_count() or 1
+    with BagReader(path) as reader:
+        ranges = reader.chunk_ranges(topic, workers)
+
+    jobs = [(path, topic, chunk_range, func) for chunk_range in ranges]
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(processes=max(len(jobs), 1)) as pool:
+        results = pool.map(_map_worker, jobs)
+    return [r for part in results for r in part]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize a RealSense bag without librealsense.")
+    parser.add_argument("-f", "--input", type=str, required=True, help="Bag file to read")
+    args = parser.parse_args()
+
+    with BagReader(args.input) as reader:
+        print(f"{args.input}: {len(reader.chunks)} chunks, {len(reader.connections)} connections")
+        for topic, count in sorted(reader.topics().items()):
+            print(f"  {topic}: {count} messages")
+        for topic in (COLOR_TOPIC, DEPTH_TOPIC):
+            if topic in reader.topics():
+                index = reader.build_index(topic)
+                print(f"{topic}: frames {index['frame'][0]}..{index['frame'][-1]} ({len(index)} indexed)")
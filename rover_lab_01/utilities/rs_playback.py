@@ -0,0 +1,100 @@
+"""
+rs_playback.py
+
+Helpers for reading RealSense .bag recordings through a librealsense playback device.
+
+With real_time=False the playback device hands over every recorded frame, in order,
+as fast as the caller can consume them (no frames are dropped when processing falls
+behind, and conversion is not capped at the recorded 30 fps).
+"""
+
+import pyrealsense2.pyrealsense2 as rs
+
+# How long to wait for a frame before checking whether playback reached end-of-file
+DEFAULT_TIMEOUT_MS = 1000
+
+# Give up if playback claims to be playing but stops producing frames for this many waits
+MAX_EMPTY_WAITS = 10
+
+
+def new_stats():
+    # frames read from the bag, frames matched to telemetry, and frames missing
+    # from the recorded frame number sequence
+    return {'read': 0, 'matched': 0, 'dropped': 0}
+
+
+def open_bag(path, streams, real_time=False):
+    """Start a pipeline on a bag file; streams is a list of enable_stream() argument tuples."""
+    config = rs.config()
+
+    # repeat_playback=False so the device stops at the end of the file
+    rs.config.enable_device_from_file(config, path, False)
+    for stream in streams:
+        config.enable_stream(*stream)
+
+    pipeline = rs.pipeline()
+    profile = pipeline.start(config)
+
+    playback = profile.get_device().as_playback()
+    playback.set_real_time(real_time)
+    return pipeline, playback
+
+
+def close_bag(pipeline, playback):
+    """Stop playback and the pipeline, ignoring a device that already stopped itself."""
+    try:
+        if playback is not None \
+                and playback.current_status() == rs.playback_status.playing:
+            playback.pause()
+    except RuntimeError:
+        pass
+
+    try:
+        if pipeline is not None:
+            pipeline.stop()
+    except RuntimeError:
+        pass
+
+
+def iter_frames(pipeline, playback, stats=None, timeout_ms=DEFAULT_TIMEOUT_MS):
+    """
+    Yield framesets in recorded order until the end of the file.
+    Updates stats['read'] and stats['dropped'] (gaps in the color frame numbers).
+    """
+    if stats is None:
+        stats = new_stats()
+
+    last_frm_num = None
+    empty_waits = 0
+
+    while True:
+        success, frames = pipeline.try_wait_for_frames(timeout_ms)
+        if not success:
+            # end of file: the playback device stops itself when repeat_playback is off
+            if playback.current_status() == rs.playback_status.stopped:
+                break
+            empty_waits += 1
+            if empty_waits >= MAX_EMPTY_WAITS:
+                print(f"No frames for {empty_waits * timeout_ms / 1000:.1f}s; assuming end of file.")
+                break
+            continue
+        empty_waits = 0
+
+        color_frame = frames.get_color_frame()
+        if color_frame:
+            frm_num = int(color_frame.frame_number)
+            if last_frm_num is not None:
+                if frm_num <= last_frm_num:
+                    # frame numbers went backwards; playback looped around
+                    break
+                stats['dropped'] += frm_num - last_frm_num - 1
+            last_frm_num = frm_num
+
+        stats['read'] += 1
+        yield frames
+
+
+def print_stats(file_name, stats):
+    print(f"{file_name}: frames read: {stats['read']}, "
+          f"matched to telemetry: {stats['matched']}, "
+          f"dropped: {stats['dropped']}")
@@ -0,0 +1,149 @@
+"""
+sample_manifest.py
+
+Dataset manifest for png training samples: the file name, frame number and labels of every
+sample under a root folder, kept in one .npz file in that root folder (one manifest per
+sample pattern, e.g. manifest_BW.png.npz for "*_BW.png").
+
+Without it every training start globs every run folder and the batch generator re-checks
+and re-parses every file name on every epoch, which is slow on network storage. With it a
+start is one scandir of the root folder plus one stat per run folder: folders whose mtime
+is unchanged keep their manifest rows, and only new or changed folders are globbed again.
+Adding, removing or renaming files in a run folder changes its mtime.
+
+load_samples() returns the samples as one structured array (SAMPLE_DTYPE) instead of a list
+of path strings, so labels come from the array and nothing is parsed per epoch.
+"""
+
+import glob
+import os
+import re
+import numpy as np
+
+# one row per sample in the manifest file; folder indexes the manifest's folder list
+MANIFEST_DTYPE = np.dtype([('folder', '<i4'), ('name', 'S64'), ('frame', '<i8'),
+                           ('throttle', '<i4'), ('steering', '<i4'), ('heading', '<f4')])
+
+
+def manifest_path(root_folder, ends_with):
+    # "*_BW.png" -> <root>/manifest_BW.png.npz
+    key = re.sub(r"[^A-Za-z0-9.]+", "_", ends_with).strip("_.")
+    return os.path.join(root_folder, f"manifest_{key}.npz")
+
+
+def sample_dtype(path_len):
+    # samples handed to training: full path (bytes, os.fsencode) plus the parsed labels
+    return np.dtype([('path', f'S{max(path_len, 1)}'), ('frame', '<i8'),
+                     ('throttle', '<i4'), ('steering', '<i4'), ('heading', '<f4')])
+
+
+def parse_sample_name(file_name):
+    """<frame>_<throttle>_<steering>[_<heading>]_<type>.<ext> -> (frame, throttle, steering, heading)."""
+    attributes = os.path.splitext(file_name)[0].split('_')
+    if len(attributes) < 5:
+        f_num, throttle, steering, f_type = attributes
+        heading = np.nan
+    else:
+        f_num, throttle, steering, heading, f_type = attributes
+        heading = float(heading)
+    return int(f_num), int(throttle), int(steering), heading
+
+
+def scan_folder(folder, ends_with):
+    # manifest rows (folder field left at 0) for the samples of one run folder, in file name order
+    rows = []
+    for path in sorted(glob.glob(os.path.join(folder, ends_with))):
+        name = os.path.basename(path)
+        encoded = os.fsencode(name)
+        if len(encoded) > MANIFEST_DTYPE['name'].itemsize:
+            print(f"Skipping sample with a file name too long for the manifest: {path}")
+            continue
+        try:
+            rows.append((0, encoded) + parse_sample_name(name))
+        except ValueError:
+            print(f"Error parsing labels from filename: {path}; skipping it.")
+    return np.array(rows, dtype=MANIFEST_DTYPE)
+
+
+def _load(path):
+    # {folder name: (mtime_ns, rows)} from a saved manifest, or {} if there is none we can use
+    try:
+        with np.load(path) as manifest:
+            folders, mtimes, rows = manifest['folders'], manifest['mtimes'], manifest['rows']
+    except (OSError, KeyError, ValueError):
+        return {}
+    if rows.dtype != MANIFEST_DTYPE:
+        return {}
+    order = np.argsort(rows['folder'], kind='stable')
+    bounds = np.searchsorted(rows['folder'][order], np.arange(len(folders) + 1))
+    return {str(name): (int(mtime), rows[order[bounds[i]:bounds[i + 1]]])
+            for i, (name, mtime) in enumerate(zip(folders, mtimes))}
+
+
+def _save(path, folders):
+    names = list(folders)
+    parts = []
+    for i, name in enumerate(names):
+        rows = folders[name][1].copy()
+        rows['folder'] = i
+        parts.append(rows)
+    rows = np.concatenate(parts) if parts else np.empty(0, dtype=MANIFEST_DTYPE)
+    tmp_path = path + ".tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, folders=np.array(names, dtype=str), rows=rows,
+                     mtimes=np.array([folders[name][0] for name in names], dtype=np.int64))
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Could not save the dataset manifest {path}: {e}")
+
+
+def refresh_manifest(root_folder, ends_with="*_BW.png"):
+    """
+    {run folder name: (mtime_ns, manifest rows)} for every run folder under root_folder,
+    in os.scandir order. Folders changed since the saved manifest are rescanned, and the
+    manifest is saved again if anything changed.
+    """
+    path = manifest_path(root_folder, ends_with)
+    cached = _load(path)
+    folders = {}
+    changed = False
+    for entry in os.scandir(root_folder):
+        if not entry.is_dir():
+            continue
+        mtime = entry.stat().st_mtime_ns
+        if entry.name in cached and cached[entry.name][0] == mtime:
+            folders[entry.name] = cached[entry.name]
+        else:
+            folders[entry.name] = (mtime, scan_folder(entry.path, ends_with))
+            changed = True
+
+    if changed or set(folders) != set(cached):
+        rescanned = sum(1 for name in folders if name not in cached or cached[name][0] != folders[name][0])
+        print(f"Dataset manifest {os.path.basename(path)}: {rescanned} of {len(folders)} run folders rescanned")
+        _save(path, folders)
+    return folders
+
+
+def load_samples(root_folder, ends_with="*_BW.png"):
+    """
+    Every sample under root_folder as one SAMPLE_DTYPE array, grouped by run folder in
+    scandir order and sorted by file name within a folder (the order glob + sorted gave),
+    and the number of samples in each folder.
+    """
+    folders = refresh_manifest(root_folder, ends_with)
+    parts = [rows for _, rows in folders.values()]
+    sizes = [len(rows) for rows in parts]
+    if not parts or sum(sizes) == 0:
+        return np.empty(0, dtype=sample_dtype(1)), sizes
+
+    rows = np.concatenate(parts)
+    prefixes = np.array([os.fsencode(os.path.join(root_folder, name, "")) for name in folders],
+                        dtype=bytes)
+    paths = np.char.add(np.repeat(prefixes, sizes), rows['name'])
+
+    samples = np.empty(len(rows), dtype=sample_dtype(paths.dtype.itemsize))
+    samples['path'] = paths
+    for field in ('frame', 'throttle', 'steering', 'heading'):
+        samples[field] = rows[field]
+    return samples, sizes
@@ -0,0 +1,206 @@
+"""
+shard_io.py
+
+Packed shard dataset format: instead of one png per frame, a run folder holds a few
+fixed-size shards. Each shard is a pair of .npy files:
+
+    <name>_00000.npy         contiguous image block (uint8, or uint16 for depth), shape (N, H, W) or (N, H, W, C)
+    <name>_00000_labels.npy  label table (frame, throttle, steering, heading), one row per image
+
+Shards are written with np.save and read back with np.load(mmap_mode='r'), so training
+can slice batches straight out of the page cache without per-file opens or png decodes.
+
+Black and white frames (0 or 255 only) can be bit-packed: shards named <product>_bits
+(e.g. bw_bits_00000.npy) hold every 8 pixels of a row in one byte, shape (N, H, W / 8), so a
+run takes 8x less disk and page cache. open_shard() returns them wrapped in PackedImages,
+which looks like the unpacked (N, H, W) uint8 array and unpacks only the rows it is indexed
+with, in one vectorized np.unpackbits call.
+"""
+
+import glob
+import os
+import threading
+import numpy as np
+
+# Frames per shard (the last shard of a run may be shorter)
+SHARD_SIZE = 1024
+
+# Label table layout shared by every shard
+LABEL_DTYPE = np.dtype([('frame', '<i8'), ('throttle', '<i4'), ('steering', '<i4'), ('heading', '<f4')])
+
+# Shards whose name ends with this hold bit-packed black and white frames
+PACKED_SUFFIX = "_bits"
+
+
+def packed_name(name):
+    return name + PACKED_SUFFIX
+
+
+def is_packed(name):
+    return name.endswith(PACKED_SUFFIX)
+
+
+def pack_bits(images):
+    """(..., H, W) black and white images -> (..., H, W / 8) bytes; any nonzero pixel counts as white."""
+    if images.shape[-1] % 8 != 0:
+        raise ValueError(f"bit-packed frames need a width divisible by 8, got {images.shape[-1]}")
+    return np.packbits(images, axis=-1)
+
+
+def unpack_bits(packed):
+    """(..., H, W / 8) packed bytes -> (..., H, W) uint8 images of 0 and 255."""
+    # unpackbits gives 0/1; scaling in place is faster than a byte -> 8 pixel table lookup
+    images = np.unpackbits(packed, axis=-1)
+    images *= 255
+    return images
+
+
+class PackedImages:
+    """
+    Read-only view of a bit-packed shard that behaves like its unpacked (N, H, W) uint8 image
+    block: len(), shape, dtype and indexing (ints, slices, row arrays) return unpacked pixels.
+    """
+
+    def __init__(self, packed):
+        self.packed = packed
+        self.shape = packed.shape[:-1] + (packed.shape[-1] * 8,)
+        self.dtype = np.dtype(np.uint8)
+        self.nbytes = packed.nbytes
+
+    def __len__(self):
+        return len(self.packed)
+
+    def __getitem__(self, rows):
+        return unpack_bits(np.asarray(self.packed[rows]))
+
+
+def shard_paths(folder, name, idx):
+    base = os.path.join(folder, f"{name}_{idx:05d}")
+    return base + ".npy", base + "_labels.npy"
+
+
+def save_atomic(path, array):
+    """np.save through a temp file and a rename, so a crash never leaves a truncated shard behind."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
+
+class ShardWriter:
+    """
+    Buffers frames into a preallocated block and writes a shard every shard_size frames.
+    add() is thread safe. When frames are tagged with a sequence number (their order
+    from the reader) they are written in that order even if they arrive out of order.
+    """
+
+    def __init__(self, folder, name="bw", shard_size=SHARD_SIZE, start_shard=0, on_flush=None, on_skip=None):
+        self.folder = folder
+        # called with the frame numbers of each shard once it is safely on disk
+        self.on_flush = on_flush
+        # called with the frame numbers of frames skipped instead of written (when they are known)
+        self.on_skip = on_skip
+        self.name = name
+        self.packed = is_packed(name)
+        self.shard_size = shard_size
+        self.shard_idx = start_shard
+        self.images = None
+        self.labels = np.zeros(shard_size, dtype=LABEL_DTYPE)
+        self.count = 0
+        self.lock = threading.Lock()
+        self.next_seq = 0
+        self.pending = {}
+        os.makedirs(folder, exist_ok=True)
+
+    def add(self, image, frame, throttle, steering, heading, seq=None):
+        # labels are parsed before queueing, so a bad telemetry row (e.g. an empty heading)
+        # fails here for this frame only instead of inside a later drain
+        try:
+            label = (int(frame), int(float(throttle)), int(float(steering)), float(heading))
+        except (TypeError, ValueError) as e:
+            self.skip(seq, frame)
+            raise ValueError(f"frame {frame}: bad labels ({throttle}, {steering}, {heading}): {e}")
+
+        with self.lock:
+            if seq is None:
+                self._append(image, label)
+                return
+
+            # hold early arrivals until every frame before them has been written
+            self.pending[seq] = (image, label)
+            self._drain()
+
+    def skip(self, seq, frame=None):
+        # a frame that failed to convert and will never arrive
+        with self.lock:
+            if seq is not None and seq >= self.next_seq:
+                self.pending[seq] = None
+                self._drain()
+        self._report_skip(frame)
+
+    def _report_skip(self, frame):
+        if frame is None or self.on_skip is None:
+            return
+        try:
+            self.on_skip([int(frame)])
+        except (TypeError, ValueError):
+            pass
+
+    def _drain(self):
+        while self.next_seq in self.pending:
+            entry = self.pending.pop(self.next_seq)
+            try:
+                if entry is not None:
+                    self._append(*entry)
+            except Exception as e:
+                # written or not, this frame must not hold up the ones behind it
+                print(f"{self.name} shards: skipping frame {entry[1][0]}: {e}")
+                self._report_skip(entry[1][0])
+            finally:
+                self.next_seq += 1
+
+    def _append(self, image, label):
+        if self.packed:
+            image = pack_bits(image)
+        if self.images is None:
+            self.images = np.empty((self.shard_size,) + image.shape, dtype=image.dtype)
+        self.images[self.count] = image
+        self.labels[self.count] = label
+        self.count += 1
+        if self.count == self.shard_size:
+            self._flush()
+
+    def _flush(self):
+        if self.count == 0:
+            return
+        image_path, label_path = shard_paths(self.folder, self.name, self.shard_idx)
+        save_atomic(image_path, self.images[:self.count])
+        save_atomic(label_path, self.labels[:self.count])
+        if self.on_flush is not None:
+            self.on_flush(self.labels['frame'][:self.count].tolist())
+        self.shard_idx += 1
+        self.count = 0
+
+    def close(self):
+        with self.lock:
+            # anything still pending is behind a frame that never arrived; write it in order
+            for seq in sorted(self.pending):
+                if self.pending[seq] is not None:
+                    self._append(*self.pending[seq])
+            self.pending = {}
+            self._flush()
+
+
+def list_shards(folder, name="bw"):
+    """Image paths of the shards in one run folder, in order."""
+    return sorted(p for p in glob.glob(os.path.join(folder, f"{name}_[0-9]*.npy"))
+                  if not p.endswith("_labels.npy"))
+
+
+def open_shard(image_path):
+    """Memory-map one shard; returns (images, labels) without reading the pixels."""
+    images = np.load(image_path, mmap_mode='r')
+    labels = np.load(image_path.replace(".npy", "_labels.npy"))
+    if is_packed(os.path.basename(image_path).rsplit("_", 1)[0]):
+        images = PackedImages(images)
+    return images, labels
@@ -0,0 +1,122 @@
+"""
+stage_pipeline.py
+
+A small staged pipeline: a source iterated on the calling thread feeds one or more
+stages of worker threads, joined by bounded queues. A full queue blocks the stage in
+front of it (backpressure), so a slow encoder can never pile up unbounded frames in memory.
+
+OpenCV releases the GIL inside resize/cvtColor/Canny/imwrite, so threads are enough
+to keep several cores busy with image work.
+"""
+
+import queue
+import threading
+import time
+
+# Default size of the queue in front of each stage
+QUEUE_SIZE = 32
+
+# Marks the end of the stream for a worker
+_DONE = object()
+
+
+class StagePipeline:
+    """
+    stages is a list of (name, func, workers). Each func takes one item and returns
+    the item for the next stage, or None to drop it. The last stage's results are discarded.
+    """
+
+    def __init__(self, stages, queue_size=QUEUE_SIZE):
+        self.stages = stages
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+        self.stats = {'source': self._new_stage_stats(1)}
+        for name, func, workers in stages:
+            self.stats[name] = self._new_stage_stats(workers)
+        self.lock = threading.Lock()
+        self.remaining = [workers for name, func, workers in stages]
+        self.threads = []
+        self.start_time = None
+
+    @staticmethod
+    def _new_stage_stats(workers):
+        # busy is the time spent inside the stage function, summed over its workers
+        return {'workers': workers, 'items': 0, 'errors': 0, 'busy': 0.0, 'wall': 0.0}
+
+    def _worker(self, idx):
+        name, func, workers = self.stages[idx]
+        in_q = self.queues[idx]
+        out_q = self.queues[idx + 1] if idx + 1 < len(self.queues) else None
+        stats = self.stats[name]
+
+        while True:
+            item = in_q.get()
+            if item is _DONE:
+                break
+
+            t0 = time.perf_counter()
+            try:
+                result = func(item)
+            except Exception as e:
+                print(f"{name}: {e}")
+                result = None
+                with self.lock:
+                    stats['errors'] += 1
+            busy = time.perf_counter() - t0
+
+            with self.lock:
+                stats['items'] += 1
+                stats['busy'] += busy
+
+            if out_q is not None and result is not None:
+                out_q.put(result)
+
+        # the last worker of a stage to finish tells every worker of the next stage
+        with self.lock:
+            self.remaining[idx] -= 1
+            last = self.remaining[idx] == 0
+            if last:
+                stats['wall'] = time.perf_counter() - self.start_time
+        if last and out_q is not None:
+            for _ in range(self.stages[idx + 1][2]):
+                out_q.put(_DONE)
+
+    def run(self, source):
+        """Feed every item of source through the stages and wait for them to drain."""
+        self.start_time = time.perf_counter()
+        for idx, (name, func, workers) in enumerate(self.stages):
+            for w in range(workers):
+                t = threading.Thread(target=self._worker, args=(idx,), name=f"{name}-{w}", daemon=True)
+                t.start()
+                self.threads.append(t)
+
+        source_stats = self.stats['source']
+        iterator = iter(source)
+        try:
+            while True:
+                t0 = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                source_stats['busy'] += time.perf_counter() - t0
+                source_stats['items'] += 1
+
+                # blocks while the first stage is backed up
+                self.queues[0].put(item)
+        finally:
+            source_stats['wall'] = time.perf_counter() - self.start_time
+            for _ in range(self.stages[0][2]):
+                self.queues[0].put(_DONE)
+            for t in self.threads:
+                t.join()
+
+        return self.stats
+
+    def print_report(self, label=""):
+        # items/sec per worker shows each stage's own speed; effective is what the pipeline saw
+        print(f"{label} stage throughput:")
+        for name, s in self.stats.items():
+            per_worker = s['items'] / s['busy'] if s['busy'] > 0 else 0.0
+            effective = s['items'] / s['wall'] if s['wall'] > 0 else 0.0
+            print(f"  {name:<10} workers: {s['workers']:>2}  items: {s['items']:>7}  errors: {s['errors']:>4}  "
+                  f"{per_worker:8.1f} items/sec/worker  {effective:8.1f} items/sec")
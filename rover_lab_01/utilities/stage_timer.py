@@ -0,0 +1,124 @@
+"""
+stage_timer.py
+
+Per-stage latency histograms for hot loops (e.g. the bag conversion loop).
+
+Each stage gets a fixed set of log-spaced buckets (1 us to 100 s, 20 per decade), so memory
+does not grow with the number of frames and percentiles are accurate to about 12%.
+Usage in a loop:
+
+    timers = StageTimers(["wait", "transform"], enabled=True)
+    t0 = timers.stamp()
+    ...
+    t0 = timers.record("wait", t0)      # records the time since t0, returns a new stamp
+
+When disabled, stamp() and record() return straight away without reading the clock,
+so the instrumentation can stay in the loop permanently.
+"""
+
+import json
+import math
+import signal
+import threading
+import time
+import numpy as np
+
+# bucket edges: 20 per decade from 1 us to 100 s
+BUCKETS_PER_DECADE = 20
+MIN_SECONDS = 1e-6
+NUM_BUCKETS = 8 * BUCKETS_PER_DECADE + 1
+BUCKET_EDGES = MIN_SECONDS * 10 ** (np.arange(NUM_BUCKETS + 1) / BUCKETS_PER_DECADE)
+
+PERCENTILES = (50, 95, 99)
+
+
+class LatencyHistogram:
+    def __init__(self):
+        self.counts = [0] * NUM_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, seconds, n=1):
+        # n samples of the same duration (e.g. a batch time split over its frames)
+        if seconds <= MIN_SECONDS:
+            idx = 0
+        else:
+            idx = min(int(math.log10(seconds / MIN_SECONDS) * BUCKETS_PER_DECADE), NUM_BUCKETS - 1)
+        with self.lock:
+            self.counts[idx] += n
+            self.count += n
+            self.total += seconds * n
+            if seconds > self.max:
+                self.max = seconds
+
+    def percentile(self, p):
+        # upper edge of the bucket holding the p-th percentile sample (never more than max)
+        if self.count == 0:
+            return 0.0
+        target = self.count * p / 100.0
+        cumulative = np.cumsum(self.counts)
+        idx = int(np.searchsorted(cumulative, target))
+        return min(float(BUCKET_EDGES[min(idx, NUM_BUCKETS - 1) + 1]), self.max)
+
+    def summary(self):
+        result = {'count': self.count,
+                  'mean_ms': self.total / self.count * 1000 if self.count else 0.0,
+                  'max_ms': self.max * 1000}
+        for p in PERCENTILES:
+            result[f'p{p}_ms'] = self.percentile(p) * 1000
+        return result
+
+
+class StageTimers:
+    def __init__(self, stages, enabled=True):
+        self.enabled = enabled
+        self.histograms = {stage: LatencyHistogram() for stage in stages}
+
+    def stamp(self):
+        if not self.enabled:
+            return 0.0
+        return time.perf_counter()
+
+    def record(self, stage, start, n=1):
+        """Record the time since start for stage (split over n items); returns a new stamp."""
+        if not self.enabled:
+            return 0.0
+        now = time.perf_counter()
+        self.histograms[stage].add((now - start) / n, n)
+        return now
+
+    def summary(self):
+        return {stage: h.summary() for stage, h in self.histograms.items() if h.count > 0}
+
+    def print_report(self, label=""):
+        if not self.enabled:
+            return
+        print(f"{label} stage latency (ms):")
+        for stage, s in self.summary().items():
+            print(f"  {stage:<10} count: {s['count']:>7}  mean: {s['mean_ms']:8.2f}  p50: {s['p50_ms']:8.2f}  "
+                  f"p95: {s['p95_ms']:8.2f}  p99: {s['p99_ms']:8.2f}  max: {s['max_ms']:8.2f}")
+
+    def save(self, path):
+        if not self.enabled:
+            return
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+
+def report_on_signal(get_timers, label=""):
+    """
+    Print the current report whenever the process receives SIGUSR1 (kill -USR1 <pid>).
+    get_timers returns the StageTimers in use right now (or None). Must be called from the
+    main thread; does nothing on platforms without SIGUSR1.
+    """
+    if not hasattr(signal, "SIGUSR1"):
+        return
+
+    def handler(signum, frame):
+        timers = get_timers()
+        if timers is not None:
+            timers.print_report(label)
+
+    signal.signal(signal.SIGUSR1, handler)
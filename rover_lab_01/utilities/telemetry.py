@@ -0,0 +1,123 @@
+"""
+telemetry.py
+
+Loads rover telemetry logs (the .csv rs_rover_collect writes next to each .bag) and joins
+them to camera frames.
+
+Logs written since the timestamp column was added carry the host time each row was read,
+so frames can be matched to the telemetry row nearest in time instead of needing a row with
+exactly the same frame number. The join is a sorted-array search (np.searchsorted) over
+the whole run at once, O((frames + rows) log rows); throttle and steering can optionally be
+linearly interpolated between the two rows around each frame.
+
+Frame times come from the image header stamps in the bag (see rs_bag_reader), which
+librealsense records in host time when global timestamps are enabled (the D4xx default).
+"""
+
+import csv
+import numpy as np
+from utilities.rs_bag_reader import BagReader, COLOR_TOPIC
+
+# Largest gap (seconds) between a frame and its telemetry row; one frame is 1/30 s
+DEFAULT_TOLERANCE = 0.05
+
+# one row per telemetry sample, sorted by timestamp (NaN when the log has no timestamps)
+TELEM_DTYPE = np.dtype([('frame', '<i8'), ('timestamp', '<f8'),
+                        ('throttle', '<f8'), ('steering', '<f8'), ('heading', '<f8')])
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def load_telemetry(path):
+    """Telemetry log as a TELEM_DTYPE array; rows without a frame number, throttle or steering are dropped."""
+    rows = []
+    with open(path, 'r') as f:
+        for row in csv.DictReader(f):
+            try:
+                rows.append((int(row['index']), _to_float(row.get('timestamp')),
+                             float(row['throttle']), float(row['steering']), _to_float(row['heading'])))
+            except (TypeError, ValueError):
+                # partial rows (e.g. recording stopped mid-write)
+                continue
+
+    telem = np.array(rows, dtype=TELEM_DTYPE)
+    if has_timestamps(telem):
+        telem = telem[~np.isnan(telem['timestamp'])]
+        telem = telem[np.argsort(telem['timestamp'], kind='stable')]
+    return telem
+
+
+def has_timestamps(telem):
+    return len(telem) > 0 and not np.isnan(telem['timestamp']).all()
+
+
+def bag_frame_times(bag_file, topic=COLOR_TOPIC):
+    """(frame numbers, timestamps in seconds) of every image in one topic of a bag, sorted by frame."""
+    with BagReader(bag_file) as reader:
+        index = reader.build_index(topic)
+    return index['frame'].copy(), index['time'] / 1e9
+
+
+def join_nearest(frame_times, telem, tolerance=DEFAULT_TOLERANCE, interpolate=False):
+    """
+    Match each frame time to the nearest telemetry row by timestamp.
+    Returns (matched mask, throttle, steering, heading, offset in seconds), one entry per frame.
+    With interpolate=True throttle and steering are linearly interpolated between the rows
+    on either side of the frame; heading always comes from the nearest row.
+    """
+    frame_times = np.asarray(frame_times, dtype=np.float64)
+    times = telem['timestamp']
+    if len(times) == 0:
+        empty = np.full(len(frame_times), np.nan)
+        return np.zeros(len(frame_times), dtype=bool), empty, empty, empty, empty
+
+    # nearest of the rows just before and just after each frame
+    right = np.clip(np.searchsorted(times, frame_times), 0, len(times) - 1)
+    left = np.clip(right - 1, 0, len(times) - 1)
+    nearest = np.where(np.abs(frame_times - times[left]) <= np.abs(times[right] - frame_times), left, right)
+    offset = frame_times - times[nearest]
+    matched = np.abs(offset) <= tolerance
+
+    if interpolate:
+        throttle = np.interp(frame_times, times, telem['throttle'])
+        steering = np.interp(frame_times, times, telem['steering'])
+    else:
+        throttle = telem['throttle'][nearest]
+        steering = telem['steering'][nearest]
+    return matched, throttle, steering, telem['heading'][nearest], offset
+
+
+def join_frames(frames, telem):
+    """
+    Match each frame to the first telemetry row with the same frame number (logs without timestamps).
+    Returns (matched mask, throttle, steering, heading), one entry per frame.
+    """
+    frames = np.asarray(frames)
+    if len(telem) == 0:
+        empty = np.full(len(frames), np.nan)
+        return np.zeros(len(frames), dtype=bool), empty, empty, empty
+
+    # a stable sort keeps rows for the same frame in log order, so searchsorted finds the first one
+    by_frame = telem[np.argsort(telem['frame'], kind='stable')]
+    rows = np.clip(np.searchsorted(by_frame['frame'], frames), 0, len(by_frame) - 1)
+    matched = by_frame['frame'][rows] == frames
+    return matched, by_frame['throttle'][rows], by_frame['steering'][rows], by_frame['heading'][rows]
+
+
+def frame_lookup(frames, frame_times, telem, tolerance=DEFAULT_TOLERANCE, interpolate=False):
+    """
+    {frame: (throttle, steering, heading)} for every frame within tolerance of a telemetry row,
+    formatted like the values in the log so it can stand in for an exact frame-number lookup.
+    Also returns the match offsets (seconds) of the matched frames.
+    """
+    matched, throttle, steering, heading, offset = join_nearest(frame_times, telem, tolerance, interpolate)
+    lookup = {}
+    for frm, t, s, h in zip(frames[matched].tolist(), np.rint(throttle[matched]).tolist(),
+                            np.rint(steering[matched]).tolist(), heading[matched].tolist()):
+        lookup[frm] = (str(int(t)), str(int(s)), f"{h:g}")
+    return lookup, offset[matched]